@@ -1,4 +1,3 @@
-import asyncio
 import logging
 from aiogram import Router, types, F
 from aiogram.filters import Command
@@ -6,12 +5,24 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 from config import ADMIN_IDS
-from db.crud import build_crud, analytics_crud, showcase_crud
+from db.crud import build_crud, analytics_crud, showcase_crud, broadcast_crud
+from db.cache import get_cache_stats
+from db.activity import activity_writer
+from deferred import deferred_tasks
+from search_results import search_results
+from discovery import discovery
+from middlewares import db_session_middleware, throttling_middleware, OutboundPriorityMiddleware
+from broadcast import broadcaster
+from media import photo_sender
+from renderer import renderer
 from db.models import BuildType, BuildStyle, Difficulty, BUILD_TYPE_MAP, STYLE_MAP, DIFFICULTY_MAP
 from keyboards import get_admin_keyboard, get_admin_builds_keyboard, get_admin_moderation_keyboard
 
 # Создаем роутер для админ-панели
 admin_router = Router()
+# Ответы админке уступают ответам пользователям, но обгоняют рассылку
+admin_router.message.middleware(OutboundPriorityMiddleware('admin'))
+admin_router.callback_query.middleware(OutboundPriorityMiddleware('admin'))
 
 # Фильтр для проверки прав администратора
 def admin_filter(message: types.Message) -> bool:
@@ -58,6 +69,108 @@ async def admin_stats_handler(message: types.Message):
                 stats_text += f"{i}. {build.name} - {build.downloads_count} скачиваний\n"
         else:
             stats_text += "\nНет данных о сборках"
+
+        stats_text += "\n<b>Кэш:</b>\n"
+        for name, cache_stats in get_cache_stats().items():
+            stats_text += (
+                f"• {name}: {cache_stats['size']}/{cache_stats['maxsize']}, "
+                f"попаданий {cache_stats['hit_rate'] * 100:.0f}% "
+                f"({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']}), "
+                f"вытеснено {cache_stats['evictions']}\n"
+            )
+
+        queue_stats = activity_writer.stats()
+        stats_text += (
+            f"\n<b>Очередь активности:</b> {queue_stats['depth']}/{queue_stats['maxsize']} "
+            f"({queue_stats['policy']})\n"
+            f"• Записано: {queue_stats['written']}, отброшено: {queue_stats['dropped']}, "
+            f"отсеяно: {queue_stats['sampled_out']}, ошибок: {queue_stats['failed']}\n"
+            f"• Задержка: {queue_stats['avg_latency_ms']:.0f} мс (макс. {queue_stats['max_latency_ms']:.0f} мс)\n"
+        )
+
+        query_stats = db_session_middleware.stats()
+        if query_stats:
+            stats_text += "\n<b>SQL-запросов на апдейт:</b>\n"
+            for update_type, update_stats in query_stats.items():
+                stats_text += (
+                    f"• {update_type}: {update_stats['avg_queries']:.1f} "
+                    f"(макс. {update_stats['max_queries']}, апдейтов {update_stats['updates']})\n"
+                )
+
+        throttle_stats = throttling_middleware.stats()
+        stats_text += "\n<b>Антифлуд (пропущено / отброшено / склеено):</b>\n"
+        for action, action_stats in throttle_stats.items():
+            stats_text += (
+                f"• {action}: {action_stats['passed']} / {action_stats['throttled']} / "
+                f"{action_stats['coalesced']}\n"
+            )
+
+        deferred_stats = deferred_tasks.stats()
+        if deferred_stats:
+            stats_text += f"\n<b>Фоновые задачи</b> (выполняются: {deferred_tasks.running}, всего: {deferred_tasks.pending()}):\n"
+            for name, task_stats in deferred_stats.items():
+                stats_text += (
+                    f"• {name}: {task_stats['completed']}/{task_stats['spawned']}, "
+                    f"ошибок {task_stats['failed']}, отброшено {task_stats['dropped']}, "
+                    f"{task_stats['avg_ms']:.0f} мс (макс. {task_stats['max_ms']:.0f} мс)\n"
+                )
+
+        results_stats = search_results.stats()
+        stats_text += (
+            f"\n<b>Листание результатов поиска:</b>\n"
+            f"• Поисков: {results_stats['searches']}, переходов: {results_stats['moves']}, "
+            f"активных курсоров: {results_stats['cursors']}\n"
+            f"• Страниц загружено: {results_stats['page_loads']} (заранее: {results_stats['prefetched']}), "
+            f"переход ждал загрузку: {results_stats['waited']}, "
+            f"исчезло до показа: {results_stats['dropped']}\n"
+        )
+
+        discovery_stats = discovery.stats()
+        stats_text += (
+            f"\n<b>Случайные сборки без повторов:</b>\n"
+            f"• Показано: {discovery_stats['picks']}, пропущено ID: {discovery_stats['skipped']}, "
+            f"пройдено корзин целиком: {discovery_stats['cycles']}\n"
+            f"• Активных курсоров: {discovery_stats['cursors']}\n"
+        )
+
+        photo_stats = photo_sender.stats()
+        stats_text += (
+            f"\n<b>Отправка фото:</b>\n"
+            f"• По file_id: {photo_stats['file_id']['sends']}, "
+            f"{photo_stats['file_id']['avg_ms']:.0f} мс в среднем\n"
+            f"• По URL: {photo_stats['url']['sends']}, "
+            f"{photo_stats['url']['avg_ms']:.0f} мс в среднем, ошибок {photo_stats['url']['failures']}\n"
+            f"• Пропущено битых URL: {photo_stats['skipped_broken']}\n"
+        )
+
+        render_stats = renderer.stats()
+        if render_stats:
+            stats_text += "\n<b>Вызовы API при навигации:</b>\n"
+            for action, action_stats in render_stats.items():
+                stats_text += (
+                    f"• {action}: {action_stats['calls']} вызовов на {action_stats['updates']} апдейтов, "
+                    f"сэкономлено {action_stats['saved']}\n"
+                )
+
+        broadcast_stats = broadcaster.stats()
+        stats_text += (
+            f"\n<b>Рассылки:</b>\n"
+            f"• Активных: {broadcast_stats['running']}\n"
+            f"• Лимит: {broadcast_stats['rate_limit']:.0f} сообщ./с\n"
+            f"• RetryAfter от Telegram: {broadcast_stats['retry_after']}\n"
+        )
+
+        if hasattr(message.bot.session, 'stats'):
+            outbound_stats = message.bot.session.stats()
+            stats_text += (
+                f"\n<b>Очередь запросов к API</b> (ждут: {outbound_stats.pop('waiting')}, "
+                f"общих пауз по 429: {outbound_stats.pop('global_pauses')}):\n"
+            )
+            for name, class_stats in outbound_stats.items():
+                stats_text += (
+                    f"• {name}: {class_stats['requests']}, ожидание {class_stats['avg_wait_ms']:.0f} мс "
+                    f"(макс. {class_stats['max_wait_ms']:.0f} мс), RetryAfter {class_stats['retry_after']}\n"
+                )
             
         await message.answer(stats_text, parse_mode="HTML")
         
@@ -283,16 +396,17 @@ async def process_build_difficulty(callback: types.CallbackQuery, state: FSMCont
         success_text += f"\n<b>ID сборки:</b> {build.id}"
         
         # Если есть изображение, отправляем его с текстом
+        # Заодно Telegram загрузит картинку и мы сохраним ее file_id для пользователей
         if user_data.get('image_url'):
-            try:
-                await callback.message.answer_photo(
-                    photo=user_data['image_url'],
-                    caption=success_text,
-                    parse_mode="HTML",
-                    reply_markup=get_admin_keyboard()
-                )
-            except Exception as e:
-                logging.error(f"Error sending photo: {e}")
+            sent = await photo_sender.answer_photo(
+                callback.message,
+                build,
+                build_crud,
+                caption=success_text,
+                parse_mode="HTML",
+                reply_markup=get_admin_keyboard()
+            )
+            if not sent:
                 await callback.message.answer(
                     f"{success_text}\n\n⚠️ <i>Не удалось загрузить изображение</i>",
                     parse_mode="HTML",
@@ -337,11 +451,9 @@ async def delete_build_command(message: types.Message):
             await message.answer("❌ Сборка с таким ID не найдена")
             return
         
-        # Здесь должна быть логика удаления (пока просто отмечаем как неодобренную)
-        build.is_approved = False
+        # build - общий экземпляр из кэша сборок, его не меняем: кэши сбросит delete_build
         answer = await build_crud.delete_build(build_id=build_id)
-        # В реальном приложении нужно добавить метод delete в CRUD
-        
+
         if answer:
             await message.answer(f"✅ Сборка '{build.name}' удалена!")
         else:
@@ -442,13 +554,20 @@ async def user_stats_handler(message: types.Message):
         if len(parts) < 2:
             await message.answer(
                 "❌ Неверный формат.\n"
-                "Используйте: <code>/user_stats ID_пользователя</code>\n"
+                "Используйте: <code>/user_stats ID_пользователя</code> или <code>/user_stats @username</code>\n"
                 "Пример: <code>/user_stats 123456789</code>",
                 parse_mode="HTML"
             )
             return
         
-        user_id = int(parts[1])
+        if parts[1].startswith('@'):
+            # Поиск по username через индекс таблицы users
+            user_id = await analytics_crud.get_user_id_by_username(parts[1][1:])
+            if user_id is None:
+                await message.answer(f"❌ Пользователь {parts[1]} не найден в статистике")
+                return
+        else:
+            user_id = int(parts[1])
         stats = await analytics_crud.get_user_stats(user_id)
         
         if not stats['first_seen']:
@@ -458,11 +577,13 @@ async def user_stats_handler(message: types.Message):
         user_text = (
             f"👤 <b>Статистика пользователя</b> ID: {user_id}\n"
             "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"📅 <b>Первое действие:</b> {stats['first_seen'].timestamp.strftime('%d.%m.%Y %H:%M')}\n"
-            f"🕒 <b>Последнее действие:</b> {stats['last_seen'].timestamp.strftime('%d.%m.%Y %H:%M')}\n"
+            f"📅 <b>Первое действие:</b> {stats['first_seen'].strftime('%d.%m.%Y %H:%M')}\n"
+            f"🕒 <b>Последнее действие:</b> {stats['last_seen'].strftime('%d.%m.%Y %H:%M')}\n"
             f"📊 <b>Всего действий:</b> {stats['total_actions']}\n"
-            f"🎯 <b>Последнее действие:</b> {stats['last_seen'].action}\n"
+            f"🎯 <b>Последнее действие:</b> {stats['last_action']}\n"
         )
+        if stats['is_blocked']:
+            user_text += "🚫 <b>Заблокировал бота</b>\n"
         
         await message.answer(user_text, parse_mode="HTML")
         
@@ -477,7 +598,8 @@ async def newsletter_command(message: types.Message, state: FSMContext):
     """Команда для создания рассылки"""
     await message.answer(
         "📢 <b>Создание рассылки</b>\n\n"
-        "Введите текст сообщения, которое будет отправлено всем пользователям:\n\n"
+        "Введите текст сообщения, которое будет отправлено всем пользователям, "
+        "или отправьте фото/видео/документ - оно будет скопировано всем:\n\n"
         "<i>Поддерживается HTML разметка</i>",
         parse_mode="HTML"
     )
@@ -487,66 +609,51 @@ async def newsletter_command(message: types.Message, state: FSMContext):
 # Обработчик текста рассылки
 @admin_router.message(NewsletterStates.waiting_newsletter_message, admin_filter)
 async def process_newsletter(message: types.Message, state: FSMContext):
-    """Обработка текста рассылки и отправка всем пользователям"""
-    newsletter_text = message.text
-    
-    if not newsletter_text:
-        await message.answer("❌ Сообщение не может быть пустым")
-        await state.clear()
-        return
-    
-    # Показываем что начали рассылку
-    progress_msg = await message.answer("🔄 Начинаю рассылку...")
+    """Создание рассылки и запуск ее в фоне"""
+    await state.clear()
     
-    # Получаем всех уникальных пользователей из user_activity
-    unique_users = await analytics_crud.get_unique_users()
-    total_users = len(unique_users)
+    # Получаем количество пользователей из таблицы users
+    total_users = await analytics_crud.get_reachable_users_count()
     
     if total_users == 0:
-        await progress_msg.edit_text("❌ Нет пользователей для рассылки")
-        await state.clear()
+        await message.answer("❌ Нет пользователей для рассылки")
         return
     
-    # Отправляем рассылку
-    success_count = 0
-    fail_count = 0
-    
-    for i, user_id in enumerate(unique_users, 1):
-        try:
-            await message.bot.send_message(
-                chat_id=user_id,
-                text=f"📢 <b>Новость от администратора:</b>\n\n{newsletter_text}",
-                parse_mode="HTML"
-            )
-            success_count += 1
-            
-            # Обновляем прогресс каждые 10 сообщений
-            if i % 10 == 0:
-                await progress_msg.edit_text(
-                    f"🔄 Рассылка... ({i}/{total_users})\n"
-                    f"✅ Успешно: {success_count}\n"
-                    f"❌ Ошибок: {fail_count}"
-                )
-            
-            # Небольшая пауза чтобы не спамить
-            await asyncio.sleep(0.1)
-            
-        except Exception as e:
-            fail_count += 1
-            logging.warning(f"Не удалось отправить пользователю {user_id}: {e}")
-    
-    # Финальный отчет
-    await progress_msg.edit_text(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"📊 Статистика:\n"
-        f"• Всего пользователей: {total_users}\n"
-        f"• ✅ Успешно: {success_count}\n"
-        f"• ❌ Ошибок: {fail_count}\n"
-        f"• 📈 Доставлено: {(success_count/total_users)*100:.1f}%",
-        parse_mode="HTML"
+    # Показываем что начали рассылку
+    progress_msg = await message.answer(
+        f"🔄 Начинаю рассылку на {total_users} пользователей...\n\n"
+        f"Остановить: /stop_newsletter"
     )
     
-    await state.clear()
+    if message.text:
+        # Текст отправляем с заголовком, как раньше
+        broadcast = await broadcast_crud.create_broadcast(
+            admin_chat_id=message.chat.id,
+            total=total_users,
+            text=message.text,
+            progress_message_id=progress_msg.message_id
+        )
+    else:
+        # Фото, видео, документы и т.п. копируем как есть
+        broadcast = await broadcast_crud.create_broadcast(
+            admin_chat_id=message.chat.id,
+            total=total_users,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id,
+            progress_message_id=progress_msg.message_id
+        )
+    
+    # Обработчик не ждет окончания рассылки
+    broadcaster.start(message.bot, broadcast)
+
+
+@admin_router.message(Command("stop_newsletter"), admin_filter)
+async def stop_newsletter_handler(message: types.Message):
+    """Остановить идущие рассылки"""
+    if broadcaster.cancel():
+        await message.answer("🛑 Останавливаю рассылку...")
+    else:
+        await message.answer("❌ Сейчас нет активных рассылок")
 
 @admin_router.message(F.text == "⏳ Модерация", admin_filter)
 async def moderation_handler(message: types.Message):
@@ -0,0 +1,148 @@
+"""Текстовый поиск сборок: полнотекстовый индекс против LIKE '%...%'
+
+Во временной базе SQLite создается 100 000 сборок со случайными
+названиями и описаниями из словаря, после чего миграции строят индекс
+FTS5 (как на рабочей базе). Для каждого запроса замеряется первая
+страница результатов и подсчет всех совпадений:
+    fts   - BuildCRUD.count_search_results + search_builds, как при
+            первом показе результатов /search (кэш сборок сбрасывается
+            перед каждым замером);
+    like  - name LIKE '%слово%' OR description LIKE '%слово%' по каждому
+            слову, как искали бы без индекса.
+Запросы подобраны от редких слов к частым.
+
+Запуск из корня репозитория:
+    python -m benchmarks.fulltext_search [сборок]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import insert, text
+
+from db.cache import build_cache
+from db.crud import build_crud, search_terms
+from db.migrations import run_migrations
+from db.models import Base, Build, BuildType, BuildStyle, Difficulty
+from db.session import async_session, create_sqlite_engines, routing_session_class
+
+
+DEFAULT_BUILDS = 100_000
+REPEATS = 50
+PAGE_SIZE = 10
+
+# Слова с заданной долей сборок, в описании которых они встречаются
+TOPIC_WORDS = {
+    'драконы': 0.001,
+    'автоматизация': 0.01,
+    'dragons': 0.01,
+    'редстоун': 0.05,
+    'замок': 0.2,
+}
+QUERIES = ['драконы', 'автоматизация', 'dragons', 'редстоун механизмы', 'замок', 'замок драконы']
+FILLER = ("мир", "остров", "ресурсы", "крафт", "выживание", "карта", "квесты", "мобы",
+          "данжи", "биомы", "механизмы", "фермы", "постройки", "команда", "сервер", "моды")
+
+
+def make_rows(count: int) -> list:
+    rnd = random.Random(42)
+    syllables = ["ка", "ро", "ми", "ан", "то", "ле", "ви", "зу", "на", "ос", "эр", "ти"]
+    vocabulary = ["".join(rnd.choices(syllables, k=rnd.randint(2, 4))) for _ in range(5000)]
+    rows = []
+    for number in range(count):
+        words = rnd.choices(vocabulary, k=25) + rnd.choices(FILLER, k=5)
+        words += [word for word, share in TOPIC_WORDS.items() if rnd.random() < share]
+        rnd.shuffle(words)
+        rows.append({
+            'name': f"{rnd.choice(vocabulary).capitalize()} {rnd.choice(FILLER)} #{number}",
+            'description': " ".join(words),
+            'download_url': f"https://example.com/{number}.zip",
+            'build_type': rnd.choice(list(BuildType)),
+            'style': rnd.choice(list(BuildStyle)),
+            'difficulty': rnd.choice(list(Difficulty)),
+            'downloads_count': 0,
+            'rating': 0,
+            'votes_count': 0,
+            'is_approved': True
+        })
+    return rows
+
+
+async def like_page(query: str) -> list:
+    terms, params = like_conditions(query)
+    async with async_session() as session:
+        result = await session.execute(
+            text(f"SELECT id FROM builds WHERE is_approved AND {terms} ORDER BY id LIMIT {PAGE_SIZE}"), params
+        )
+        return result.scalars().all()
+
+
+async def like_count(query: str) -> int:
+    terms, params = like_conditions(query)
+    async with async_session() as session:
+        return (await session.execute(text(f"SELECT COUNT(*) FROM builds WHERE is_approved AND {terms}"), params)).scalar()
+
+
+def like_conditions(query: str) -> tuple:
+    conditions, params = [], {}
+    for number, term in enumerate(search_terms(query)):
+        conditions.append(f"(name LIKE :term{number} OR description LIKE :term{number})")
+        params[f"term{number}"] = f"%{term}%"
+    return " AND ".join(conditions), params
+
+
+async def fts_page(query: str) -> list:
+    build_cache.clear()
+    total = await build_crud.count_search_results(query)
+    return await build_crud.search_builds(query, limit=PAGE_SIZE, total=total)
+
+
+async def measure(func, query: str) -> tuple:
+    await func(query)  # прогрев кэша страниц SQLite
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        result = await func(query)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[int(len(timings) * 0.95)] * 1000, result
+
+
+async def main():
+    builds = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUILDS
+
+    # Отдельная временная база, а не minecraft_bot.db
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-search-"), "search.db")
+    read_engine, write_engine = create_sqlite_engines(f"sqlite+aiosqlite:///{path}")
+    async_session.configure(sync_session_class=routing_session_class(read_engine, write_engine))
+
+    started = time.perf_counter()
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(Build), make_rows(builds))
+    await run_migrations(write_engine)
+    print(f"{builds} builds, index built in {time.perf_counter() - started:.1f} s, "
+          f"{REPEATS} runs per query, ms p50 / p95")
+
+    print(f"{'query':>20} | {'matches':>7} | {'fts page':>13} | {'fts count':>13} | "
+          f"{'like page':>13} | {'like count':>13}")
+    for query in QUERIES:
+        fts_p50, fts_p95, _ = await measure(fts_page, query)
+        count_p50, count_p95, matches = await measure(build_crud.count_search_results, query)
+        like_p50, like_p95, _ = await measure(like_page, query)
+        like_count_p50, like_count_p95, like_matches = await measure(like_count, query)
+        # LIKE ищет подстроку, FTS - префикс слова: числа совпадений могут слегка отличаться
+        print(f"{query:>20} | {matches:>7} | {fts_p50:5.2f} / {fts_p95:5.2f} | {count_p50:5.2f} / {count_p95:5.2f} | "
+              f"{like_p50:5.2f} / {like_p95:5.2f} | {like_count_p50:5.2f} / {like_count_p95:5.2f}"
+              f"{'' if matches == like_matches else f'  (like: {like_matches})'}")
+
+    await read_engine.dispose()
+    await write_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
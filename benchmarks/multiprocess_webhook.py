@@ -0,0 +1,173 @@
+"""Масштабирование вебхука по процессам: один процесс против workers.py
+
+Обработчик апдейта нагружает CPU (HANDLER_CPU_MS миллисекунд чистого
+Python), поэтому один процесс упирается в одно ядро. Сравниваются:
+    single   - create_app в одном процессе (как python bot.py);
+    workers N - фронт workers.py и N процессов-воркеров.
+Клиент шлет апдейты от USERS пользователей; воркеры проверяют, что
+апдейты каждого пользователя обработаны в порядке отправки.
+Время - от первого запроса до окончания обработки всех апдейтов.
+
+Запуск из корня репозитория:
+    python -m benchmarks.multiprocess_webhook [апдейтов] [макс. число воркеров]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp import web, ClientSession
+
+from webhook import WEBHOOK_PATH, create_app
+from workers import create_front_app, start_workers, stop_workers
+
+
+DEFAULT_UPDATES = 4000
+DEFAULT_CONCURRENCY = 40
+HANDLER_CPU_MS = 2.0
+USERS = 1000
+SECRET = "bench-secret"
+TOKEN = "123456:" + "A" * 35
+# Воркеры импортируют этот модуль заново и берут из него dp и bot
+APP_MODULE = "benchmarks.multiprocess_webhook"
+
+
+def burn_cpu(ms: float):
+    deadline = time.perf_counter() + ms / 1000
+    value = 0
+    while time.perf_counter() < deadline:
+        value = sum(i * i for i in range(200))
+    return value
+
+
+# Диспетчер воркера (импортируется каждым процессом)
+dp = Dispatcher()
+bot = Bot(token=TOKEN)
+_processed = {'count': 0, 'out_of_order': 0, 'last': {}}
+
+
+@dp.message()
+async def handler(message: Message):
+    burn_cpu(HANDLER_CPU_MS)
+    last = _processed['last']
+    if message.message_id < last.get(message.from_user.id, 0):
+        _processed['out_of_order'] += 1
+    last[message.from_user.id] = message.message_id
+    _processed['count'] += 1
+
+
+@dp.shutdown()
+async def write_result():
+    result_dir = os.getenv('BENCH_RESULT_DIR')
+    if result_dir:
+        path = os.path.join(result_dir, f"worker-{os.getenv('BOT_WORKER_INDEX', 'single')}.json")
+        with open(path, "w") as f:
+            json.dump({'count': _processed['count'], 'out_of_order': _processed['out_of_order']}, f)
+
+
+def make_update(update_id: int) -> dict:
+    user_id = update_id % USERS + 1
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": "🎲 Случайная сборка"
+        }
+    }
+
+
+async def send_load(url: str, updates: int, concurrency: int):
+    queue = asyncio.Queue()
+    for update_id in range(1, updates + 1):
+        queue.put_nowait(update_id)
+
+    async with ClientSession() as client:
+        async def sender():
+            while not queue.empty():
+                update_id = queue.get_nowait()
+                headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+                async with client.post(url, json=make_update(update_id), headers=headers) as response:
+                    assert response.status == 200, response.status
+
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+
+
+async def serve(app: web.Application):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}{WEBHOOK_PATH}"
+
+
+async def run_single(updates: int, concurrency: int):
+    runner, url = await serve(create_app(dp, bot, secret_token=SECRET, max_in_flight=1000))
+    started = time.perf_counter()
+    await send_load(url, updates, concurrency)
+    # Остановка дожидается апдейтов в работе
+    await runner.cleanup()
+    return time.perf_counter() - started
+
+
+async def run_front(socket_paths: list, updates: int, concurrency: int):
+    runner, url = await serve(create_front_app(socket_paths, SECRET))
+    started = time.perf_counter()
+    await send_load(url, updates, concurrency)
+    await runner.cleanup()
+    return started
+
+
+def read_results(result_dir: str) -> dict:
+    total = {'count': 0, 'out_of_order': 0}
+    for name in os.listdir(result_dir):
+        with open(os.path.join(result_dir, name)) as f:
+            result = json.load(f)
+        total['count'] += result['count']
+        total['out_of_order'] += result['out_of_order']
+        os.remove(os.path.join(result_dir, name))
+    return total
+
+
+def report(name: str, updates: int, elapsed: float, result: dict, baseline: float = None):
+    scaling = f" | x{baseline / elapsed:4.2f}" if baseline else ""
+    print(
+        f"{name:>10} | {updates / elapsed:6.0f} updates/s ({elapsed:.1f} s) | "
+        f"processed {result['count']} | out of order {result['out_of_order']}{scaling}"
+    )
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_UPDATES
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    print(f"{updates} updates, {DEFAULT_CONCURRENCY} connections, handler {HANDLER_CPU_MS:.0f} ms CPU, "
+          f"{os.cpu_count()} CPU(s)")
+
+    result_dir = tempfile.mkdtemp(prefix="bench-results-")
+    os.environ['BENCH_RESULT_DIR'] = result_dir
+
+    elapsed = asyncio.run(run_single(updates, DEFAULT_CONCURRENCY))
+    baseline = elapsed
+    report("single", updates, elapsed, read_results(result_dir))
+
+    workers = 1
+    while workers <= max_workers:
+        processes, socket_paths, socket_dir = start_workers(workers, APP_MODULE, max_in_flight=1000)
+        started = asyncio.run(run_front(socket_paths, updates, DEFAULT_CONCURRENCY))
+        # Остановка воркеров дожидается всех апдейтов в работе
+        stop_workers(processes, socket_dir)
+        elapsed = time.perf_counter() - started
+        report(f"workers {workers}", updates, elapsed, read_results(result_dir), baseline)
+        workers *= 2
+
+    os.rmdir(result_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Ответы пользователям во время рассылки: обычная сессия против ScheduledSession
+
+Локальный сервер изображает Bot API: отвечает за API_LATENCY и, как
+Telegram, возвращает 429 (retry after 1), если за последнюю секунду
+было больше SERVER_LIMIT сообщений. Рассылка идет как в broadcast.py
+(TokenBucket на 25 сообщ./с, пауза при RetryAfter), параллельно
+INTERACTIVE_USERS пользователей получают ответы раз в секунду.
+Считаются задержка ответов пользователям и потерянные из-за 429 ответы.
+
+Запуск из корня репозитория:
+    python -m benchmarks.outbound_priority [секунды]
+"""
+import asyncio
+import statistics
+import sys
+import time
+from collections import deque
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiohttp import web
+
+from broadcast import TokenBucket
+from outbound import ScheduledSession, priority
+
+
+DEFAULT_SECONDS = 10
+API_LATENCY = 0.02
+SERVER_LIMIT = 30
+BROADCAST_RATE = 25
+BROADCAST_WORKERS = 8
+INTERACTIVE_USERS = 15
+TOKEN = "123456:" + "A" * 35
+
+
+def make_server(counters: dict) -> web.Application:
+    recent = deque()
+
+    async def handle(request: web.Request) -> web.Response:
+        await asyncio.sleep(API_LATENCY)
+        data = await request.post()
+        now = time.monotonic()
+        while recent and recent[0] < now - 1:
+            recent.popleft()
+        if len(recent) >= SERVER_LIMIT:
+            counters['429'] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            })
+        recent.append(now)
+        counters['ok'] += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": counters['ok'], "date": int(time.time()),
+            "chat": {"id": int(data["chat_id"]), "type": "private"}, "text": "ok"
+        }})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+async def broadcast(bot: Bot, stop: asyncio.Event, result: dict):
+    bucket = TokenBucket(BROADCAST_RATE)
+    user_ids = iter(range(1_000_000, 2_000_000))
+
+    async def worker():
+        with priority('bulk'):
+            while not stop.is_set():
+                user_id = next(user_ids)
+                while True:
+                    await bucket.acquire()
+                    try:
+                        await bot.send_message(user_id, "Новость")
+                        result['sent'] += 1
+                        break
+                    except TelegramRetryAfter as e:
+                        bucket.pause(e.retry_after)
+
+    await asyncio.gather(*(worker() for _ in range(BROADCAST_WORKERS)))
+
+
+async def interactive(bot: Bot, user_id: int, stop: asyncio.Event, result: dict):
+    await asyncio.sleep(user_id / INTERACTIVE_USERS)
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            await bot.send_message(user_id, "Ответ на нажатие")
+            result['latency'].append(time.perf_counter() - started)
+        except TelegramRetryAfter:
+            # Обработчик получил 429 - пользователь остался без ответа
+            result['lost'] += 1
+        await asyncio.sleep(1)
+
+
+async def run(name: str, session, seconds: float, base_url: str):
+    session.api = TelegramAPIServer.from_base(base_url)
+    bot = Bot(token=TOKEN, session=session)
+    stop = asyncio.Event()
+    result = {'sent': 0, 'latency': [], 'lost': 0}
+
+    tasks = [asyncio.create_task(broadcast(bot, stop, result))]
+    tasks += [asyncio.create_task(interactive(bot, user_id, stop, result))
+              for user_id in range(1, INTERACTIVE_USERS + 1)]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await bot.session.close()
+
+    latency = sorted(result['latency'])
+    p95 = latency[int(len(latency) * 0.95)] if latency else 0
+    print(
+        f"{name:>10} | broadcast {result['sent'] / seconds:5.1f} msg/s | "
+        f"replies {len(latency)}, lost {result['lost']} | "
+        f"reply p50 {statistics.median(latency) * 1000 if latency else 0:5.0f} ms, "
+        f"p95 {p95 * 1000:5.0f} ms"
+    )
+
+
+async def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SECONDS
+    counters = {'ok': 0, '429': 0}
+    runner = web.AppRunner(make_server(counters))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    print(f"{seconds:.0f} s, server limit {SERVER_LIMIT}/s, broadcast {BROADCAST_RATE}/s, "
+          f"{INTERACTIVE_USERS} users replying 1/s")
+
+    for name, session in (("plain", AiohttpSession()), ("scheduled", ScheduledSession())):
+        counters.update({'ok': 0, '429': 0})
+        await run(name, session, seconds, base_url)
+        print(f"{'':>10} | server: {counters['ok']} ok, {counters['429']} x 429")
+
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""Бенчмарк выбора случайной сборки: ORDER BY random() против пула ID
+
+Запуск из корня репозитория:
+    python -m benchmarks.random_selection [10000 100000 1000000]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from array import array
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from db.models import Base, Build, BuildType, BuildStyle, Difficulty
+
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+PICKS = 200
+
+
+def fill_database(path: str, rows: int):
+    """Наполнить базу сборками и удалить часть, чтобы появились пропуски в ID"""
+    connection = sqlite3.connect(path)
+    build_types = [member.name for member in BuildType]
+    styles = [member.name for member in BuildStyle]
+    difficulties = [member.name for member in Difficulty]
+
+    connection.executemany(
+        "INSERT INTO builds (name, description, download_url, build_type, style, difficulty, "
+        "downloads_count, rating, votes_count, is_approved) VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, 1)",
+        (
+            (
+                f"Build {i}", "Описание сборки " * 10, f"https://example.com/{i}",
+                random.choice(build_types), random.choice(styles), random.choice(difficulties)
+            )
+            for i in range(rows)
+        )
+    )
+    connection.execute("DELETE FROM builds WHERE abs(random()) % 10 = 0")
+    connection.commit()
+    connection.close()
+
+
+async def timed(picks: int, pick) -> float:
+    started = time.perf_counter()
+    for _ in range(picks):
+        await pick()
+    return (time.perf_counter() - started) / picks * 1000
+
+
+async def run(rows: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    fill_database(path, rows)
+
+    async def order_by_random():
+        async with session_factory() as session:
+            stmt = select(Build).where(Build.is_approved == True).order_by(func.random()).limit(1)
+            return (await session.execute(stmt)).scalar_one_or_none()
+
+    # Загрузка пула - разовая стоимость, дальше пул живет в id_pool_cache
+    started = time.perf_counter()
+    async with session_factory() as session:
+        result = await session.execute(select(Build.id).where(Build.is_approved == True))
+        pool = array('q', result.scalars().all())
+    pool_load_ms = (time.perf_counter() - started) * 1000
+
+    async def id_pool():
+        async with session_factory() as session:
+            return await session.get(Build, random.choice(pool))
+
+    picks = max(5, PICKS * 10_000 // rows)
+    old_ms = await timed(picks, order_by_random)
+    new_ms = await timed(PICKS, id_pool)
+
+    print(
+        f"{rows:>9} rows | ORDER BY random(): {old_ms:8.2f} ms | "
+        f"id pool: {new_ms:6.2f} ms (pool load {pool_load_ms:.0f} ms once, "
+        f"{pool.itemsize * len(pool) / 1024:.0f} KiB) | x{old_ms / new_ms:.0f}"
+    )
+    await engine.dispose()
+
+
+async def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    for rows in sizes:
+        await run(rows)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
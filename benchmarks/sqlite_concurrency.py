@@ -0,0 +1,137 @@
+"""Нагрузочный тест SQLite: движок по умолчанию против профиля WAL + один писатель
+
+Каждый воркер имитирует апдейт с сессией на апдейт (как DbSessionMiddleware):
+читает сборку, в части апдейтов увеличивает счетчик и пишет активность,
+коммитит и затем "обращается к Telegram" (sleep).
+
+Запуск из корня репозитория:
+    python -m benchmarks.sqlite_concurrency [воркеры] [секунды]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from db.models import Base, Build, UserActivity, BuildType, BuildStyle, Difficulty
+from db.session import create_sqlite_engines, routing_session_class
+
+
+DEFAULT_WORKERS = 200
+DEFAULT_SECONDS = 10
+BUILDS = 10_000
+WRITE_SHARE = 0.3       # доля апдейтов с записью (голос/скачивание + активность)
+API_LATENCY = 0.02      # время "запроса к Telegram" внутри апдейта
+
+
+def fill_database(path: str):
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO builds (name, description, download_url, build_type, style, difficulty, "
+        "downloads_count, rating, votes_count, is_approved) VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, 1)",
+        (
+            (
+                f"Build {i}", "Описание сборки " * 10, f"https://example.com/{i}",
+                random.choice(list(BuildType)).name, random.choice(list(BuildStyle)).name,
+                random.choice(list(Difficulty)).name
+            )
+            for i in range(BUILDS)
+        )
+    )
+    connection.commit()
+    connection.close()
+
+
+async def make_default(path: str):
+    """Как в продакшене сейчас: create_async_engine без настроек"""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    return [engine], async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def make_tuned(path: str):
+    """Профиль из db.session: WAL, пул читателей, один писатель"""
+    read_engine, write_engine = create_sqlite_engines(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(
+        class_=AsyncSession,
+        sync_session_class=routing_session_class(read_engine, write_engine),
+        expire_on_commit=False
+    )
+    return [read_engine, write_engine], session_factory
+
+
+async def worker(session_factory, deadline: float, results: dict):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            async with session_factory() as session:
+                build = await session.get(Build, random.randint(1, BUILDS))
+                if random.random() < WRITE_SHARE:
+                    await session.execute(
+                        update(Build)
+                        .where(Build.id == build.id)
+                        .values(downloads_count=Build.downloads_count + 1)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await session.execute(insert(UserActivity), [{
+                        'user_id': random.randint(1, 100_000),
+                        'action': 'download_build',
+                        'timestamp': datetime.utcnow()
+                    }])
+                    # Как db.session.commit() в профиле SQLite: запись фиксируется
+                    # сразу, а не держит писателя на время запроса к Telegram
+                    await session.commit()
+                    results['writes'] += 1
+                await asyncio.sleep(API_LATENCY)
+                await session.commit()
+        except (OperationalError, PoolTimeoutError) as e:
+            key = 'locked' if 'locked' in str(e) else 'other_errors'
+            results[key] += 1
+            continue
+        results['ok'] += 1
+        results['latencies'].append(time.perf_counter() - started)
+
+
+async def run(name: str, make_engines, workers: int, seconds: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    setup_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with setup_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await setup_engine.dispose()
+    fill_database(path)
+
+    engines, session_factory = await make_engines(path)
+    results = {'ok': 0, 'writes': 0, 'locked': 0, 'other_errors': 0, 'latencies': []}
+    deadline = time.monotonic() + seconds
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(session_factory, deadline, results) for _ in range(workers)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(results['latencies']) or [0.0]
+    print(
+        f"{name:>8} | {results['ok'] / elapsed:7.1f} updates/s "
+        f"({results['writes'] / elapsed:6.1f} with writes) | "
+        f"p50 {latencies[len(latencies) // 2] * 1000:6.0f} ms, "
+        f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.0f} ms | "
+        f"locked: {results['locked']}, other errors: {results['other_errors']}"
+    )
+    for engine in engines:
+        await engine.dispose()
+
+
+async def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_WORKERS
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SECONDS
+    print(f"{workers} concurrent updates, {seconds} s, {WRITE_SHARE:.0%} with writes")
+    await run("default", make_default, workers, seconds)
+    await run("tuned", make_tuned, workers, seconds)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
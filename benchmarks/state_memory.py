@@ -0,0 +1,130 @@
+"""Память на хранение фильтров и FSM: словарь в памяти против db/state.py
+
+Для USERS пользователей сохраняются фильтры подбора (все три поля) и
+состояние FSM посреди добавления сборки. Сравниваются:
+    dict      - как было: словарь словарей / MemoryStorage aiogram;
+    memory    - MemoryStateBackend (упакованные фильтры, TTL + LRU);
+    sql       - SQLStateBackend: в памяти только ограниченный кэш,
+                данные в SQLite (размер на диске - отдельно).
+Память считается через tracemalloc. Последняя строка показывает, что
+memory-бэкенд не растет, когда пользователей больше его maxsize.
+
+Запуск из корня репозитория:
+    python -m benchmarks.state_memory [пользователей]
+"""
+import asyncio
+import gc
+import os
+import sqlite3
+import sys
+import tempfile
+import tracemalloc
+
+from aiogram.fsm.storage.base import StorageKey, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from admin_handlers import AdminStates
+from db.models import Base
+from db.session import async_session, create_sqlite_engines, routing_session_class
+from db.state import MemoryStateBackend, SQLStateBackend, BackendFSMStorage
+from filters import pack_filters
+
+
+DEFAULT_USERS = 10_000
+FILTERS = {'build_type': 'survival', 'style': 'medieval', 'difficulty': 'expert'}
+
+
+def fsm_data(user_id: int) -> dict:
+    return {'name': f"Сборка {user_id}", 'description': "Описание новой сборки " * 5}
+
+
+def storage_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def measure(fill) -> int:
+    """Прирост памяти (байт) после выполнения fill; объект держим до замера"""
+    gc.collect()
+    tracemalloc.start()
+    keep = await fill()
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return used
+
+
+async def fill_dict_filters(users: int):
+    # Как было в filters.py: словарь user_id -> словарь из трех полей
+    user_filters = {}
+    for user_id in range(1, users + 1):
+        user_filters[user_id] = dict(FILTERS)
+    return user_filters
+
+
+async def fill_backend_filters(backend, users: int):
+    packed = pack_filters(FILTERS)
+    for user_id in range(1, users + 1):
+        await backend.set_filters(user_id, packed)
+    return backend
+
+
+async def fill_fsm(storage, users: int):
+    for user_id in range(1, users + 1):
+        await storage.set_state(storage_key(user_id), AdminStates.waiting_build_url)
+        await storage.set_data(storage_key(user_id), fsm_data(user_id))
+    return storage
+
+
+def database_size(path: str) -> int:
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    connection.close()
+    return page_count * page_size
+
+
+def report(name: str, used: int, users: int, disk: int = None):
+    per_10k = used * 10_000 / users
+    disk_text = f" | on disk {disk * 10_000 / users / 1024:7.0f} KiB / 10k" if disk is not None else ""
+    print(f"{name:>16} | {per_10k / 1024:7.0f} KiB / 10k users | {used / users:6.0f} B/user{disk_text}")
+
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_USERS
+    print(f"{users} users")
+
+    # SQL-бэкенд пишет во временную базу, а не в minecraft_bot.db
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-state-"), "state.db")
+    read_engine, write_engine = create_sqlite_engines(f"sqlite+aiosqlite:///{path}")
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async_session.configure(sync_session_class=routing_session_class(read_engine, write_engine))
+    empty = database_size(path)
+
+    print("filters")
+    report("dict", await measure(lambda: fill_dict_filters(users)), users)
+    report("memory", await measure(lambda: fill_backend_filters(MemoryStateBackend(maxsize=users), users)), users)
+    used = await measure(lambda: fill_backend_filters(SQLStateBackend(cache_size=users), users))
+    filters_disk = database_size(path) - empty
+    report("sql", used, users, filters_disk)
+
+    print("fsm")
+    report("MemoryStorage", await measure(lambda: fill_fsm(MemoryStorage(), users)), users)
+    report("memory", await measure(lambda: fill_fsm(
+        BackendFSMStorage(MemoryStateBackend(maxsize=users), DefaultKeyBuilder()), users)), users)
+    used = await measure(lambda: fill_fsm(
+        BackendFSMStorage(SQLStateBackend(cache_size=users), DefaultKeyBuilder()), users))
+    report("sql", used, users, database_size(path) - empty - filters_disk)
+
+    print(f"bounded: {users * 2} users, maxsize {users}")
+    report("memory filters", await measure(
+        lambda: fill_backend_filters(MemoryStateBackend(maxsize=users), users * 2)), users)
+
+    await read_engine.dispose()
+    await write_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
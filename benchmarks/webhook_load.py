@@ -0,0 +1,114 @@
+"""Нагрузочный тест вебхука: обработка в запросе против фоновой с лимитом
+
+Локальный aiohttp-сервер с диспетчером, обработчик которого имитирует
+работу апдейта (БД + запросы к Telegram) через sleep. Клиент шлет
+апдейты с заданной параллельностью (как Telegram с max_connections).
+
+Запуск из корня репозитория:
+    python -m benchmarks.webhook_load [апдейтов] [параллельность]
+"""
+import asyncio
+import sys
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web, ClientSession
+
+from webhook import WEBHOOK_PATH, create_app
+
+
+DEFAULT_UPDATES = 5000
+DEFAULT_CONCURRENCY = 40
+HANDLER_TIME = 0.05
+SECRET = "bench-secret"
+TOKEN = "123456:" + "A" * 35
+
+
+def make_dispatcher(processed: list) -> Dispatcher:
+    dp = Dispatcher()
+
+    @dp.message()
+    async def handler(message: Message):
+        await asyncio.sleep(HANDLER_TIME)
+        processed[0] += 1
+
+    return dp
+
+
+def make_update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": update_id % 1000 + 1, "type": "private"},
+            "from": {"id": update_id % 1000 + 1, "is_bot": False, "first_name": "User"},
+            "text": "🎲 Случайная сборка"
+        }
+    }
+
+
+def make_inline_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """Как раньше: ответ Telegram только после обработки апдейта"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=False,
+                         secret_token=SECRET).register(app, path=WEBHOOK_PATH)
+    return app
+
+
+def make_bounded_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    return create_app(dp, bot, secret_token=SECRET, max_in_flight=1000)
+
+
+async def run(name: str, make_app, updates: int, concurrency: int):
+    processed = [0]
+    dp = make_dispatcher(processed)
+    bot = Bot(token=TOKEN)
+    runner = web.AppRunner(make_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}{WEBHOOK_PATH}"
+
+    queue = asyncio.Queue()
+    for update_id in range(1, updates + 1):
+        queue.put_nowait(update_id)
+
+    async with ClientSession() as client:
+        # Запрос без секрета должен быть отклонен
+        async with client.post(url, json=make_update(0)) as response:
+            assert response.status == 401, response.status
+
+        async def sender():
+            while not queue.empty():
+                update_id = queue.get_nowait()
+                headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+                async with client.post(url, json=make_update(update_id), headers=headers) as response:
+                    assert response.status == 200, response.status
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        accepted = time.perf_counter() - started
+        while processed[0] < updates:
+            await asyncio.sleep(0.01)
+        done = time.perf_counter() - started
+
+    print(
+        f"{name:>10} | accepted {updates / accepted:8.0f} req/s | "
+        f"processed {updates / done:6.0f} updates/s ({done:.1f} s)"
+    )
+    await runner.cleanup()
+
+
+async def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_UPDATES
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CONCURRENCY
+    print(f"{updates} updates, {concurrency} connections, handler {HANDLER_TIME * 1000:.0f} ms")
+    await run("inline", make_inline_app, updates, concurrency)
+    await run("background", make_bounded_app, updates, concurrency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,15 +4,24 @@ import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 
-from config import TOKEN
+from config import TOKEN, ADMIN_IDS
 from commands import set_bot_commands
 from handlers import router
 from admin_handlers import admin_router
 from contact_handlers import contact_router
+from inline_handlers import inline_router
 from db.session import init_db
+from db.counters import download_counter
+from db.activity import activity_writer
+from db.jobs import stats_rollup_job, similar_builds_job
+from db.state import fsm_storage
+from deferred import deferred_tasks
+from middlewares import db_session_middleware, throttling_middleware
+from broadcast import broadcaster
+from outbound import create_session
+from webhook import get_webhook_secret, create_app, register_webhook, shard_for
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,16 +29,31 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
 )
 
+# При запуске через workers.py: номер этого воркера и число воркеров
+WORKER_INDEX = os.getenv('BOT_WORKER_INDEX')
+WORKERS = int(os.getenv('BOT_WORKERS', 1))
+
 # Инициализация бота и диспетчера
 bot = Bot(
     token=TOKEN,
+    # Все запросы к API - через общий планировщик с лимитами и приоритетами.
+    # Рассылки идут из воркера шарда администратора - ему и бюджет на них
+    session=create_session(
+        processes=WORKERS,
+        broadcasts=shard_for(ADMIN_IDS, WORKERS) == int(WORKER_INDEX or 0)
+    ),
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 
-dp = Dispatcher()
+# Хранилище FSM выбирается STATE_STORAGE (см. db/state.py)
+dp = Dispatcher(storage=fsm_storage)
+# Флуд отсекается до того, как апдейт возьмет сессию БД
+dp.update.outer_middleware(throttling_middleware)
+dp.update.outer_middleware(db_session_middleware)
 dp.include_router(router)
 dp.include_router(admin_router)
-dp.include_router(contact_router) 
+dp.include_router(contact_router)
+dp.include_router(inline_router)
 
 async def on_startup():
     """Действия при запуске бота"""
@@ -39,14 +63,29 @@ async def on_startup():
     await init_db()
     logging.info("Database initialized")
     
+    # Свертка дневной статистики (догоняет пропущенные дни и дальше раз в час) - в одном процессе
+    if WORKER_INDEX in (None, '0'):
+        stats_rollup_job.start()
+        similar_builds_job.start()
+    
+    # Продолжаем рассылки, прерванные перезапуском. Каждый воркер берет рассылки
+    # администраторов своего шарда - туда же придет их /stop_newsletter
+    resumed = await broadcaster.resume(
+        bot, owns=lambda broadcast: shard_for(broadcast.admin_chat_id, WORKERS) == int(WORKER_INDEX or 0)
+    )
+    if resumed:
+        logging.info(f"Resumed {resumed} broadcast(s)")
+    
+    if WORKER_INDEX is not None:
+        # Команды и вебхук настраивает фронтовой процесс workers.py
+        return
+    
     # Устанавливаем команды в меню
     await set_bot_commands(bot)
     
     # Если есть URL для вебхука (продакшен), настраиваем его
     if 'RAILWAY_STATIC_URL' in os.environ:
-        webhook_url = f"{os.environ['RAILWAY_STATIC_URL']}/webhook"
-        await bot.set_webhook(webhook_url)
-        logging.info(f"Webhook set to: {webhook_url}")
+        await register_webhook(bot, os.environ['RAILWAY_STATIC_URL'], get_webhook_secret(TOKEN))
     else:
         # Локальная разработка - polling
         await bot.delete_webhook(drop_pending_updates=True)
@@ -55,37 +94,41 @@ async def on_startup():
 async def on_shutdown():
     """Действия при остановке бота"""
     logging.info("Shutting down...")
+    await stats_rollup_job.stop()
+    await similar_builds_job.stop()
+    # Курсор рассылок сохраняется - после перезапуска они продолжатся
+    await broadcaster.stop()
+    
+    # Фоновые побочные эффекты обработчиков кладут данные в счетчики и очередь
+    # активности - дожидаемся их до того, как те допишутся в БД
+    await deferred_tasks.drain(timeout=float(os.getenv('DEFERRED_DRAIN_TIMEOUT', 10)))
+    
+    # Дописываем в БД накопленные счетчики скачиваний и активность
+    await download_counter.stop()
+    await activity_writer.stop()
     await bot.session.close()
 
-async def main():
+# Запуск и остановка - в жизненном цикле диспетчера: при polling их вызывает
+# start_polling, при вебхуке - aiohttp-приложение (в том же event loop)
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+def main():
     """Основная функция запуска бота"""
-    await on_startup()
-    
     # Проверяем окружение - вебхук или polling
     if 'RAILWAY_STATIC_URL' in os.environ:
         # Продакшен режим - вебхук
-        app = web.Application()
-        webhook_requests_handler = SimpleRequestHandler(
-            dispatcher=dp,
-            bot=bot,
+        app = create_app(
+            dp,
+            bot,
+            secret_token=get_webhook_secret(TOKEN),
+            max_in_flight=int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', 100))
         )
-        webhook_requests_handler.register(app, path="/webhook")
-        setup_application(app, dp, bot=bot)
-        
-        port = int(os.environ.get("PORT", 8000))
-        return app
+        web.run_app(app, port=int(os.environ.get("PORT", 8000)), host='0.0.0.0')
     else:
         # Локальная разработка - polling
-        try:
-            await dp.start_polling(bot)
-        finally:
-            await on_shutdown()
+        asyncio.run(dp.start_polling(bot))
 
 if __name__ == "__main__":
-    if 'RAILWAY_STATIC_URL' in os.environ:
-        # Запуск для Railway
-        app = asyncio.run(main())
-        web.run_app(app, port=int(os.environ.get("PORT", 8000)), host='0.0.0.0')
-    else:
-        # Локальный запуск
-        asyncio.run(main())
\ No newline at end of file
+    main()
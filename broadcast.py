@@ -0,0 +1,313 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramNetworkError
+
+from db.crud import analytics_crud, broadcast_crud
+from db.models import Broadcast
+from outbound import outbound_priority, priority
+
+
+NEWSLETTER_HEADER = "📢 <b>Новость от администратора:</b>\n\n"
+
+
+class TokenBucket:
+    """Общий лимит скорости отправки: rate сообщений в секунду"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
+
+    async def acquire(self):
+        """Дождаться разрешения на одну отправку"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Под блокировкой ожидающие получают токены по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Остановить все отправки (Telegram ответил RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class BroadcastJob:
+    """Состояние одной выполняющейся рассылки"""
+
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self.cursor = broadcast.cursor_user_id
+        self.sent = broadcast.sent
+        self.failed = broadcast.failed
+        self.blocked = broadcast.blocked
+        self.cancelled = False
+        self.started_at = time.monotonic()
+        self.started_processed = self.processed
+
+        # user_id в порядке выдачи воркерам и уже обработанные из них:
+        # курсор двигается только по непрерывному префиксу обработанных
+        self._order = deque()
+        self._done = set()
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def assign(self, user_id: int):
+        self._order.append(user_id)
+
+    def complete(self, user_id: int):
+        self._done.add(user_id)
+        while self._order and self._order[0] in self._done:
+            self.cursor = self._order.popleft()
+            self._done.discard(self.cursor)
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return (self.processed - self.started_processed) / elapsed if elapsed else 0.0
+
+
+class Broadcaster:
+    """Фоновые рассылки: N воркеров под общим лимитом скорости
+
+    Пользователи перебираются по возрастанию user_id, курсор и счетчики
+    периодически сохраняются в таблицу broadcasts. После падения или
+    передеплоя рассылка продолжается с курсора (resume), повторно могут
+    получить сообщение только те, кому оно отправлялось в момент остановки.
+    """
+
+    def __init__(self, workers: int = 8, rate: float = 25, progress_interval: float = 5.0,
+                 max_attempts: int = 5):
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.progress_interval = progress_interval
+        self.max_attempts = max_attempts
+        self._jobs = {}   # broadcast_id -> (BroadcastJob, task)
+
+        self.retry_after_count = 0
+
+    def start(self, bot: Bot, broadcast: Broadcast):
+        """Запустить рассылку в фоне"""
+        job = BroadcastJob(broadcast)
+        # Чистый контекст: рассылка не должна унаследовать сессию апдейта администратора
+        task = asyncio.get_running_loop().create_task(self._run(bot, job), context=contextvars.Context())
+        self._jobs[broadcast.id] = (job, task)
+
+    async def resume(self, bot: Bot, owns=None) -> int:
+        """Продолжить незавершенные рассылки (вызывается при старте бота)
+
+        owns(broadcast) - фильтр рассылок этого процесса, если процессов несколько.
+        """
+        broadcasts = await broadcast_crud.get_running_broadcasts()
+        if owns is not None:
+            broadcasts = [broadcast for broadcast in broadcasts if owns(broadcast)]
+        for broadcast in broadcasts:
+            if broadcast.id not in self._jobs:
+                logging.info(f"Resuming broadcast {broadcast.id} after user {broadcast.cursor_user_id}")
+                self.start(bot, broadcast)
+        return len(broadcasts)
+
+    def cancel(self) -> int:
+        """Отменить все идущие рассылки, вернуть их количество"""
+        for job, _ in self._jobs.values():
+            job.cancelled = True
+        return len(self._jobs)
+
+    async def stop(self):
+        """Остановить рассылки с сохранением курсора (вызывается при остановке бота)"""
+        for _, task in list(self._jobs.values()):
+            task.cancel()
+        for _, task in list(self._jobs.values()):
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._jobs.clear()
+
+    async def _run(self, bot: Bot, job: BroadcastJob):
+        # Контекст задачи свой (см. start) - сообщения рассылки уступают ответам пользователям
+        outbound_priority.set('bulk')
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        tasks = [asyncio.create_task(self._produce(job, queue))]
+        tasks += [asyncio.create_task(self._work(bot, job, queue)) for _ in range(self.workers)]
+        reporter = asyncio.create_task(self._report(bot, job))
+
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # Остановка бота: сохраняем курсор, рассылка останется running и продолжится
+            for task in tasks:
+                task.cancel()
+            await self._checkpoint(job)
+            raise
+        except Exception as e:
+            logging.error(f"Broadcast {job.broadcast.id} failed: {e}")
+            for task in tasks:
+                task.cancel()
+            await self._checkpoint(job)
+            return
+        finally:
+            reporter.cancel()
+            self._jobs.pop(job.broadcast.id, None)
+
+        status = 'cancelled' if job.cancelled else 'done'
+        await self._checkpoint(job, status=status)
+        await self._edit_progress(bot, job, self._final_text(job, status))
+
+    async def _produce(self, job: BroadcastJob, queue: asyncio.Queue):
+        async for user_id in analytics_crud.iter_user_ids(after_user_id=job.cursor):
+            if job.cancelled:
+                break
+            job.assign(user_id)
+            await queue.put(user_id)
+
+        for _ in range(self.workers):
+            await queue.put(None)
+
+    async def _work(self, bot: Bot, job: BroadcastJob, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            if not job.cancelled:
+                await self._send(bot, job, user_id)
+            job.complete(user_id)
+
+    async def _send(self, bot: Bot, job: BroadcastJob, user_id: int):
+        broadcast = job.broadcast
+        for attempt in range(self.max_attempts):
+            await self.bucket.acquire()
+            try:
+                if broadcast.text is not None:
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text=f"{NEWSLETTER_HEADER}{broadcast.text}",
+                        parse_mode="HTML"
+                    )
+                else:
+                    await bot.copy_message(
+                        chat_id=user_id,
+                        from_chat_id=broadcast.from_chat_id,
+                        message_id=broadcast.message_id
+                    )
+                job.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                # Лимит превышен - останавливаем всех воркеров, а не только этого
+                self.retry_after_count += 1
+                self.bucket.pause(e.retry_after)
+            except TelegramNetworkError as e:
+                logging.warning(f"Network error sending to {user_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота - больше не пишем ему
+                job.blocked += 1
+                try:
+                    await analytics_crud.mark_user_blocked(user_id)
+                except Exception as e:
+                    logging.error(f"Error marking user {user_id} as blocked: {e}")
+                return
+            except Exception as e:
+                job.failed += 1
+                logging.warning(f"Не удалось отправить пользователю {user_id}: {e}")
+                return
+
+        job.failed += 1
+        logging.warning(f"Не удалось отправить пользователю {user_id}: попытки исчерпаны")
+
+    async def _report(self, bot: Bot, job: BroadcastJob):
+        """Раз в progress_interval секунд сохранять курсор и обновлять прогресс"""
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._checkpoint(job)
+            await self._edit_progress(bot, job, self._progress_text(job))
+
+    async def _checkpoint(self, job: BroadcastJob, status: str = None):
+        try:
+            await broadcast_crud.save_progress(
+                job.broadcast.id, job.cursor, job.sent, job.failed, job.blocked, status=status
+            )
+        except Exception as e:
+            logging.error(f"Error saving broadcast {job.broadcast.id} progress: {e}")
+
+    async def _edit_progress(self, bot: Bot, job: BroadcastJob, text: str):
+        if job.broadcast.progress_message_id is None:
+            return
+        try:
+            with priority('admin'):
+                await bot.edit_message_text(
+                    chat_id=job.broadcast.admin_chat_id,
+                    message_id=job.broadcast.progress_message_id,
+                    text=text,
+                    parse_mode="HTML"
+                )
+        except Exception as e:
+            # Например, "message is not modified" - прогресс не изменился
+            logging.debug(f"Can't update broadcast progress: {e}")
+
+    @staticmethod
+    def _progress_text(job: BroadcastJob) -> str:
+        total = job.broadcast.total
+        rate = job.rate()
+        left = max(total - job.processed, 0)
+        eta = f"{left / rate / 60:.0f} мин" if rate else "—"
+        return (
+            f"🔄 Рассылка... ({job.processed}/{total})\n"
+            f"✅ Успешно: {job.sent}\n"
+            f"❌ Ошибок: {job.failed}\n"
+            f"🚫 Заблокировали бота: {job.blocked}\n"
+            f"⚡ Скорость: {rate:.1f} сообщ./с, осталось ~{eta}\n\n"
+            f"Остановить: /stop_newsletter"
+        )
+
+    @staticmethod
+    def _final_text(job: BroadcastJob, status: str) -> str:
+        total = job.broadcast.total
+        title = "✅ <b>Рассылка завершена!</b>" if status == 'done' else "🛑 <b>Рассылка остановлена</b>"
+        delivered = (job.sent / total) * 100 if total else 0.0
+        return (
+            f"{title}\n\n"
+            f"📊 Статистика:\n"
+            f"• Всего пользователей: {total}\n"
+            f"• ✅ Успешно: {job.sent}\n"
+            f"• ❌ Ошибок: {job.failed}\n"
+            f"• 🚫 Заблокировали бота: {job.blocked}\n"
+            f"• 📈 Доставлено: {delivered:.1f}%"
+        )
+
+    def stats(self) -> dict:
+        """Состояние рассылок (для админки)"""
+        return {
+            'running': len(self._jobs),
+            'rate_limit': self.bucket.rate,
+            'retry_after': self.retry_after_count
+        }
+
+
+broadcaster = Broadcaster(
+    workers=int(os.getenv('BROADCAST_WORKERS', 8)),
+    rate=float(os.getenv('BROADCAST_RATE', 25)),
+    progress_interval=float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))
+)
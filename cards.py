@@ -0,0 +1,137 @@
+import html
+import re
+from dataclasses import dataclass
+
+from aiogram import types
+
+from db.cache import card_cache
+from db.models import BuildType, BuildStyle, Difficulty
+from keyboards import get_search_results_keyboard
+
+
+# Лимиты Telegram (в символах после разбора HTML-разметки)
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+
+TYPE_DISPLAY = {
+    BuildType.SURVIVAL: "🏕️ Выживание",
+    BuildType.ADVENTURE: "🗺️ Приключение/РПГ",
+    BuildType.HARDCORE: "💀 Хардкор",
+    BuildType.PUZZLE: "🧩 Пазл/Головоломка",
+    BuildType.CREATIVE: "🎨 Творчество",
+    BuildType.MINIGAME: "🎯 Мини-игры"
+}
+
+STYLE_DISPLAY = {
+    BuildStyle.FANTASY: "🧙‍♂️ Фэнтези",
+    BuildStyle.MEDIEVAL: "🏰 Средневековье",
+    BuildStyle.POSTAPOCALYPTIC: "☢️ Постапокалипсис",
+    BuildStyle.SCI_FI: "🚀 Техно/Научная фантастика",
+    BuildStyle.MODERN: "🏙️ Современный мир",
+    BuildStyle.FAIRYTALE: "🌈 Сказочный/Мультяшный"
+}
+
+DIFFICULTY_DISPLAY = {
+    Difficulty.BEGINNER: "🟢 Для новичков",
+    Difficulty.INTERMEDIATE: "🟡 Средняя",
+    Difficulty.EXPERT: "🔴 Для экспертов"
+}
+
+_TAG = re.compile(r"<[^>]+>")
+
+
+@dataclass(frozen=True)
+class BuildCard:
+    """Готовая карточка сборки: текст, клавиатура и способ отправки"""
+    text: str
+    keyboard: types.InlineKeyboardMarkup
+    download_keyboard: types.InlineKeyboardMarkup  # после нажатия "Скачать" - кнопка-ссылка
+    as_photo: bool  # False - подпись не влезает в лимит или нет картинки
+
+
+def plain_text(text: str) -> str:
+    """Текст без HTML-разметки: теги убраны, сущности раскрыты"""
+    return html.unescape(_TAG.sub("", text))
+
+
+def visible_length(text: str) -> int:
+    """Длина текста так, как ее считает Telegram: без тегов, в UTF-16"""
+    return len(plain_text(text).encode("utf-16-le")) // 2
+
+
+def truncate_html(text: str, length: int) -> str:
+    """Обрезать HTML-текст до length видимых символов (UTF-16) и поставить "…"
+
+    Режем текст без разметки и экранируем заново: обрезка исходного HTML
+    могла разорвать тег или сущность, и Telegram не разобрал бы подпись.
+    """
+    encoded = plain_text(text).encode("utf-16-le")[:max(length - 1, 0) * 2]
+    # Половинка суррогатной пары на границе отбрасывается
+    return html.escape(encoded.decode("utf-16-le", errors="ignore"), quote=False) + "…"
+
+
+def format_build_text(build, description: str = None) -> str:
+    """Форматировать текст сборки"""
+    type_display = TYPE_DISPLAY.get(build.build_type, build.build_type.value)
+    style_display = STYLE_DISPLAY.get(build.style, build.style.value)
+    difficulty_display = DIFFICULTY_DISPLAY.get(build.difficulty, build.difficulty.value)
+
+    # Добавляем отображение рейтинга
+    rating_display = f"⭐ {build.rating}/5" if build.rating > 0 else "☆ Еще нет оценок"
+
+    return (
+        f"🎲 <b>{build.name}</b>\n\n"
+        f"{build.description if description is None else description}\n\n"
+        f"🔹 <b>Тип:</b> {type_display}\n"
+        f"🔹 <b>Стиль:</b> {style_display}\n"
+        f"🔹 <b>Сложность:</b> {difficulty_display}\n"
+        f"🔹 <b>Скачиваний:</b> {build.downloads_count}\n"
+        f"🔹 <b>Рейтинг:</b> {rating_display} ({build.votes_count} оценок)\n"
+        f"🔹 <b>ID сборки:</b> {build.id}\n\n"
+    )
+
+
+def _card_version(build) -> tuple:
+    """Все поля, от которых зависит карточка: изменилось любое - карточка устарела"""
+    return (
+        build.name, build.description, build.image_url, build.download_url,
+        build.build_type, build.style, build.difficulty,
+        build.downloads_count, build.rating, build.votes_count
+    )
+
+
+def _render(build) -> BuildCard:
+    text = format_build_text(build)
+    length = visible_length(text)
+
+    if length > MESSAGE_LIMIT:
+        # Даже текстом не влезает - обрезаем описание
+        excess = length - MESSAGE_LIMIT
+        description = truncate_html(build.description, visible_length(build.description) - excess)
+        text = format_build_text(build, description)
+        length = visible_length(text)
+
+    return BuildCard(
+        text=text,
+        keyboard=get_search_results_keyboard(build.id),
+        download_keyboard=get_search_results_keyboard(build.id, download_url=build.download_url),
+        # Подпись длиннее лимита - фото не отправится, сразу шлем текст
+        as_photo=bool(build.image_url) and length <= CAPTION_LIMIT
+    )
+
+
+def get_build_card(build) -> BuildCard:
+    """Карточка сборки из кэша (ключ - ID и версия сборки)
+
+    Храним одну запись на сборку вместе с ее версией: при голосе,
+    скачивании или правке версия меняется и карточка перерисовывается,
+    а устаревшая запись не занимает место в кэше.
+    """
+    version = _card_version(build)
+    cached = card_cache.get(build.id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    card = _render(build)
+    card_cache.set(build.id, (version, card))
+    return card
@@ -7,6 +7,7 @@ async def set_bot_commands(bot: Bot):
         BotCommand(command="start", description="🎮 Начать работу с ботом"),
         BotCommand(command="random_build", description="🎲 Случайная сборка"),
         BotCommand(command="build_filters", description="🔍 Подбор по фильтрам"),
+        BotCommand(command="search", description="🔎 Поиск по названию и описанию"),
     ]
     
     await bot.set_my_commands(commands, scope=BotCommandScopeDefault())
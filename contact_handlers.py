@@ -5,6 +5,7 @@ from aiogram.fsm.state import State, StatesGroup
 
 from config import TOKEN, ADMIN_IDS
 from keyboards import get_main_keyboard, get_contact_cancel_keyboard
+from outbound import priority
 
 
 ADMINS = [ADMIN_IDS]
@@ -65,11 +66,12 @@ async def process_contact_message(message: types.Message, state: FSMContext):
         sent_to_admins = []
         for admin_id in ADMINS:
             try:
-                await message.bot.send_message(
-                    chat_id=admin_id,
-                    text=admin_message,
-                    parse_mode="HTML"
-                )
+                with priority('admin'):
+                    await message.bot.send_message(
+                        chat_id=admin_id,
+                        text=admin_message,
+                        parse_mode="HTML"
+                    )
                 sent_to_admins.append(admin_id)
             except Exception as e:
                 logging.error(f"Error sending message to admin {admin_id}: {e}")
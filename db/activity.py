@@ -0,0 +1,222 @@
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import time
+
+from sqlalchemy import insert, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db.models import UserActivity, User
+from db.session import async_session
+
+
+OVERFLOW_POLICIES = ('block', 'drop', 'sample')
+
+
+class ActivityWriter:
+    """Асинхронная пакетная запись активности пользователей
+
+    Обработчики только кладут запись в ограниченную очередь. Фоновая задача
+    вставляет записи пачками: по batch_size штук или раз в flush_interval
+    секунд. Поведение при переполнении задается overflow_policy:
+      block  - ждать места в очереди;
+      drop   - отбрасывать новые записи;
+      sample - после заполнения очереди на sample_threshold сохранять
+               только долю sample_rate записей, при полной очереди - отбрасывать.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 10000,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        overflow_policy: str = 'drop',
+        sample_rate: float = 0.1,
+        sample_threshold: float = 0.5
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+        self.sample_threshold = sample_threshold
+
+        self._queue = None
+        self._task = None
+
+        # Метрики
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed = 0
+        self.batches = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def log(self, **activity):
+        """Поставить запись активности в очередь"""
+        self._ensure_started()
+        item = (time.monotonic(), activity)
+
+        if self.overflow_policy == 'block':
+            await self._queue.put(item)
+            self.enqueued += 1
+            return
+
+        if (
+            self.overflow_policy == 'sample'
+            and self._queue.qsize() >= self.maxsize * self.sample_threshold
+            and random.random() >= self.sample_rate
+        ):
+            self.sampled_out += 1
+            return
+
+        try:
+            self._queue.put_nowait(item)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        """Запустить фоновую запись в текущем event loop"""
+        if self._task is not None and not self._task.done():
+            return
+
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        # Чистый контекст: задача не должна унаследовать сессию апдейта, в котором стартовала
+        self._task = asyncio.get_running_loop().create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            await self._write(batch)
+            if stop:
+                return
+
+    async def _write(self, batch: list):
+        """Вставить пачку записей одним executemany и обновить users"""
+        activities = [activity for _, activity in batch]
+        try:
+            async with async_session() as session:
+                await session.execute(insert(UserActivity), activities)
+                await upsert_users(session, activities)
+                await session.commit()
+        except Exception as e:
+            self.failed += len(batch)
+            logging.error(f"Error writing {len(batch)} activity rows: {e}")
+            return
+
+        now = time.monotonic()
+        for enqueued_at, _ in batch:
+            latency = now - enqueued_at
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+        self.written += len(batch)
+        self.batches += 1
+
+    async def stop(self):
+        """Дописать очередь в БД и остановить запись (вызывается при остановке бота)"""
+        if self._task is None or self._task.done():
+            return
+
+        # Маркер конца встает в очередь после всех уже поставленных записей
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def stats(self) -> dict:
+        """Метрики очереди"""
+        return {
+            'depth': self._queue.qsize() if self._queue else 0,
+            'maxsize': self.maxsize,
+            'policy': self.overflow_policy,
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'failed': self.failed,
+            'batches': self.batches,
+            'avg_batch': self.written / self.batches if self.batches else 0.0,
+            'avg_latency_ms': self.latency_total / self.written * 1000 if self.written else 0.0,
+            'max_latency_ms': self.latency_max * 1000
+        }
+
+
+async def upsert_users(session, activities: list):
+    """Обновить таблицу users по пачке активности (одна строка на пользователя)"""
+    users = {}
+    for activity in activities:
+        user = users.get(activity['user_id'])
+        if user is None:
+            user = users[activity['user_id']] = {
+                'user_id': activity['user_id'],
+                'username': None,
+                'first_name': None,
+                'last_name': None,
+                'first_seen': activity['timestamp'],
+                'actions_count': 0,
+                'is_blocked': False
+            }
+        user['last_seen'] = activity['timestamp']
+        user['last_action'] = activity['action']
+        user['actions_count'] += 1
+        for field in ('username', 'first_name', 'last_name'):
+            if activity.get(field):
+                user[field] = activity[field]
+
+    dialect = session.get_bind().dialect.name
+    insert_stmt = (postgresql if dialect == 'postgresql' else sqlite).insert(User)
+    excluded = insert_stmt.excluded
+
+    stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={
+            # Имя обновляем только если оно пришло в этой пачке
+            'username': func.coalesce(excluded.username, User.username),
+            'first_name': func.coalesce(excluded.first_name, User.first_name),
+            'last_name': func.coalesce(excluded.last_name, User.last_name),
+            'last_seen': excluded.last_seen,
+            'last_action': excluded.last_action,
+            'actions_count': User.actions_count + excluded.actions_count,
+            # Пользователь снова пишет боту - значит, разблокировал его
+            'is_blocked': False
+        }
+    )
+    await session.execute(stmt, list(users.values()))
+
+
+activity_writer = ActivityWriter(
+    maxsize=int(os.getenv('ACTIVITY_QUEUE_SIZE', 10000)),
+    batch_size=int(os.getenv('ACTIVITY_BATCH_SIZE', 200)),
+    flush_interval=int(os.getenv('ACTIVITY_FLUSH_INTERVAL_MS', 1000)) / 1000,
+    overflow_policy=os.getenv('ACTIVITY_OVERFLOW_POLICY', 'drop'),
+    sample_rate=float(os.getenv('ACTIVITY_SAMPLE_RATE', 0.1))
+)
@@ -0,0 +1,174 @@
+import os
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей"""
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+        # Счетчики для подбора размера кэша
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """Получить значение по ключу (или default, если записи нет/она устарела)"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Сохранить значение, вытесняя самые старые записи при переполнении"""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Удалить одну запись"""
+        if self._data.pop(key, self._MISSING) is not self._MISSING:
+            self.invalidations += 1
+
+    def invalidate_where(self, predicate):
+        """Удалить все записи, ключ которых удовлетворяет условию"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+            self.invalidations += 1
+
+    def clear(self):
+        """Полностью очистить кэш"""
+        self.invalidations += len(self._data)
+        self._data.clear()
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Счетчики попаданий/промахов/вытеснений"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
+
+
+class CacheEvents:
+    """Именованные сбросы кэшей: в этом процессе и в остальных воркерах
+
+    Обработчики регистрирует владелец кэшей (db/crud.py), сброс после
+    коммита вызывает emit: обработчик выполняется здесь, а если задан
+    publisher (воркер workers.py), событие уходит и остальным воркерам,
+    где его выполняет apply. Аргументы событий - JSON-совместимые.
+    """
+
+    def __init__(self):
+        self.handlers = {}     # имя -> обработчик
+        self.publisher = None  # callable(имя, аргументы); None - процесс бота один
+
+        self.emitted = 0
+        self.received = 0
+
+    def register(self, name: str, handler):
+        self.handlers[name] = handler
+
+    def emit(self, name: str, *args):
+        """Сбросить кэши здесь и разослать сброс остальным процессам"""
+        self.handlers[name](*args)
+        self.emitted += 1
+        if self.publisher is not None:
+            self.publisher(name, args)
+
+    def apply(self, name: str, args):
+        """Выполнить сброс, пришедший из другого процесса"""
+        handler = self.handlers.get(name)
+        if handler is not None:
+            self.received += 1
+            handler(*args)
+
+    def stats(self) -> dict:
+        return {'emitted': self.emitted, 'received': self.received}
+
+
+cache_events = CacheEvents()
+
+# Кэш сборок по ID
+build_cache = TTLCache(
+    maxsize=int(os.getenv('BUILD_CACHE_SIZE', 2048)),
+    ttl=float(os.getenv('BUILD_CACHE_TTL', 600))
+)
+
+# Кэш агрегатов каталога (количество сборок, топы)
+catalog_cache = TTLCache(
+    maxsize=int(os.getenv('CATALOG_CACHE_SIZE', 64)),
+    ttl=float(os.getenv('CATALOG_CACHE_TTL', 300))
+)
+
+# Пулы ID для случайного выбора (ключ - корзина фильтров)
+id_pool_cache = TTLCache(
+    maxsize=int(os.getenv('ID_POOL_CACHE_SIZE', 256)),
+    ttl=float(os.getenv('ID_POOL_CACHE_TTL', 900))
+)
+
+# Отрисованные карточки сборок (см. cards.py)
+card_cache = TTLCache(
+    maxsize=int(os.getenv('CARD_CACHE_SIZE', 4096)),
+    ttl=float(os.getenv('CARD_CACHE_TTL', 3600))
+)
+
+# URL изображений, которые Telegram не смог загрузить (чтобы не повторять запрос)
+broken_image_cache = TTLCache(
+    maxsize=int(os.getenv('BROKEN_IMAGE_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('BROKEN_IMAGE_CACHE_TTL', 3600))
+)
+
+# Ответы инлайн-режима (ключ - нормализованный запрос и смещение, см. inline_handlers.py)
+inline_cache = TTLCache(
+    maxsize=int(os.getenv('INLINE_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('INLINE_CACHE_TTL', 60))
+)
+
+
+def get_cache_stats() -> dict:
+    """Статистика всех кэшей (для админки и подбора размеров)"""
+    return {
+        'builds': build_cache.stats(),
+        'catalog': catalog_cache.stats(),
+        'id_pools': id_pool_cache.stats(),
+        'cards': card_cache.stats(),
+        'broken_images': broken_image_cache.stats(),
+        'inline': inline_cache.stats()
+    }
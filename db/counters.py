@@ -0,0 +1,137 @@
+import asyncio
+import contextvars
+import logging
+import os
+from collections import defaultdict
+
+from sqlalchemy import update, case, func
+
+from db.models import Build
+from db.session import async_session
+
+
+class DownloadCounter:
+    """Буфер счетчиков скачиваний с отложенной записью в БД
+
+    Нажатие "Скачать" только увеличивает дельту в памяти. Накопленные
+    дельты сбрасываются одним UPDATE раз в flush_interval секунд или
+    после flush_threshold событий, а также при остановке бота.
+    """
+
+    def __init__(self, flush_interval: float = 2.0, flush_threshold: int = 100):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+
+        self._pending = defaultdict(int)  # build_id -> дельта, еще не отправленная в БД
+        self._in_flight = {}              # дельты, которые сейчас записываются
+        self._events = 0
+        self._lock = None
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+        self.flushes = 0
+        self.flushed_events = 0
+
+    def add(self, build_id: int, delta: int = 1):
+        """Учесть скачивание (без обращения к БД)"""
+        self._ensure_started()
+        self._pending[build_id] += delta
+        self._events += delta
+
+        if self._events >= self.flush_threshold:
+            self._wakeup.set()
+
+    def pending(self, build_id: int) -> int:
+        """Дельта, которой еще нет в БД (для отображения актуального счетчика)"""
+        return self._pending.get(build_id, 0) + self._in_flight.get(build_id, 0)
+
+    async def flush(self) -> int:
+        """Записать накопленные дельты одним UPDATE, вернуть число записанных событий"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not self._pending:
+                return 0
+
+            batch = dict(self._pending)
+            self._pending.clear()
+            self._events = 0
+            self._in_flight = batch
+
+            try:
+                async with async_session() as session:
+                    await session.execute(
+                        update(Build)
+                        .where(Build.id.in_(batch.keys()))
+                        .values(
+                            downloads_count=func.coalesce(Build.downloads_count, 0)
+                            + case(batch, value=Build.id, else_=0)
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                    await session.commit()
+                    # Дельты уже в БД: до закрытия сессии может пройти переключение
+                    # задач, и чтение сборки не должно прибавить их второй раз
+                    self._in_flight = {}
+            except Exception as e:
+                # Возвращаем дельты в буфер - попробуем в следующий раз
+                if self._in_flight is batch:
+                    self._in_flight = {}
+                    for build_id, delta in batch.items():
+                        self._pending[build_id] += delta
+                        self._events += delta
+                logging.error(f"Error flushing download counters: {e}")
+                return 0
+
+            events = sum(batch.values())
+            self.flushes += 1
+            self.flushed_events += events
+            return events
+
+    def _ensure_started(self):
+        """Запустить фоновый сброс в текущем event loop"""
+        if self._task is not None and not self._task.done():
+            return
+
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        # Чистый контекст: задача не должна унаследовать сессию апдейта, в котором стартовала
+        self._task = asyncio.get_running_loop().create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def stop(self):
+        """Остановить фоновый сброс и записать остаток (вызывается при остановке бота)"""
+        if self._task is not None:
+            # Не отменяем задачу, чтобы не оборвать запись посреди UPDATE
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+
+    def stats(self) -> dict:
+        """Состояние буфера"""
+        return {
+            'pending_builds': len(self._pending),
+            'pending_events': sum(self._pending.values()),
+            'flushes': self.flushes,
+            'flushed_events': self.flushed_events
+        }
+
+
+download_counter = DownloadCounter(
+    flush_interval=int(os.getenv('DOWNLOADS_FLUSH_INTERVAL_MS', 2000)) / 1000,
+    flush_threshold=int(os.getenv('DOWNLOADS_FLUSH_THRESHOLD', 100))
+)
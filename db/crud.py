@@ -1,9 +1,35 @@
-from sqlalchemy import select, func, distinct
+import os
+import random
+import re
+from array import array
+from functools import partial
+
+from sqlalchemy import select, update, delete, func, distinct, case, text
 from sqlalchemy.ext.asyncio import AsyncSession
-from db.models import Build, BuildType, BuildStyle, Difficulty, Vote, UserActivity, BuildLike, BuildShowcase
-from db.session import async_session
+from sqlalchemy.orm.attributes import set_committed_value
+from db.models import Build, BuildType, BuildStyle, Difficulty, Vote, UserActivity, User, BuildLike, BuildShowcase, BotStats, Broadcast, SimilarBuild
+from db.session import session_scope, commit, cacheable, after_commit
+from db.cache import build_cache, catalog_cache, id_pool_cache, card_cache, inline_cache, cache_events
+from db.migrations import backfill_rating_aggregates
+from db.counters import download_counter
+from db.activity import activity_writer
+
+from datetime import datetime, date, time, timedelta
+
+
+# Задержка закрытия дня для свертки статистики
+ROLLUP_GRACE = timedelta(minutes=10)
 
-from datetime import datetime, date
+# Полнотекстовый поиск: слова запроса (остальные символы отбрасываются)
+SEARCH_TERM = re.compile(r"\w+")
+MAX_SEARCH_TERMS = 8
+# Больше совпадений - без ранжирования, от новых сборок к старым
+SEARCH_RANK_LIMIT = int(os.getenv('SEARCH_RANK_LIMIT', 1000))
+
+
+def search_terms(query: str) -> list[str]:
+    """Слова поискового запроса в нижнем регистре"""
+    return SEARCH_TERM.findall(query.lower())[:MAX_SEARCH_TERMS]
 
 
 
@@ -22,7 +48,7 @@ class BuildCRUD:
         added_by: int = None
     ) -> Build:
         """Создать новую сборку"""
-        async with async_session() as session:
+        async with session_scope() as session:
             build = Build(
                 name=name,
                 description=description,
@@ -34,18 +60,22 @@ class BuildCRUD:
                 added_by=added_by
             )
             session.add(build)
-            await session.commit()
+            await session.flush()
+            # Полнотекстовый индекс - в той же транзакции, что и сама сборка
+            await BuildCRUD._index_build(session, build)
+            await commit(session)
             await session.refresh(build)
+
+            # Новая сборка меняет количество и может попасть в топ
+            after_commit(session, partial(cache_events.emit, 'catalog'))
+            after_commit(session, partial(cache_events.emit, 'id_pools', *BuildCRUD._pool_attributes(build)))
             return build
     
     @staticmethod
     async def get_random_build() -> Build:
         """Получить случайную сборку"""
-        async with async_session() as session:
-            # Используем limit(1) и first() вместо scalar_one_or_none()
-            stmt = select(Build).where(Build.is_approved == True).order_by(func.random()).limit(1)
-            result = await session.execute(stmt)
-            return result.scalar_one_or_none()  # Теперь это безопасно, т.к. limit(1)
+        builds = await BuildCRUD.get_builds_by_filters(limit=1)
+        return builds[0] if builds else None
     
     @staticmethod
     async def get_builds_by_filters(
@@ -54,8 +84,69 @@ class BuildCRUD:
         difficulty: Difficulty = None,
         limit: int = 10
     ) -> list[Build]:
-        """Получить сборки по фильтрам"""
-        async with async_session() as session:
+        """Получить случайные сборки по фильтрам
+        
+        Вместо ORDER BY random() выбираем случайные ID из закэшированного
+        пула ID корзины фильтров, поэтому стоимость выбора не зависит от
+        размера таблицы, а пропуски в ID не искажают распределение.
+        """
+        pool = await BuildCRUD._get_id_pool(build_type, style, difficulty)
+        if not pool:
+            return []
+        
+        build_ids = random.sample(pool, min(limit, len(pool)))
+        builds = await BuildCRUD.get_builds_by_ids(build_ids)
+        
+        if len(builds) < len(build_ids):
+            # Пул устарел (сборку удалили в другом процессе) - перечитаем его
+            id_pool_cache.invalidate(('builds', build_type, style, difficulty))
+        return builds
+    
+    @staticmethod
+    async def _get_id_pool(
+        build_type: BuildType = None,
+        style: BuildStyle = None,
+        difficulty: Difficulty = None
+    ) -> array:
+        """Получить ID одобренных сборок корзины фильтров (с кэшированием)"""
+        key = ('builds', build_type, style, difficulty)
+        pool = id_pool_cache.get(key)
+        if pool is not None:
+            return pool
+        
+        async with session_scope() as session:
+            stmt = select(Build.id).where(Build.is_approved == True)
+            
+            if build_type:
+                stmt = stmt.where(Build.build_type == build_type)
+            if style:
+                stmt = stmt.where(Build.style == style)
+            if difficulty:
+                stmt = stmt.where(Build.difficulty == difficulty)
+            
+            # По возрастанию ID: discovery.py ищет в пуле бинарным поиском
+            result = await session.execute(stmt.order_by(Build.id))
+            pool = array('q', result.scalars().all())
+            if cacheable(session):
+                id_pool_cache.set(key, pool)
+        return pool
+    
+    @staticmethod
+    async def get_builds_page(
+        build_type: BuildType = None,
+        style: BuildStyle = None,
+        difficulty: Difficulty = None,
+        before_id: int = None,
+        limit: int = 10
+    ) -> list[Build]:
+        """Страница сборок по фильтрам: от новых к старым, после before_id
+        
+        Keyset-пагинация по ID (индекс ix_builds_filters заканчивается на id):
+        следующая страница - WHERE id < последнего показанного, без OFFSET,
+        поэтому стоимость не растет с номером страницы, а добавленные за
+        это время сборки не сдвигают уже показанные.
+        """
+        async with session_scope() as session:
             stmt = select(Build).where(Build.is_approved == True)
             
             if build_type:
@@ -64,112 +155,382 @@ class BuildCRUD:
                 stmt = stmt.where(Build.style == style)
             if difficulty:
                 stmt = stmt.where(Build.difficulty == difficulty)
-                
-            stmt = stmt.order_by(func.random()).limit(limit)
-            result = await session.execute(stmt)
-            return result.scalars().all()
+            if before_id is not None:
+                stmt = stmt.where(Build.id < before_id)
+            
+            result = await session.execute(stmt.order_by(Build.id.desc()).limit(limit))
+            builds = result.scalars().all()
+            for build in builds:
+                # Листание вперед-назад берет сборки уже из кэша
+                BuildCRUD._detach(session, build)
+                if cacheable(session):
+                    build_cache.set(build.id, build)
+        return builds
+    
+    @staticmethod
+    async def search_builds(query: str, offset: int = 0, limit: int = 10, total: int = None) -> list[Build]:
+        """Полнотекстовый поиск по названию и описанию (страница search_build_ids)"""
+        build_ids = await BuildCRUD.search_build_ids(query, offset=offset, limit=limit, total=total)
+        return await BuildCRUD.get_builds_by_ids(build_ids)
+    
+    @staticmethod
+    async def search_build_ids(query: str, offset: int = 0, limit: int = 10, total: int = None) -> list[int]:
+        """ID сборок, найденных полнотекстовым поиском по названию и описанию
+        
+        Каждое слово запроса ищется как префикс ("дракон" найдет "драконы"),
+        должны совпасть все слова. Индекс - FTS5 в SQLite или tsvector + GIN
+        в PostgreSQL (см. миграцию 5). Страницы листаются по числу ID, а не
+        сборок: ID сборки, удаленной после обновления индекса, не сдвигает
+        следующие страницы.
+        
+        Если совпадений не больше SEARCH_RANK_LIMIT, порядок - по
+        релевантности (совпадение в названии весит больше, чем в описании).
+        Для слишком общих запросов ранжирование стоило бы оценки каждого
+        совпадения, поэтому они отдаются от новых сборок к старым прямо по
+        индексу. total - уже известное число совпадений (count_search_results),
+        чтобы не считать их заново для каждой страницы.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        
+        async with session_scope() as session:
+            if total is None:
+                total = await BuildCRUD._count_matches(session, terms)
+            ranked = total <= SEARCH_RANK_LIMIT
+            if session.get_bind().dialect.name == 'postgresql':
+                order = "ts_rank_cd(search_vector, query) DESC, id" if ranked else "id DESC"
+                stmt = text(
+                    "SELECT id FROM builds, to_tsquery('russian', :query) AS query "
+                    f"WHERE search_vector @@ query AND is_approved ORDER BY {order} "
+                    "LIMIT :limit OFFSET :offset"
+                )
+            else:
+                # bm25 в SQLite отрицательный: чем меньше, тем релевантнее. Вес названия - 10
+                order = "bm25(builds_fts, 10.0, 1.0), rowid" if ranked else "rowid DESC"
+                stmt = text(
+                    "SELECT rowid FROM builds_fts WHERE builds_fts MATCH :query "
+                    f"ORDER BY {order} LIMIT :limit OFFSET :offset"
+                )
+            result = await session.execute(stmt, {
+                'query': BuildCRUD._match_query(session, terms), 'limit': limit, 'offset': offset
+            })
+            return list(result.scalars().all())
+    
+    @staticmethod
+    async def count_search_results(query: str) -> int:
+        """Сколько сборок находит запрос"""
+        terms = search_terms(query)
+        if not terms:
+            return 0
+        
+        async with session_scope() as session:
+            return await BuildCRUD._count_matches(session, terms)
+    
+    @staticmethod
+    async def _count_matches(session: AsyncSession, terms: list[str]) -> int:
+        if session.get_bind().dialect.name == 'postgresql':
+            stmt = text(
+                "SELECT COUNT(*) FROM builds "
+                "WHERE search_vector @@ to_tsquery('russian', :query) AND is_approved"
+            )
+        else:
+            stmt = text("SELECT COUNT(*) FROM builds_fts WHERE builds_fts MATCH :query")
+        result = await session.execute(stmt, {'query': BuildCRUD._match_query(session, terms)})
+        return result.scalar()
+    
+    @staticmethod
+    def _match_query(session: AsyncSession, terms: list[str]) -> str:
+        """Запрос к индексу: все слова, каждое как префикс (слова - только \\w+)"""
+        if session.get_bind().dialect.name == 'postgresql':
+            return " & ".join(f"{term}:*" for term in terms)
+        return " ".join(f'"{term}"*' for term in terms)
+    
+    @staticmethod
+    async def _index_build(session: AsyncSession, build: Build, delete: bool = False):
+        """Добавить сборку в полнотекстовый индекс SQLite или убрать из него
+        
+        В индексе только одобренные сборки - поиску не нужен JOIN с builds.
+        В PostgreSQL индекс строится по вычисляемой колонке и обновляется сам.
+        """
+        if not build.is_approved or session.get_bind().dialect.name == 'postgresql':
+            return
+        # FTS5 с внешним содержимым удаляет запись по старым значениям колонок
+        columns = "builds_fts, rowid, name, description" if delete else "rowid, name, description"
+        values = "'delete', :id, :name, :description" if delete else ":id, :name, :description"
+        await session.execute(
+            text(f"INSERT INTO builds_fts({columns}) VALUES ({values})"),
+            {'id': build.id, 'name': build.name, 'description': build.description},
+            bind_arguments={'for_write': True}
+        )
+    
+    @staticmethod
+    async def count_builds_by_filters(
+        build_type: BuildType = None,
+        style: BuildStyle = None,
+        difficulty: Difficulty = None
+    ) -> int:
+        """Количество сборок в корзине фильтров (по закэшированному пулу ID)"""
+        return len(await BuildCRUD._get_id_pool(build_type, style, difficulty))
+    
+    @staticmethod
+    async def get_id_pool(
+        build_type: BuildType = None,
+        style: BuildStyle = None,
+        difficulty: Difficulty = None
+    ) -> array:
+        """ID одобренных сборок корзины фильтров по возрастанию (общий закэшированный пул - не изменять)"""
+        return await BuildCRUD._get_id_pool(build_type, style, difficulty)
+    
+    @staticmethod
+    async def warm_id_pool(
+        build_type: BuildType = None,
+        style: BuildStyle = None,
+        difficulty: Difficulty = None
+    ):
+        """Загрузить пул ID корзины фильтров в кэш заранее (фоновый прогрев)"""
+        await BuildCRUD._get_id_pool(build_type, style, difficulty)
+    
+    @staticmethod
+    def _pool_attributes(build: Build) -> tuple:
+        """Тип, стиль и сложность сборки для события 'id_pools' (значения enum - для JSON)"""
+        return build.build_type.value, build.style.value, build.difficulty.value
+    
+    @staticmethod
+    def _invalidate_id_pools(build_type: str, style: str, difficulty: str):
+        """Сбросить пулы ID всех корзин фильтров, в которые входит сборка"""
+        build_type, style, difficulty = BuildType(build_type), BuildStyle(style), Difficulty(difficulty)
+        id_pool_cache.invalidate_where(
+            lambda key: key[0] == 'builds'
+            and key[1] in (None, build_type)
+            and key[2] in (None, style)
+            and key[3] in (None, difficulty)
+        )
+    
+    @staticmethod
+    async def get_builds_by_ids(build_ids: list[int]) -> list[Build]:
+        """Получить сборки по списку ID (в том же порядке, с кэшированием)"""
+        builds = {}
+        missing_ids = []
+        for build_id in build_ids:
+            build = build_cache.get(build_id)
+            if build is not None:
+                builds[build_id] = build
+            else:
+                missing_ids.append(build_id)
+        
+        if missing_ids:
+            async with session_scope() as session:
+                stmt = select(Build).where(Build.id.in_(missing_ids))
+                result = await session.execute(stmt)
+                for build in result.scalars().all():
+                    BuildCRUD._detach(session, build)
+                    if cacheable(session):
+                        build_cache.set(build.id, build)
+                    builds[build.id] = build
+        
+        return [builds[build_id] for build_id in build_ids if build_id in builds]
+    
+    @staticmethod
+    async def get_similar_builds(build_id: int, limit: int = 5) -> list[Build]:
+        """Похожие сборки по таблице similar_builds (ее заполняет db/similar.py)"""
+        async with session_scope() as session:
+            stmt = (
+                select(SimilarBuild.similar_id)
+                .where(SimilarBuild.build_id == build_id)
+                .order_by(SimilarBuild.rank)
+                .limit(limit)
+            )
+            similar_ids = (await session.execute(stmt)).scalars().all()
+        
+        # Соседа могли удалить или снять с модерации после пересчета
+        return [build for build in await BuildCRUD.get_builds_by_ids(similar_ids) if build.is_approved]
     
     @staticmethod
     async def get_build_by_id(build_id: int) -> Build:
-        """Получить сборку по ID"""
-        async with async_session() as session:
+        """Получить сборку по ID (с кэшированием)"""
+        build = build_cache.get(build_id)
+        if build is not None:
+            return build
+
+        async with session_scope() as session:
             stmt = select(Build).where(Build.id == build_id)
             result = await session.execute(stmt)
-            return result.scalar_one_or_none()
+            build = result.scalar_one_or_none()
+
+            if build is not None:
+                BuildCRUD._detach(session, build)
+                if cacheable(session):
+                    build_cache.set(build_id, build)
+        return build
+    
+    @staticmethod
+    def _detach(session: AsyncSession, build: Build):
+        """Подготовить загруженную сборку к кэшированию
+        
+        Закэшированный объект разделяют разные апдейты, поэтому отвязываем
+        его от сессии апдейта и добавляем к счетчику из БД еще не
+        записанные скачивания.
+        """
+        session.expunge(build)
+        set_committed_value(
+            build, 'downloads_count',
+            (build.downloads_count or 0) + download_counter.pending(build.id)
+        )
     
     @staticmethod
     async def increment_downloads(build_id: int) -> Build:
-        """Увеличить счетчик скачиваний и вернуть обновленную сборку"""
-        async with async_session() as session:
-            # Получаем сборку с блокировкой для обновления
-            stmt = select(Build).where(Build.id == build_id)
-            result = await session.execute(stmt)
-            build = result.scalar_one_or_none()
-            
-            if build:
-                build.downloads_count += 1
-                await session.commit()
-                await session.refresh(build)  # Обновляем объект
-                return build
+        """Увеличить счетчик скачиваний и вернуть обновленную сборку
+        
+        Запись в БД отложена (см. db/counters.py): счетчик в закэшированной
+        сборке всегда равен значению в БД плюс еще не записанная дельта.
+        """
+        build = await BuildCRUD.get_build_by_id(build_id)
+        if not build:
             return None
+        
+        download_counter.add(build_id)
+        set_committed_value(build, 'downloads_count', build.downloads_count + 1)
+        BuildCRUD._invalidate_top()
+        return build
     
+    @staticmethod
+    async def set_image_file_id(build_id: int, file_id: str, image_url: str):
+        """Запомнить file_id фото, загруженного Telegram из image_url"""
+        async with session_scope() as session:
+            # Если URL успели поменять, file_id относится к старой картинке
+            await session.execute(
+                update(Build)
+                .where(Build.id == build_id, Build.image_url == image_url)
+                .values(image_file_id=file_id, image_file_url=image_url)
+                .execution_options(synchronize_session=False)
+            )
+            await commit(session)
+
+        cached = build_cache.get(build_id)
+        if cached is not None and cached.image_url == image_url:
+            set_committed_value(cached, 'image_file_id', file_id)
+            set_committed_value(cached, 'image_file_url', image_url)
+
     @staticmethod
     async def get_top_builds(limit: int = 10) -> list[Build]:
-        """Получить топ сборок по скачиваниям"""
-        async with async_session() as session:
+        """Получить топ сборок по скачиваниям (с кэшированием)"""
+        key = ('top', limit)
+        top_builds = catalog_cache.get(key)
+        if top_builds is not None:
+            return top_builds
+
+        async with session_scope() as session:
             stmt = select(Build).where(Build.is_approved == True).order_by(Build.downloads_count.desc()).limit(limit)
             result = await session.execute(stmt)
-            return result.scalars().all()
+            top_builds = result.scalars().all()
+
+            for build in top_builds:
+                BuildCRUD._detach(session, build)
+            if cacheable(session):
+                catalog_cache.set(key, top_builds)
+        return top_builds
     
     @staticmethod
     async def get_builds_count() -> int:
-        """Получить общее количество сборок"""
-        async with async_session() as session:
+        """Получить общее количество сборок (с кэшированием)"""
+        key = ('count',)
+        builds_count = catalog_cache.get(key)
+        if builds_count is not None:
+            return builds_count
+
+        async with session_scope() as session:
             stmt = select(func.count(Build.id)).where(Build.is_approved == True)
             result = await session.execute(stmt)
-            return result.scalar()
+            builds_count = result.scalar()
+            if cacheable(session):
+                catalog_cache.set(key, builds_count)
+        return builds_count
+
+    @staticmethod
+    def _invalidate_build(build_id: int):
+        """Сбросить сборку и ее карточку"""
+        build_cache.invalidate(build_id)
+        card_cache.invalidate(build_id)
+
+    @staticmethod
+    def _invalidate_top():
+        """Сбросить закэшированные топы сборок"""
+        catalog_cache.invalidate_where(lambda key: key[0] == 'top')
+
+    @staticmethod
+    def _invalidate_catalog():
+        """Сбросить количество сборок, топы и ответы инлайн-режима"""
+        catalog_cache.invalidate(('count',))
+        BuildCRUD._invalidate_top()
+        inline_cache.clear()
 
     @staticmethod
     async def add_vote(build_id: int, user_id: int, rating: int) -> dict:
-        """Добавить оценку сборке"""
-        async with async_session() as session:
+        """Добавить оценку сборке
+        
+        Сумма оценок, их количество и гистограмма по звездам обновляются
+        одним UPDATE в той же транзакции, что и вставка голоса, поэтому
+        стоимость не зависит от числа уже поставленных оценок.
+        """
+        async with session_scope() as session:
             # Проверяем, не голосовал ли уже пользователь
             existing_vote = await session.execute(
-                select(Vote).where(
+                select(Vote.id).where(
                     Vote.build_id == build_id, 
                     Vote.user_id == user_id
                 )
             )
-            existing_vote = existing_vote.scalar_one_or_none()
-            
-            if existing_vote:
+            if existing_vote.first():
                 return {'success': False, 'error': 'already_voted'}
             
-            # Проверяем существование сборки
-            build_stmt = select(Build).where(Build.id == build_id)
-            build_result = await session.execute(build_stmt)
-            build = build_result.scalar_one_or_none()
+            new_sum = Build.rating_sum + rating
+            new_count = Build.votes_count + 1
+            star_column = getattr(Build, f'rating_{rating}')
+            
+            # Обновляем агрегаты (старые значения в SET одинаково трактуют SQLite и PostgreSQL).
+            # Средний рейтинг округляется половиной вверх: (2 * sum + n) / (2 * n)
+            stmt = (
+                update(Build)
+                .where(Build.id == build_id)
+                .values({
+                    Build.rating_sum: new_sum,
+                    Build.votes_count: new_count,
+                    star_column: star_column + 1,
+                    Build.rating: (2 * new_sum + new_count) // (2 * new_count)
+                })
+                .returning(Build.rating, Build.rating_sum, Build.votes_count)
+                .execution_options(synchronize_session=False)
+            )
+            row = (await session.execute(stmt)).first()
             
-            if not build:
+            # Сборки нет - UPDATE ничего не затронул
+            if row is None:
                 return {'success': False, 'error': 'build_not_found'}
             
-            # Создаем новую оценку
-            vote = Vote(
+            session.add(Vote(
                 build_id=build_id,
                 user_id=user_id,
                 rating=rating
-            )
-            session.add(vote)
-            
-            # Пересчитываем средний рейтинг
-            all_votes_stmt = select(Vote.rating).where(Vote.build_id == build_id)
-            all_votes_result = await session.execute(all_votes_stmt)
-            all_ratings = [v[0] for v in all_votes_result.all()]
-            
-            # Включая новую оценку
-            all_ratings.append(rating)
-            
-            # Правильно рассчитываем средний рейтинг
-            average_rating = sum(all_ratings) / len(all_ratings)
-            
-            # Обновляем статистику сборки
-            build.votes_count = len(all_ratings)
-            build.rating = round(average_rating)  # Округляем до целого
-            
-            await session.commit()
-            await session.refresh(build)  # Обновляем объект
+            ))
+            await commit(session)
+
+            # Рейтинг виден в карточке и в топах
+            after_commit(session, partial(cache_events.emit, 'build', build_id))
+            after_commit(session, partial(cache_events.emit, 'top'))
             
+            new_rating, rating_sum, votes_count = row
             return {
                 'success': True, 
-                'new_rating': build.rating, 
-                'votes_count': build.votes_count,
-                'average_rating': average_rating  # Для отладки
+                'new_rating': new_rating, 
+                'votes_count': votes_count,
+                'average_rating': rating_sum / votes_count
             }
     
     @staticmethod
     async def get_user_vote(build_id: int, user_id: int) -> Vote:
         """Получить оценку пользователя для сборки"""
-        async with async_session() as session:
+        async with session_scope() as session:
             stmt = select(Vote).where(
                 Vote.build_id == build_id,
                 Vote.user_id == user_id
@@ -179,58 +540,37 @@ class BuildCRUD:
     
     @staticmethod
     async def recalculate_all_ratings():
-        """Пересчитать рейтинги для всех сборок (для исправления данных)"""
-        async with async_session() as session:
-            # Получаем все сборки
-            builds_stmt = select(Build)
-            builds_result = await session.execute(builds_stmt)
-            builds = builds_result.scalars().all()
-            
-            updated_count = 0
-            for build in builds:
-                # Получаем все оценки для сборки
-                votes_stmt = select(Vote.rating).where(Vote.build_id == build.id)
-                votes_result = await session.execute(votes_stmt)
-                ratings = [v[0] for v in votes_result.all()]
-                
-                if ratings:
-                    average_rating = sum(ratings) / len(ratings)
-                    build.votes_count = len(ratings)
-                    build.rating = round(average_rating)
-                    updated_count += 1
-                else:
-                    build.votes_count = 0
-                    build.rating = 0
-            
-            await session.commit()
+        """Пересчитать агрегаты рейтингов всех сборок из голосов (для исправления данных)"""
+        async with session_scope() as session:
+            connection = await session.connection(bind_arguments={"for_write": True})
+            updated_count = await connection.run_sync(backfill_rating_aggregates)
+            await commit(session)
+
+            after_commit(session, partial(cache_events.emit, 'builds'))
+            after_commit(session, partial(cache_events.emit, 'top'))
             return updated_count
     
     @staticmethod
     async def get_build_rating_stats(build_id: int) -> dict:
-        """Получить статистику рейтинга сборки"""
-        async with async_session() as session:
-            build = await BuildCRUD.get_build_by_id(build_id)
-            if not build:
-                return None
-            
-            # Получаем распределение оценок
-            stmt = select(Vote.rating, func.count(Vote.id)).where(
-                Vote.build_id == build_id
-            ).group_by(Vote.rating)
-            
-            result = await session.execute(stmt)
-            rating_distribution = {row[0]: row[1] for row in result.all()}
-            
-            return {
-                'average_rating': build.rating,
-                'votes_count': build.votes_count,
-                'distribution': rating_distribution
-            }
+        """Получить статистику рейтинга сборки (из хранимых агрегатов)"""
+        build = await BuildCRUD.get_build_by_id(build_id)
+        if not build:
+            return None
+        
+        rating_distribution = {
+            star: count for star, count in build.rating_distribution.items() if count
+        }
+        
+        return {
+            'average_rating': build.rating,
+            'votes_count': build.votes_count,
+            'distribution': rating_distribution
+        }
         
     @staticmethod
     async def delete_build(build_id: int) -> bool:
         """Удалить сборку по ID"""
-        async with async_session() as session:
+        async with session_scope() as session:
             # Находим сборку
             stmt = select(Build).where(Build.id == build_id)
             result = await session.execute(stmt)
@@ -239,9 +579,15 @@ class BuildCRUD:
             if not build:
                 return False
             
+            await BuildCRUD._index_build(session, build, delete=True)
+            await session.execute(delete(SimilarBuild).where(SimilarBuild.build_id == build_id))
             # Удаляем сборку (каскадно удалятся и голоса благодаря relationship)
             await session.delete(build)
-            await session.commit()
+            await commit(session)
+
+            after_commit(session, partial(cache_events.emit, 'build', build_id))
+            after_commit(session, partial(cache_events.emit, 'catalog'))
+            after_commit(session, partial(cache_events.emit, 'id_pools', *BuildCRUD._pool_attributes(build)))
             return True
     
 
@@ -256,87 +602,133 @@ class AnalyticsCRUD:
         last_name: str = None,
         details: str = None
     ):
-        """Логирование активности пользователя"""
-        async with async_session() as session:
-            activity = UserActivity(
-                user_id=user_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                action=action,
-                details=details
-            )
-            session.add(activity)
-            await session.commit()
+        """Логирование активности пользователя
+        
+        Запись только ставится в очередь - вставка в БД идет пачками
+        в фоне (см. db/activity.py), обработчик не ждет коммита.
+        """
+        await activity_writer.log(
+            user_id=user_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            action=action,
+            details=details,
+            timestamp=datetime.utcnow()
+        )
+    
+    @staticmethod
+    async def _compute_day_stats(session: AsyncSession, day: date) -> dict:
+        """Посчитать статистику за день одним проходом по индексу timestamp"""
+        day_start = datetime.combine(day, time.min)
+        stmt = select(
+            func.count(distinct(case((UserActivity.action == 'start', UserActivity.user_id)))),
+            func.count(distinct(UserActivity.user_id)),
+            func.count(UserActivity.id)
+        ).where(
+            UserActivity.timestamp >= day_start,
+            UserActivity.timestamp < day_start + timedelta(days=1)
+        )
+        new_users, active_users, total_actions = (await session.execute(stmt)).one()
+        
+        return {
+            'date': day,
+            'new_users': new_users or 0,
+            'active_users': active_users or 0,
+            'total_actions': total_actions or 0
+        }
+    
+    @staticmethod
+    async def rollup_daily_stats() -> int:
+        """Свернуть активность закрытых дней в bot_stats, начиная с последнего свернутого дня
+        
+        День считается закрытым через ROLLUP_GRACE после полуночи (UTC),
+        чтобы успели записаться отложенные записи очереди активности.
+        Возвращает количество добавленных дней.
+        """
+        last_closed_day = (datetime.utcnow() - ROLLUP_GRACE).date() - timedelta(days=1)
+        
+        async with session_scope() as session:
+            high_water_mark = (await session.execute(select(func.max(BotStats.date)))).scalar()
+            
+            if high_water_mark is not None:
+                day = high_water_mark + timedelta(days=1)
+            else:
+                first_activity = (await session.execute(select(func.min(UserActivity.timestamp)))).scalar()
+                if first_activity is None:
+                    return 0
+                day = first_activity.date()
+            
+            rolled_up = 0
+            while day <= last_closed_day:
+                stats = await AnalyticsCRUD._compute_day_stats(session, day)
+                session.add(BotStats(**stats))
+                rolled_up += 1
+                day += timedelta(days=1)
+            
+            await commit(session)
+            return rolled_up
     
     @staticmethod
     async def get_daily_stats(date: date = None) -> dict:
-        """Получить статистику за день"""
+        """Получить статистику за день
+        
+        Закрытые дни читаются из свертки bot_stats, по текущему дню
+        считается только частичная статистика.
+        """
         if date is None:
             date = datetime.utcnow().date()
             
-        async with async_session() as session:
-            # Новые пользователи за день
-            new_users_stmt = select(func.count(distinct(UserActivity.user_id))).where(
-                func.date(UserActivity.timestamp) == date,
-                UserActivity.action == 'start'
-            )
-            new_users = await session.execute(new_users_stmt)
-            new_users_count = new_users.scalar() or 0
+        async with session_scope() as session:
+            rollup = (await session.execute(
+                select(BotStats).where(BotStats.date == date)
+            )).scalar_one_or_none()
             
-            # Активные пользователи за день
-            active_users_stmt = select(func.count(distinct(UserActivity.user_id))).where(
-                func.date(UserActivity.timestamp) == date
-            )
-            active_users = await session.execute(active_users_stmt)
-            active_users_count = active_users.scalar() or 0
-            
-            # Всего действий за день
-            total_actions_stmt = select(func.count(UserActivity.id)).where(
-                func.date(UserActivity.timestamp) == date
-            )
-            total_actions = await session.execute(total_actions_stmt)
-            total_actions_count = total_actions.scalar() or 0
+            if rollup is not None:
+                return {
+                    'date': rollup.date,
+                    'new_users': rollup.new_users,
+                    'active_users': rollup.active_users,
+                    'total_actions': rollup.total_actions
+                }
             
-            return {
-                'date': date,
-                'new_users': new_users_count,
-                'active_users': active_users_count,
-                'total_actions': total_actions_count
-            }
+            return await AnalyticsCRUD._compute_day_stats(session, date)
     
     @staticmethod
     async def get_user_stats(user_id: int) -> dict:
-        """Получить статистику по конкретному пользователю"""
-        async with async_session() as session:
-            # Первое и последнее действие
-            first_action_stmt = select(UserActivity).where(
-                UserActivity.user_id == user_id
-            ).order_by(UserActivity.timestamp.asc()).limit(1)
-            
-            last_action_stmt = select(UserActivity).where(
-                UserActivity.user_id == user_id
-            ).order_by(UserActivity.timestamp.desc()).limit(1)
-            
-            first_action = await session.execute(first_action_stmt)
-            last_action = await session.execute(last_action_stmt)
-            
-            # Количество действий
-            actions_count_stmt = select(func.count(UserActivity.id)).where(
-                UserActivity.user_id == user_id
-            )
-            actions_count = await session.execute(actions_count_stmt)
+        """Получить статистику по конкретному пользователю (из таблицы users)"""
+        async with session_scope() as session:
+            user = await session.get(User, user_id)
+            
+            if user is None:
+                return {
+                    'first_seen': None,
+                    'last_seen': None,
+                    'last_action': None,
+                    'total_actions': 0
+                }
             
             return {
-                'first_seen': first_action.scalar_one_or_none(),
-                'last_seen': last_action.scalar_one_or_none(),
-                'total_actions': actions_count.scalar() or 0
+                'first_seen': user.first_seen,
+                'last_seen': user.last_seen,
+                'last_action': user.last_action,
+                'total_actions': user.actions_count,
+                'username': user.username,
+                'is_blocked': user.is_blocked
             }
     
+    @staticmethod
+    async def get_user_id_by_username(username: str) -> int:
+        """Найти ID пользователя по username (без @)"""
+        async with session_scope() as session:
+            stmt = select(User.user_id).where(User.username == username).limit(1)
+            result = await session.execute(stmt)
+            return result.scalar_one_or_none()
+    
     @staticmethod
     async def get_top_actions(limit: int = 10) -> list:
         """Самые популярные действия"""
-        async with async_session() as session:
+        async with session_scope() as session:
             stmt = select(
                 UserActivity.action,
                 func.count(UserActivity.id).label('count')
@@ -347,89 +739,170 @@ class AnalyticsCRUD:
     
     @staticmethod
     async def get_total_users() -> int:
-        """Общее количество уникальных пользователей"""
-        async with async_session() as session:
-            stmt = select(func.count(distinct(UserActivity.user_id)))
+        """Общее количество пользователей"""
+        async with session_scope() as session:
+            stmt = select(func.count(User.user_id))
             result = await session.execute(stmt)
             return result.scalar() or 0
     
     @staticmethod
-    async def get_unique_users_from_activity() -> list:
-        """Получить список уникальных пользователей из таблицы активности"""
-        async with async_session() as session:
-            stmt = select(
-                UserActivity.user_id,
-                UserActivity.username,
-                UserActivity.first_name,
-                UserActivity.last_name
-            ).distinct(UserActivity.user_id)
-            
+    async def get_reachable_users_count() -> int:
+        """Количество пользователей, не заблокировавших бота"""
+        async with session_scope() as session:
+            stmt = select(func.count(User.user_id)).where(User.is_blocked == False)
             result = await session.execute(stmt)
-            return result.all()
+            return result.scalar() or 0
     
     @staticmethod
-    async def get_unique_users():
-        """Получить список уникальных user_id из user_activity"""
-        async with async_session() as session:
-            # Получаем все уникальные user_id из таблицы активности
-            stmt = select(distinct(UserActivity.user_id))
-            result = await session.execute(stmt)
-            user_ids = [row[0] for row in result.all()]
-            return user_ids
+    async def iter_user_ids(batch_size: int = 1000, after_user_id: int = 0):
+        """Перебрать ID пользователей, не заблокировавших бота, порциями по возрастанию ID
+        
+        Keyset-пагинация по первичному ключу: в памяти одновременно
+        только одна порция, можно продолжить с after_user_id.
+        """
+        while True:
+            async with session_scope() as session:
+                stmt = select(User.user_id).where(
+                    User.user_id > after_user_id,
+                    User.is_blocked == False
+                ).order_by(User.user_id).limit(batch_size)
+                result = await session.execute(stmt)
+                user_ids = result.scalars().all()
+            
+            if not user_ids:
+                return
+            
+            for user_id in user_ids:
+                yield user_id
+            after_user_id = user_ids[-1]
+    
+    @staticmethod
+    async def mark_user_blocked(user_id: int):
+        """Отметить, что пользователь заблокировал бота"""
+        async with session_scope() as session:
+            await session.execute(
+                update(User).where(User.user_id == user_id).values(is_blocked=True)
+            )
+            await commit(session)
 
 
 class ShowcaseCRUD:
+    # Лайки, уже засчитанные пользователю, но еще не записанные в БД
+    _pending_likes = set()
+    
     @staticmethod
     async def add_build_showcase(user_id: int, image_url: str, description: str = None):
         """Добавить постройку в showcase"""
-        async with async_session() as session:
+        async with session_scope() as session:
             build = BuildShowcase(
                 user_id=user_id,
                 image_url=image_url,
                 description=description
             )
             session.add(build)
-            await session.commit()
+            await commit(session)
+
+            after_commit(session, partial(cache_events.emit, 'showcases'))
             return build
     
+    @staticmethod
+    async def set_image_file_id(showcase_id: int, file_id: str, image_url: str):
+        """Запомнить file_id фото постройки, загруженного Telegram из image_url"""
+        async with session_scope() as session:
+            await session.execute(
+                update(BuildShowcase)
+                .where(BuildShowcase.id == showcase_id, BuildShowcase.image_url == image_url)
+                .values(image_file_id=file_id, image_file_url=image_url)
+                .execution_options(synchronize_session=False)
+            )
+            await commit(session)
+
     @staticmethod
     async def get_random_showcase():
-        """Получить случайную постройку"""
-        async with async_session() as session:
-            stmt = select(BuildShowcase).order_by(func.random()).limit(1)
-            result = await session.execute(stmt)
-            return result.scalar_one_or_none()
+        """Получить случайную постройку (без ORDER BY random())"""
+        pool = id_pool_cache.get(('showcases',))
+        if pool is None:
+            async with session_scope() as session:
+                result = await session.execute(select(BuildShowcase.id))
+                pool = array('q', result.scalars().all())
+                if cacheable(session):
+                    id_pool_cache.set(('showcases',), pool)
+        
+        if not pool:
+            return None
+        
+        async with session_scope() as session:
+            build = await session.get(BuildShowcase, random.choice(pool))
+        
+        if build is None:
+            # Постройку удалили в другом процессе - перечитаем пул в следующий раз
+            id_pool_cache.invalidate(('showcases',))
+        return build
+    
+    @staticmethod
+    async def reserve_like(build_id: int, user_id: int) -> bool:
+        """Засчитать лайк до записи в БД, False - пользователь уже лайкал
+        
+        Запись делает like_build (обработчик запускает ее в фоне). Пока она
+        не закончилась, повторное нажатие тоже отклоняется - без этого два
+        быстрых нажатия прошли бы проверку оба.
+        """
+        key = (build_id, user_id)
+        if key in ShowcaseCRUD._pending_likes:
+            return False
+        ShowcaseCRUD._pending_likes.add(key)
+        
+        try:
+            async with session_scope() as session:
+                existing = await session.execute(
+                    select(BuildLike.id).where(
+                        BuildLike.build_id == build_id,
+                        BuildLike.user_id == user_id
+                    )
+                )
+                liked = existing.first() is not None
+        except Exception:
+            # Иначе ключ остался бы навсегда и лайк больше не засчитался бы
+            ShowcaseCRUD._pending_likes.discard(key)
+            raise
+        if liked:
+            ShowcaseCRUD._pending_likes.discard(key)
+            return False
+        return True
     
     @staticmethod
     async def like_build(build_id: int, user_id: int):
         """Поставить лайк постройке"""
-        async with async_session() as session:
-            # Проверяем не лайкал ли уже
-            existing = await session.execute(
-                select(BuildLike).where(
-                    BuildLike.build_id == build_id,
-                    BuildLike.user_id == user_id
+        try:
+            async with session_scope() as session:
+                # Проверяем не лайкал ли уже
+                existing = await session.execute(
+                    select(BuildLike).where(
+                        BuildLike.build_id == build_id,
+                        BuildLike.user_id == user_id
+                    )
                 )
-            )
-            if existing.scalar_one_or_none():
-                return False
-            
-            # Добавляем лайк
-            like = BuildLike(build_id=build_id, user_id=user_id)
-            session.add(like)
-            
-            # Обновляем счетчик
-            build = await session.get(BuildShowcase, build_id)
-            if build:
-                build.likes_count += 1
-            
-            await session.commit()
-            return True
+                if existing.scalar_one_or_none():
+                    return False
+                
+                # Добавляем лайк
+                like = BuildLike(build_id=build_id, user_id=user_id)
+                session.add(like)
+                
+                # Обновляем счетчик
+                build = await session.get(BuildShowcase, build_id)
+                if build:
+                    build.likes_count += 1
+                
+                await commit(session)
+                return True
+        finally:
+            ShowcaseCRUD._pending_likes.discard((build_id, user_id))
 
     @staticmethod
     async def get_all_showcases():
         """Получить все постройки для админки"""
-        async with async_session() as session:
+        async with session_scope() as session:
             stmt = select(BuildShowcase).order_by(BuildShowcase.id.desc())
             result = await session.execute(stmt)
             return result.scalars().all()
@@ -437,15 +910,85 @@ class ShowcaseCRUD:
     @staticmethod
     async def delete_showcase(build_id: int):
         """Удалить постройку"""
-        async with async_session() as session:
+        async with session_scope() as session:
             build = await session.get(BuildShowcase, build_id)
             if build:
                 await session.delete(build)
-                await session.commit()
+                await commit(session)
+
+                after_commit(session, partial(cache_events.emit, 'showcases'))
                 return True
             return False
 
 
+class BroadcastCRUD:
+    @staticmethod
+    async def create_broadcast(admin_chat_id: int, total: int, text: str = None,
+                               from_chat_id: int = None, message_id: int = None,
+                               progress_message_id: int = None) -> Broadcast:
+        """Создать рассылку"""
+        async with session_scope() as session:
+            broadcast = Broadcast(
+                admin_chat_id=admin_chat_id,
+                text=text,
+                from_chat_id=from_chat_id,
+                message_id=message_id,
+                progress_message_id=progress_message_id,
+                status='running',
+                cursor_user_id=0,
+                total=total,
+                sent=0,
+                failed=0,
+                blocked=0
+            )
+            session.add(broadcast)
+            await commit(session)
+            return broadcast
+
+    @staticmethod
+    async def get_broadcast(broadcast_id: int) -> Broadcast:
+        """Получить рассылку по ID"""
+        async with session_scope() as session:
+            return await session.get(Broadcast, broadcast_id)
+
+    @staticmethod
+    async def get_running_broadcasts() -> list:
+        """Незавершенные рассылки (для продолжения после перезапуска)"""
+        async with session_scope() as session:
+            stmt = select(Broadcast).where(Broadcast.status == 'running').order_by(Broadcast.id)
+            result = await session.execute(stmt)
+            return result.scalars().all()
+
+    @staticmethod
+    async def save_progress(broadcast_id: int, cursor_user_id: int, sent: int, failed: int,
+                            blocked: int, status: str = None):
+        """Сохранить курсор и счетчики рассылки"""
+        values = {
+            'cursor_user_id': cursor_user_id,
+            'sent': sent,
+            'failed': failed,
+            'blocked': blocked
+        }
+        if status is not None:
+            values['status'] = status
+            if status != 'running':
+                values['finished_at'] = datetime.utcnow()
+
+        async with session_scope() as session:
+            await session.execute(
+                update(Broadcast).where(Broadcast.id == broadcast_id).values(**values)
+            )
+            await commit(session)
+
+
 build_crud = BuildCRUD()
 analytics_crud = AnalyticsCRUD()
-showcase_crud = ShowcaseCRUD()
\ No newline at end of file
+showcase_crud = ShowcaseCRUD()
+broadcast_crud = BroadcastCRUD()
+# Сбросы кэшей после записи - они же рассылаются остальным воркерам (см. workers.py)
+cache_events.register('build', BuildCRUD._invalidate_build)
+cache_events.register('builds', build_cache.clear)
+cache_events.register('top', BuildCRUD._invalidate_top)
+cache_events.register('catalog', BuildCRUD._invalidate_catalog)
+cache_events.register('id_pools', BuildCRUD._invalidate_id_pools)
+cache_events.register('showcases', partial(id_pool_cache.invalidate, ('showcases',)))
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import os
+
+from db.crud import analytics_crud
+from db.similar import similar_builds_index
+
+
+class PeriodicJob:
+    """Фоновая задача, которая запускается сразу и затем раз в interval секунд"""
+
+    def __init__(self, name: str, interval: float, job):
+        self.name = name
+        self.interval = interval
+        self.job = job
+        self._task = None
+
+    def start(self):
+        """Запустить задачу в текущем event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                result = await self.job()
+                logging.info(f"Job {self.name} finished: {result}")
+            except Exception as e:
+                logging.error(f"Job {self.name} failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        """Остановить задачу"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Свертка активности в bot_stats
+stats_rollup_job = PeriodicJob(
+    'stats_rollup',
+    interval=int(os.getenv('STATS_ROLLUP_INTERVAL', 3600)),
+    job=analytics_crud.rollup_daily_stats
+)
+
+# Пересчет похожих сборок (инкрементальный, полный - раз в SIMILAR_FULL_INTERVAL)
+similar_builds_job = PeriodicJob(
+    'similar_builds',
+    interval=int(os.getenv('SIMILAR_INTERVAL', 600)),
+    job=similar_builds_index.refresh
+)
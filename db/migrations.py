@@ -0,0 +1,146 @@
+import logging
+
+from sqlalchemy import select, func, text, inspect
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from db.models import SchemaVersion
+
+
+# Миграции только вперед: (версия, описание, функция(conn)).
+# Функция получает синхронное соединение (через run_sync) и должна быть
+# безопасной для уже существующих баз SQLite и PostgreSQL с данными.
+MIGRATIONS = []
+
+
+def migration(version: int, description: str):
+    """Зарегистрировать миграцию схемы"""
+    def decorator(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        return upgrade
+    return decorator
+
+
+def create_index(conn, name: str, table: str, *columns: str):
+    """Создать индекс, если его еще нет (SQLite и PostgreSQL)"""
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+
+def add_column(conn, table: str, column: str, ddl: str):
+    """Добавить колонку, если ее еще нет (в новых базах ее создает create_all)"""
+    existing = {col['name'] for col in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def backfill_rating_aggregates(conn) -> int:
+    """Пересчитать агрегаты оценок всех сборок из таблицы votes"""
+    build_votes = "FROM votes WHERE votes.build_id = builds.id"
+    histogram = ", ".join(
+        f"rating_{star} = (SELECT COUNT(*) {build_votes} AND votes.rating = {star})"
+        for star in range(1, 6)
+    )
+    conn.execute(text(
+        f"UPDATE builds SET "
+        f"rating_sum = COALESCE((SELECT SUM(votes.rating) {build_votes}), 0), "
+        f"votes_count = (SELECT COUNT(*) {build_votes}), "
+        f"{histogram}"
+    ))
+    # Округление половины вверх, как в BuildCRUD.add_vote
+    conn.execute(text(
+        "UPDATE builds SET rating = CASE WHEN votes_count > 0 "
+        "THEN (2 * rating_sum + votes_count) / (2 * votes_count) ELSE 0 END"
+    ))
+    return conn.execute(text("SELECT COUNT(*) FROM builds WHERE votes_count > 0")).scalar()
+
+
+@migration(1, "Составные индексы для фильтров, топа, голосов и активности")
+def add_hot_query_indexes(conn):
+    # get_builds_by_filters / get_random_build / get_builds_count
+    create_index(conn, 'ix_builds_filters', 'builds', 'is_approved', 'build_type', 'style', 'difficulty', 'id')
+    # get_top_builds
+    create_index(conn, 'ix_builds_top', 'builds', 'is_approved', 'downloads_count')
+    # add_vote / get_user_vote
+    create_index(conn, 'ix_votes_build_user', 'votes', 'build_id', 'user_id')
+    # like_build
+    create_index(conn, 'ix_build_likes_build_user', 'build_likes', 'build_id', 'user_id')
+    # get_user_stats / get_daily_stats / get_top_actions
+    create_index(conn, 'ix_user_activity_user_timestamp', 'user_activity', 'user_id', 'timestamp')
+    create_index(conn, 'ix_user_activity_timestamp', 'user_activity', 'timestamp')
+    create_index(conn, 'ix_user_activity_action', 'user_activity', 'action')
+
+
+@migration(2, "Сумма оценок и гистограмма по звездам в builds")
+def add_rating_aggregates(conn):
+    add_column(conn, 'builds', 'rating_sum', 'INTEGER NOT NULL DEFAULT 0')
+    for star in range(1, 6):
+        add_column(conn, 'builds', f'rating_{star}', 'INTEGER NOT NULL DEFAULT 0')
+    backfill_rating_aggregates(conn)
+
+
+@migration(3, "Заполнение users из user_activity")
+def backfill_users(conn):
+    # Таблицу users к этому моменту уже создал create_all
+    conn.execute(text(
+        "INSERT INTO users (user_id, username, first_name, last_name, first_seen, last_seen, "
+        "last_action, actions_count, is_blocked) "
+        "SELECT a.user_id, MAX(a.username), MAX(a.first_name), MAX(a.last_name), "
+        "COALESCE(MIN(a.timestamp), CURRENT_TIMESTAMP), COALESCE(MAX(a.timestamp), CURRENT_TIMESTAMP), "
+        "(SELECT last.action FROM user_activity last WHERE last.user_id = a.user_id "
+        "ORDER BY last.timestamp DESC LIMIT 1), "
+        "COUNT(*), false "
+        "FROM user_activity a "
+        "WHERE a.user_id NOT IN (SELECT user_id FROM users) "
+        "GROUP BY a.user_id"
+    ))
+
+
+@migration(4, "file_id изображений сборок и построек")
+def add_image_file_ids(conn):
+    for table in ('builds', 'build_showcase'):
+        add_column(conn, table, 'image_file_id', 'VARCHAR(255)')
+        add_column(conn, table, 'image_file_url', 'VARCHAR(500)')
+
+
+@migration(5, "Полнотекстовый индекс по названиям и описаниям сборок")
+def add_fulltext_index(conn):
+    if conn.dialect.name == 'postgresql':
+        # Вычисляемая колонка сама обновляется при INSERT/UPDATE сборки.
+        # Конфигурация russian стеммит и русские слова, и латиницу (english_stem)
+        conn.execute(text(
+            "ALTER TABLE builds ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('russian', coalesce(name, '')), 'A') || "
+            "setweight(to_tsvector('russian', coalesce(description, '')), 'B')) STORED"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_builds_search ON builds USING GIN (search_vector)"))
+        return
+
+    # FTS5 с внешним содержимым: текст хранится только в builds, индекс
+    # обновляет BuildCRUD (create_build / delete_build). В индексе только
+    # одобренные сборки, поэтому не 'rebuild', а выборка. prefix - индексы
+    # префиксов для коротких запросов "ка*"
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS builds_fts USING fts5("
+        "name, description, content='builds', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    ))
+    conn.execute(text(
+        "INSERT INTO builds_fts(rowid, name, description) "
+        "SELECT id, name, description FROM builds WHERE is_approved"
+    ))
+
+
+async def run_migrations(engine: AsyncEngine):
+    """Применить все еще не примененные миграции (каждую в своей транзакции)"""
+    async with engine.connect() as conn:
+        current_version = (await conn.execute(select(func.max(SchemaVersion.version)))).scalar() or 0
+
+    for version, description, upgrade in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version <= current_version:
+            continue
+
+        async with engine.begin() as conn:
+            await conn.run_sync(upgrade)
+            await conn.execute(
+                SchemaVersion.__table__.insert().values(version=version, description=description)
+            )
+        logging.info(f"Applied migration {version}: {description}")
@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, Enum, Boolean, ForeignKey, DateTime, Date
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Enum, Boolean, ForeignKey, DateTime, Date, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import false
 from datetime import datetime
 import enum
 
@@ -40,6 +41,10 @@ class Vote(Base):
     # Связь с сборкой
     build = relationship("Build", back_populates="votes")
 
+    __table_args__ = (
+        Index('ix_votes_build_user', 'build_id', 'user_id'),
+    )
+
 # Обновляем модель Build - добавляем связь с голосами и вычисляемые поля
 class Build(Base):
     __tablename__ = "builds"
@@ -49,6 +54,9 @@ class Build(Base):
     description = Column(Text, nullable=False)
     download_url = Column(String(500), nullable=False)
     image_url = Column(String(500), nullable=True)
+    # file_id фото в Telegram и URL, из которого он получен (см. media.py)
+    image_file_id = Column(String(255), nullable=True)
+    image_file_url = Column(String(500), nullable=True)
     
     # Основные фильтры
     build_type = Column(Enum(BuildType), nullable=False)
@@ -60,12 +68,26 @@ class Build(Base):
     rating = Column(Integer, default=0)  # Средний рейтинг (1-5)
     votes_count = Column(Integer, default=0)  # Количество оценок
     
+    # Агрегаты оценок: сумма и гистограмма по звездам (обновляются в add_vote)
+    rating_sum = Column(Integer, default=0, nullable=False, server_default='0')
+    rating_1 = Column(Integer, default=0, nullable=False, server_default='0')
+    rating_2 = Column(Integer, default=0, nullable=False, server_default='0')
+    rating_3 = Column(Integer, default=0, nullable=False, server_default='0')
+    rating_4 = Column(Integer, default=0, nullable=False, server_default='0')
+    rating_5 = Column(Integer, default=0, nullable=False, server_default='0')
+    
     # Модерация
     is_approved = Column(Boolean, default=True)
     added_by = Column(Integer, nullable=True)  # Telegram user ID
     
     # Связь с голосами
     votes = relationship("Vote", back_populates="build", cascade="all, delete-orphan")
+
+    # Индексы под горячие запросы (новые индексы добавляются и миграцией, см. db/migrations.py)
+    __table_args__ = (
+        Index('ix_builds_filters', 'is_approved', 'build_type', 'style', 'difficulty', 'id'),
+        Index('ix_builds_top', 'is_approved', 'downloads_count'),
+    )
     
     def to_dict(self):
         """Конвертирует объект в словарь"""
@@ -83,6 +105,22 @@ class Build(Base):
             'votes_count': self.votes_count
         }
     
+    @property
+    def average_rating(self) -> float:
+        """Точный средний рейтинг из агрегатов"""
+        return self.rating_sum / self.votes_count if self.votes_count else 0.0
+    
+    @property
+    def rating_distribution(self) -> dict:
+        """Распределение оценок {звезды: количество}"""
+        return {
+            1: self.rating_1,
+            2: self.rating_2,
+            3: self.rating_3,
+            4: self.rating_4,
+            5: self.rating_5
+        }
+    
     @property
     def stars_display(self):
         """Возвращает строку со звездами для отображения"""
@@ -128,6 +166,26 @@ class UserActivity(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     details = Column(Text, nullable=True)  # Дополнительная информация
 
+    __table_args__ = (
+        Index('ix_user_activity_user_timestamp', 'user_id', 'timestamp'),
+        Index('ix_user_activity_timestamp', 'timestamp'),
+        Index('ix_user_activity_action', 'action'),
+    )
+
+class User(Base):
+    """Пользователи бота (поддерживается из активности, см. db/activity.py)"""
+    __tablename__ = "users"
+    
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)  # Telegram user ID
+    username = Column(String(100), nullable=True, index=True)
+    first_name = Column(String(100), nullable=True)
+    last_name = Column(String(100), nullable=True)
+    first_seen = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_seen = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+    last_action = Column(String(50), nullable=True)
+    actions_count = Column(Integer, nullable=False, default=0, server_default='0')
+    is_blocked = Column(Boolean, nullable=False, default=False, server_default=false())  # Заблокировал бота
+
 class BotStats(Base):
     __tablename__ = "bot_stats"
     
@@ -144,6 +202,8 @@ class BuildShowcase(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False, index=True)
     image_url = Column(String(500), nullable=False)
+    image_file_id = Column(String(255), nullable=True)
+    image_file_url = Column(String(500), nullable=True)
     description = Column(Text, nullable=True)
     likes_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -154,4 +214,65 @@ class BuildLike(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False, index=True)
     build_id = Column(Integer, ForeignKey('build_showcase.id'), nullable=False, index=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_build_likes_build_user', 'build_id', 'user_id'),
+    )
+
+
+class Broadcast(Base):
+    """Рассылка и ее курсор (чтобы продолжить после перезапуска, см. broadcast.py)"""
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True)
+    admin_chat_id = Column(BigInteger, nullable=False)
+    # Текстовая рассылка отправляется через send_message с заголовком,
+    # медиа - через copy_message исходного сообщения администратора
+    text = Column(Text, nullable=True)
+    from_chat_id = Column(BigInteger, nullable=True)
+    message_id = Column(Integer, nullable=True)
+    progress_message_id = Column(Integer, nullable=True)
+    status = Column(String(20), nullable=False, default='running', index=True)  # running / done / cancelled
+    cursor_user_id = Column(BigInteger, nullable=False, default=0)  # все user_id <= курсора уже обработаны
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class UserFilter(Base):
+    """Фильтры подбора пользователя, упакованные в одно число (см. filters.py)"""
+    __tablename__ = "user_filters"
+    
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    packed = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class SimilarBuild(Base):
+    """Похожие сборки, посчитанные заранее (см. db/similar.py)"""
+    __tablename__ = "similar_builds"
+    
+    build_id = Column(Integer, primary_key=True, autoincrement=False)
+    rank = Column(Integer, primary_key=True, autoincrement=False)  # 0 - самая похожая
+    similar_id = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+
+class FsmState(Base):
+    """Состояния FSM (общие для всех процессов бота, см. db/state.py)"""
+    __tablename__ = "fsm_states"
+    
+    key = Column(String(255), primary_key=True)  # bot:chat:user[:thread][:business]:destiny
+    state = Column(String(255), nullable=True)
+    data = Column(Text, nullable=True)  # JSON
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    
+    version = Column(Integer, primary_key=True)
+    description = Column(String(255), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
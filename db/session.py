@@ -1,6 +1,13 @@
 import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event, Insert, Update, Delete
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from db.models import Base
+from db.migrations import run_migrations
 
 
 # Определяем URL базы данных в зависимости от окружения
@@ -14,14 +21,71 @@ def get_database_url():
 
 DATABASE_URL = get_database_url()
 
-engine = create_async_engine(
-    DATABASE_URL,
-    echo=False,  # Отключаем логирование в продакшене
-    future=True
-)
 
-# Для PostgreSQL нужно увеличить пул соединений
+# Профиль SQLite: WAL, несколько соединений на чтение и одно на запись
+SQLITE_READERS = int(os.getenv('SQLITE_READERS', 4))
+SQLITE_READERS_OVERFLOW = int(os.getenv('SQLITE_READERS_OVERFLOW', 16))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 32 * 1024))
+SQLITE_WRITE_TIMEOUT = int(os.getenv('SQLITE_WRITE_TIMEOUT', 30))
+
+
+def _sqlite_pragmas(read_only: bool):
+    """Обработчик connect, настраивающий каждое новое соединение SQLite"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL: читатели не блокируют писателя и наоборот
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # В WAL режим NORMAL не теряет целостность, но не делает fsync на каждый коммит
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        # Отрицательное значение - размер в КиБ, а не в страницах
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        if read_only:
+            # Запись через соединение читателя - ошибка маршрутизации, пусть будет видна сразу
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    return set_pragmas
+
+
+def create_sqlite_engines(url: str, readers: int = SQLITE_READERS):
+    """Создать пару движков SQLite: пул читателей и единственный писатель
+
+    Писатель - пул из одного соединения: записи разных апдейтов встают в
+    очередь на это соединение внутри процесса (не дольше SQLITE_WRITE_TIMEOUT
+    секунд), а не соревнуются за блокировку файла и не ловят
+    "database is locked".
+
+    По умолчанию aiosqlite открывает новое соединение на каждую сессию
+    (NullPool), поэтому пул задаем явно - соединения и их кэш страниц
+    живут между апдейтами.
+    """
+    read_engine = create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=readers,
+        max_overflow=SQLITE_READERS_OVERFLOW
+    )
+    write_engine = create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=SQLITE_WRITE_TIMEOUT
+    )
+    event.listen(read_engine.sync_engine, "connect", _sqlite_pragmas(read_only=True))
+    event.listen(write_engine.sync_engine, "connect", _sqlite_pragmas(read_only=False))
+    return read_engine, write_engine
+
+
 if DATABASE_URL.startswith('postgresql'):
+    # Для PostgreSQL нужно увеличить пул соединений
     engine = create_async_engine(
         DATABASE_URL,
         echo=False,
@@ -29,14 +93,138 @@ if DATABASE_URL.startswith('postgresql'):
         pool_size=20,
         max_overflow=30
     )
+    write_engine = engine
+else:
+    engine, write_engine = create_sqlite_engines(DATABASE_URL)
+
+
+class RoutingSession(Session):
+    """Сессия, отправляющая записи на движок писателя, а чтения - в пул читателей
+
+    После первой записи сессия до конца транзакции работает только через
+    писателя, чтобы последующие чтения видели собственные незакоммиченные
+    изменения.
+    """
+
+    read_engine = None
+    write_engine = None
+
+    def get_bind(self, mapper=None, clause=None, for_write=False, **kw):
+        if self.write_engine is self.read_engine:
+            return self.write_engine.sync_engine
+
+        if for_write or self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            self.info['wrote'] = True
+        if self.info.get('wrote'):
+            return self.write_engine.sync_engine
+        return self.read_engine.sync_engine
+
+
+def routing_session_class(read_engine, write_engine):
+    """Класс сессии, привязанный к паре движков"""
+    return type(
+        'BoundRoutingSession',
+        (RoutingSession,),
+        {'read_engine': read_engine, 'write_engine': write_engine}
+    )
+
+
+@event.listens_for(RoutingSession, "after_commit")
+@event.listens_for(RoutingSession, "after_rollback")
+def _reset_routing(session):
+    session.info.pop('wrote', None)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _run_after_commit(session):
+    session.info.pop('uncommitted', None)
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _drop_after_commit(session):
+    session.info.pop('uncommitted', None)
+    session.info.pop('after_commit', None)
+
 
 async_session = async_sessionmaker(
-    engine, 
     class_=AsyncSession,
+    sync_session_class=routing_session_class(engine, write_engine),
     expire_on_commit=False
 )
 
+# Сессия текущего апдейта (устанавливает DbSessionMiddleware)
+current_session: ContextVar[AsyncSession] = ContextVar('current_session', default=None)
+
+# Счетчик SQL-запросов текущего апдейта
+query_counter: ContextVar[list] = ContextVar('query_counter', default=None)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+event.listen(engine.sync_engine, "before_cursor_execute", _count_query)
+if write_engine is not engine:
+    event.listen(write_engine.sync_engine, "before_cursor_execute", _count_query)
+
+
+@asynccontextmanager
+async def session_scope():
+    """Сессия текущего апдейта, а вне апдейта (скрипты, фоновые задачи) - новая сессия"""
+    session = current_session.get()
+    if session is not None:
+        yield session
+        return
+
+    async with async_session() as session:
+        yield session
+
+
+async def commit(session: AsyncSession):
+    """Зафиксировать изменения
+
+    В сессии апдейта делаем только flush - коммит (или откат) выполнит
+    DbSessionMiddleware в конце апдейта. Исключение - профиль SQLite с
+    единственным писателем: его нельзя держать до конца апдейта (на время
+    запросов к Telegram), поэтому там транзакция фиксируется сразу.
+    Кэши после таких записей сбрасываются через after_commit().
+    """
+    if session is current_session.get() and write_engine is engine:
+        await session.flush()
+        session.info['uncommitted'] = True
+    else:
+        await session.commit()
+
+
+def cacheable(session: AsyncSession) -> bool:
+    """Можно ли класть прочитанное этой сессией в общие кэши процесса
+
+    Нельзя, если в сессии апдейта есть записи, которые commit() только
+    отправил в БД: прочитанное может откатиться вместе с ними.
+    """
+    return not session.info.get('uncommitted')
+
+
+def after_commit(session: AsyncSession, callback):
+    """Сбросить кэши после записи: сразу и, если запись еще не зафиксирована, после коммита
+
+    Повторный сброс убирает то, что другие апдейты успели закэшировать до
+    коммита (старое значение). При откате повторного сброса нет.
+    """
+    callback()
+    if session.info.get('uncommitted'):
+        session.info.setdefault('after_commit', []).append(callback)
+
+
 async def init_db():
-    """Инициализация базы данных - создание таблиц"""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+    """Инициализация базы данных - создание таблиц и применение миграций"""
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    # create_all не трогает существующие таблицы - индексы и новые
+    # колонки доезжают до старых баз через миграции
+    await run_migrations(write_engine)
\ No newline at end of file
@@ -0,0 +1,344 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, delete, insert
+
+from db.models import Build, BuildType, BuildStyle, Difficulty, Vote, UserActivity, SimilarBuild
+from db.session import async_session
+
+
+# Признаки карточки и их веса в похожести по содержанию
+ATTRIBUTES = (
+    ('build_type', BuildType, float(os.getenv('SIMILAR_TYPE_WEIGHT', 1.0))),
+    ('style', BuildStyle, float(os.getenv('SIMILAR_STYLE_WEIGHT', 1.0))),
+    ('difficulty', Difficulty, float(os.getenv('SIMILAR_DIFFICULTY_WEIGHT', 0.5))),
+)
+# Доля от итоговой похожести, которая достается популярности (только развести равные)
+POPULARITY_WEIGHT = 0.001
+WRITE_CHUNK = 1000
+
+
+class SimilarityMatrices:
+    """Признаки сборок для одного пересчета"""
+
+    def __init__(self, builds: list, pairs: np.ndarray, max_user_items: int, max_item_users: int):
+        self.ids = np.array([build.id for build in builds], dtype=np.int64)
+        self.index = {build_id: position for position, build_id in enumerate(self.ids.tolist())}
+        count = len(self.ids)
+
+        # One-hot признаков с весом sqrt(w / sum w): скалярное произведение - доля совпавших
+        total_weight = sum(weight for _, _, weight in ATTRIBUTES)
+        width = sum(len(enum) for _, enum, _ in ATTRIBUTES)
+        self.features = np.zeros((count, width), dtype=np.float32)
+        offset = 0
+        for attribute, enum, weight in ATTRIBUTES:
+            codes = {member: code for code, member in enumerate(enum)}
+            columns = np.array([codes[getattr(build, attribute)] for build in builds], dtype=np.int64)
+            self.features[np.arange(count), offset + columns] = np.sqrt(weight / total_weight)
+            offset += len(enum)
+
+        downloads = np.log1p(np.array([build.downloads_count or 0 for build in builds], dtype=np.float32))
+        self.popularity = downloads / max(float(downloads.max(initial=0)), 1.0) * POPULARITY_WEIGHT
+
+        # Матрица "пользователь x сборка" в двух разреженных видах (CSR по строкам и по столбцам).
+        # pairs - (user_id, build_id) без повторов; пары удаленных сборок отбрасываются
+        positions = np.searchsorted(self.ids, pairs[:, 1])
+        known = positions < count
+        known[known] = self.ids[positions[known]] == pairs[known, 1]
+        users, user_rows = np.unique(pairs[known, 0], return_inverse=True)
+        items = positions[known]
+
+        # У пользователей, скачавших пол каталога, совпадения ничего не говорят о похожести
+        user_items = np.bincount(user_rows, minlength=len(users))
+        keep = user_items[user_rows] <= max_user_items
+        user_rows, items = user_rows[keep], items[keep]
+
+        self.interactions = len(items)
+        self.user_ptr, self.user_items = self._csr(user_rows, items, len(users))
+        item_ptr, item_users = self._csr(items, user_rows, count)
+        self.degree = np.diff(item_ptr).astype(np.float32)
+
+        # У популярной сборки совместные взаимодействия считаются по случайной выборке
+        # из max_item_users ее пользователей и масштабируются на всех
+        self.item_ptr, self.item_users = self._cap(item_ptr, item_users, max_item_users)
+        sampled = np.diff(self.item_ptr)
+        self.scale = np.divide(self.degree, sampled, out=np.ones_like(self.degree), where=sampled > 0)
+        # Сколько пар (пользователь, сборка) разворачивает строка сборки в _scores
+        self.expand_cost = np.bincount(
+            np.repeat(np.arange(count), sampled),
+            weights=np.diff(self.user_ptr)[self.item_users],
+            minlength=count
+        )
+
+    @staticmethod
+    def _csr(keys: np.ndarray, values: np.ndarray, size: int) -> tuple:
+        order = np.argsort(keys, kind='stable')
+        ptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=size), out=ptr[1:])
+        return ptr, values[order]
+
+    @staticmethod
+    def _cap(ptr: np.ndarray, values: np.ndarray, limit: int) -> tuple:
+        """Не больше limit случайных значений в каждой строке CSR-матрицы"""
+        lengths = np.diff(ptr)
+        if lengths.max(initial=0) <= limit:
+            return ptr, values
+        # Случайный порядок внутри строк (seed постоянный - результат пересчета воспроизводим)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        order = np.lexsort((np.random.default_rng(0).random(len(values)), rows))
+        offsets = np.arange(len(values)) - np.repeat(ptr[:-1], lengths)
+        capped = np.zeros_like(ptr)
+        np.cumsum(np.minimum(lengths, limit), out=capped[1:])
+        return capped, values[order][offsets < limit]
+
+    @staticmethod
+    def expand(ptr: np.ndarray, values: np.ndarray, keys: np.ndarray) -> tuple:
+        """Все значения строк keys CSR-матрицы: (номер ключа в keys, значение)"""
+        starts = ptr[keys]
+        lengths = ptr[keys + 1] - starts
+        owners = np.repeat(np.arange(len(keys)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return owners, values[np.repeat(starts, lengths) + offsets]
+
+
+class SimilarBuildsIndex:
+    """Похожие сборки, посчитанные заранее пакетно на NumPy
+
+    Похожесть двух сборок - взвешенная сумма:
+      - совпадения типа, стиля и сложности (скалярное произведение
+        one-hot векторов с весами ATTRIBUTES);
+      - косинуса столбцов матрицы "пользователь x сборка", где отмечены
+        оценки не ниже min_rating и скачивания за download_days дней:
+        "кто оценил или скачал эту, тот и ту".
+    Для каждой сборки top_k соседей пишутся в similar_builds, так что
+    кнопка "Похожие сборки" - один запрос по первичному ключу.
+
+    Первый запуск после старта и дальше раз в full_interval секунд читают
+    из БД все сборки и взаимодействия и пересчитывают все сборки. Между
+    ними сборки и пары (пользователь, сборка) хранятся в памяти, а запуск
+    читает только ID одобренных сборок, признаки новых и оценки и
+    скачивания с ID больше уже учтенных. Пересчитываются только
+    затронутые: новые и удаленные (снятые с модерации) сборки, сборки с
+    новыми оценками и скачиваниями, сборки, у которых они были в соседях,
+    и их новые соседи. Скачивания старше download_days уходят из матрицы
+    при полном пересчете. Вычисления идут в отдельном потоке, пачками не
+    больше max_batch_cells ячеек матрицы похожести и развернутых пар.
+    """
+
+    def __init__(self, top_k: int = 10, interaction_weight: float = 0.6, min_rating: int = 4,
+                 download_days: int = 90, max_user_items: int = 500, max_item_users: int = 1000,
+                 min_score: float = 0.01, full_interval: float = 86400, max_batch_cells: int = 4_000_000):
+        self.top_k = top_k
+        self.interaction_weight = interaction_weight
+        self.min_rating = min_rating
+        self.download_days = download_days
+        self.max_user_items = max_user_items
+        self.max_item_users = max_item_users
+        self.min_score = min_score
+        self.full_interval = full_interval
+        self.max_batch_cells = max_batch_cells
+
+        self._neighbours = None  # ID сборки -> ID соседей (None - еще не было полного пересчета)
+        self._builds = {}        # ID одобренной сборки -> строка с признаками
+        self._pairs = np.zeros((0, 2), dtype=np.int64)  # (user_id, build_id) без повторов
+        # Последние учтенные Vote.id и UserActivity.id: новые взаимодействия - строки после них
+        self._last_vote_id = 0
+        self._last_activity_id = 0
+        self._full_at = 0.0
+
+    async def refresh(self) -> dict:
+        """Пересчитать похожие сборки (для PeriodicJob)"""
+        full = self._neighbours is None or time.monotonic() - self._full_at >= self.full_interval
+        builds, pairs, changed, last_ids = await self._load(full)
+
+        computed, removed, rows = await asyncio.to_thread(self._compute, builds, pairs, changed, full)
+        await self._write(computed, removed, full)
+
+        # Состояние меняется только после записи - упавший пересчет повторится целиком
+        self._builds, self._pairs = builds, pairs
+        self._last_vote_id, self._last_activity_id = last_ids
+        if full:
+            self._neighbours = {}
+            self._full_at = time.monotonic()
+        for build_id in removed:
+            self._neighbours.pop(build_id, None)
+        self._neighbours.update((build_id, set(similar_ids)) for build_id, (similar_ids, _) in computed.items())
+        return {'full': full, 'builds': len(builds), 'recomputed': rows, 'removed': len(removed)}
+
+    async def _load(self, full: bool) -> tuple:
+        """Сборки, пары (user_id, build_id), сборки с новыми взаимодействиями и последние ID
+        оценок и скачиваний
+
+        При full все читается заново, иначе к сохраненному добавляются новые
+        строки. Новые взаимодействия ищутся по ID строк, а не по времени: ID
+        растут монотонно, а время пишет приложение - строка, закоммиченная
+        позже прошлого пересчета, но с более ранним временем, не потеряется.
+        """
+        columns = (Build.id, Build.build_type, Build.style, Build.difficulty, Build.downloads_count)
+        votes_query = select(Vote.id, Vote.user_id, Vote.build_id).where(Vote.rating >= self.min_rating)
+        downloads_query = select(UserActivity.id, UserActivity.user_id, UserActivity.details).where(
+            UserActivity.action == 'download',
+            UserActivity.timestamp >= datetime.utcnow() - timedelta(days=self.download_days)
+        )
+        if not full:
+            votes_query = votes_query.where(Vote.id > self._last_vote_id)
+            downloads_query = downloads_query.where(UserActivity.id > self._last_activity_id)
+
+        async with async_session() as session:
+            if full:
+                builds = {
+                    build.id: build for build in (await session.execute(
+                        select(*columns).where(Build.is_approved == True)
+                    )).all()
+                }
+            else:
+                # Удаленные и снятые с модерации уходят, признаки читаются только у новых
+                approved = set((await session.execute(
+                    select(Build.id).where(Build.is_approved == True)
+                )).scalars().all())
+                builds = {build_id: build for build_id, build in self._builds.items() if build_id in approved}
+                new_ids = sorted(approved - builds.keys())
+                for start in range(0, len(new_ids), WRITE_CHUNK):
+                    for build in (await session.execute(
+                        select(*columns).where(Build.id.in_(new_ids[start:start + WRITE_CHUNK]))
+                    )).all():
+                        builds[build.id] = build
+            votes = (await session.execute(votes_query)).all()
+            downloads = (await session.execute(downloads_query)).all()
+
+        new_pairs = [(user_id, build_id) for _, user_id, build_id in votes]
+        # details скачивания - ID сборки
+        new_pairs += [(user_id, int(details)) for _, user_id, details in downloads if details and details.isdigit()]
+        new_pairs = np.array(new_pairs, dtype=np.int64).reshape(-1, 2)
+
+        if full:
+            pairs, changed = np.unique(new_pairs, axis=0), set()
+        else:
+            pairs = np.unique(np.concatenate([self._pairs, new_pairs]), axis=0) if len(new_pairs) else self._pairs
+            changed = set(new_pairs[:, 1].tolist())
+
+        last_ids = (
+            max([0 if full else self._last_vote_id] + [vote_id for vote_id, _, _ in votes]),
+            max([0 if full else self._last_activity_id] + [activity_id for activity_id, _, _ in downloads])
+        )
+        return builds, pairs, changed, last_ids
+
+    def _compute(self, builds: dict, pairs: np.ndarray, changed: set, full: bool) -> tuple:
+        """(ID -> (соседи, оценки), удаленные ID, сколько строк посчитано)"""
+        present = set(builds)
+        if not full:
+            known = set(self._neighbours)
+            removed = known - present
+            dirty = (present - known) | removed | (changed & present)
+            if not dirty:
+                return {}, removed, 0
+
+        matrices = SimilarityMatrices(
+            [builds[build_id] for build_id in sorted(builds)], pairs, self.max_user_items, self.max_item_users
+        )
+        if full:
+            return self._top(matrices, present), set(), len(present)
+
+        rows = (dirty & present) | {
+            build_id for build_id, similar_ids in self._neighbours.items()
+            if build_id in present and not similar_ids.isdisjoint(dirty)
+        }
+        computed = self._top(matrices, rows)
+        # Измененная сборка могла войти в соседи тех, у кого ее не было
+        extra = {similar_id for build_id in dirty if build_id in computed for similar_id in computed[build_id][0]}
+        computed.update(self._top(matrices, extra - rows))
+        return computed, removed, len(computed)
+
+    def _top(self, matrices: SimilarityMatrices, build_ids: set) -> dict:
+        """top_k соседей для сборок build_ids"""
+        count = len(matrices.ids)
+        k = min(self.top_k, count - 1)
+        if k <= 0 or not build_ids:
+            return {build_id: ([], []) for build_id in build_ids}
+
+        rows = np.array(sorted(matrices.index[build_id] for build_id in build_ids), dtype=np.int64)
+        result = {}
+        for chunk in self._batches(matrices, rows):
+            scores = self._scores(matrices, chunk)
+
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+            for row, neighbours, neighbour_scores in zip(chunk.tolist(), top, top_scores):
+                keep = neighbour_scores >= self.min_score
+                result[int(matrices.ids[row])] = (
+                    matrices.ids[neighbours[keep]].tolist(), neighbour_scores[keep].tolist()
+                )
+        return result
+
+    def _batches(self, matrices: SimilarityMatrices, rows: np.ndarray):
+        """Пачки rows: строки матрицы похожести плюс развернутые в _scores пары - до max_batch_cells"""
+        total = np.cumsum(len(matrices.ids) + matrices.expand_cost[rows])
+        start = 0
+        while start < len(rows):
+            done = total[start - 1] if start else 0
+            end = max(start + 1, int(np.searchsorted(total, done + self.max_batch_cells, side='right')))
+            yield rows[start:end]
+            start = end
+
+    def _scores(self, matrices: SimilarityMatrices, rows: np.ndarray) -> np.ndarray:
+        """Похожесть сборок rows со всеми сборками (len(rows) x count)"""
+        count = len(matrices.ids)
+        scores = matrices.features[rows] @ matrices.features.T
+        scores *= 1 - self.interaction_weight
+
+        if matrices.interactions:
+            # Совместные взаимодействия: пользователи этих сборок -> все их сборки
+            row_positions, users = matrices.expand(matrices.item_ptr, matrices.item_users, rows)
+            owners, items = matrices.expand(matrices.user_ptr, matrices.user_items, users)
+            common = np.bincount(
+                row_positions[owners] * count + items, minlength=len(rows) * count
+            ).reshape(len(rows), count).astype(np.float32)
+            common *= matrices.scale[rows][:, None]
+            norm = np.sqrt(np.outer(matrices.degree[rows], matrices.degree))
+            cosine = np.divide(common, norm, out=np.zeros_like(common), where=norm > 0)
+            scores += self.interaction_weight * cosine
+
+        scores += matrices.popularity
+        scores[np.arange(len(rows)), rows] = -np.inf
+        return scores
+
+    async def _write(self, computed: dict, removed: set, full: bool):
+        """Заменить строки similar_builds пересчитанных и удаленных сборок одной транзакцией"""
+        if not full and not computed and not removed:
+            return
+
+        rows = [
+            {'build_id': build_id, 'rank': rank, 'similar_id': similar_id, 'score': score}
+            for build_id, (similar_ids, scores) in computed.items()
+            for rank, (similar_id, score) in enumerate(zip(similar_ids, scores))
+        ]
+        async with async_session() as session:
+            if full:
+                await session.execute(delete(SimilarBuild))
+            else:
+                stale = sorted(computed.keys() | removed)
+                for start in range(0, len(stale), WRITE_CHUNK):
+                    await session.execute(
+                        delete(SimilarBuild).where(SimilarBuild.build_id.in_(stale[start:start + WRITE_CHUNK]))
+                    )
+            for start in range(0, len(rows), WRITE_CHUNK):
+                await session.execute(insert(SimilarBuild), rows[start:start + WRITE_CHUNK])
+            await session.commit()
+
+
+similar_builds_index = SimilarBuildsIndex(
+    top_k=int(os.getenv('SIMILAR_TOP_K', 10)),
+    interaction_weight=float(os.getenv('SIMILAR_INTERACTION_WEIGHT', 0.6)),
+    min_rating=int(os.getenv('SIMILAR_MIN_RATING', 4)),
+    download_days=int(os.getenv('SIMILAR_DOWNLOAD_DAYS', 90)),
+    max_user_items=int(os.getenv('SIMILAR_MAX_USER_ITEMS', 500)),
+    max_item_users=int(os.getenv('SIMILAR_MAX_ITEM_USERS', 1000)),
+    full_interval=float(os.getenv('SIMILAR_FULL_INTERVAL', 86400))
+)
@@ -0,0 +1,277 @@
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db.cache import TTLCache
+from db.models import FsmState, UserFilter
+from db.session import async_session
+
+
+class StateBackend(ABC):
+    """Хранилище состояния пользователей: фильтры подбора и FSM
+
+    Фильтры хранятся упакованными в одно целое (см. filters.pack_filters),
+    0 - фильтры не выбраны. Состояние FSM - пара (state, data) по ключу
+    aiogram; (None, {}) - состояния нет.
+    """
+
+    @abstractmethod
+    async def get_filters(self, user_id: int) -> int:
+        pass
+
+    @abstractmethod
+    async def set_filters(self, user_id: int, packed: int):
+        pass
+
+    @abstractmethod
+    async def get_fsm(self, key: str) -> tuple:
+        pass
+
+    @abstractmethod
+    async def set_fsm(self, key: str, state: str, data: dict):
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class PackedFilterCache:
+    """user_id -> упакованные фильтры с TTL и LRU, одно целое на пользователя
+
+    Срок жизни (в секундах от старта) и фильтры хранятся в одном int, а
+    записи - в обычном dict без OrderedDict: при обращении ключ переносится
+    в конец, при переполнении вытесняется первый. Это в разы меньше, чем
+    словарь фильтров или запись TTLCache (кортеж, float и узел списка).
+    """
+
+    VALUE_BITS = 16
+
+    def __init__(self, maxsize: int = 100000, ttl: float = 86400):
+        self.maxsize = maxsize
+        self.ttl = int(ttl)
+        self._data = {}
+        self._started = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _now(self) -> int:
+        return int(time.monotonic() - self._started)
+
+    def get(self, user_id: int) -> int:
+        """Упакованные фильтры (0 - нет записи или она устарела)"""
+        entry = self._data.pop(user_id, None)
+        if entry is None:
+            self.misses += 1
+            return 0
+        if entry >> self.VALUE_BITS <= self._now():
+            self.expirations += 1
+            self.misses += 1
+            return 0
+        self._data[user_id] = entry
+        self.hits += 1
+        return entry & ((1 << self.VALUE_BITS) - 1)
+
+    def set(self, user_id: int, packed: int):
+        self._data.pop(user_id, None)
+        if not packed:
+            return
+        self._data[user_id] = ((self._now() + self.ttl) << self.VALUE_BITS) | packed
+        while len(self._data) > self.maxsize:
+            del self._data[next(iter(self._data))]
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class MemoryStateBackend(StateBackend):
+    """Состояние в памяти процесса: ограниченное число пользователей, TTL и LRU
+
+    Давно не менявшиеся записи истекают, при переполнении вытесняются
+    дольше всех неактивные пользователи. Фильтры - в PackedFilterCache,
+    FSM - в TTLCache (данные диалога нужны целиком). После перезапуска состояние
+    теряется; при нескольких процессах работает благодаря шардированию
+    по user_id (см. workers.py), но не переживает смену числа воркеров.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: float = 86400):
+        self.filters = PackedFilterCache(maxsize=maxsize, ttl=ttl)
+        self.fsm = TTLCache(maxsize=maxsize, ttl=ttl)  # ключ -> (state, data)
+
+    async def get_filters(self, user_id: int) -> int:
+        return self.filters.get(user_id)
+
+    async def set_filters(self, user_id: int, packed: int):
+        self.filters.set(user_id, packed)
+
+    async def get_fsm(self, key: str) -> tuple:
+        return self.fsm.get(key) or (None, {})
+
+    async def set_fsm(self, key: str, state: str, data: dict):
+        if state is None and not data:
+            self.fsm.invalidate(key)
+        else:
+            self.fsm.set(key, (state, data))
+
+    def stats(self) -> dict:
+        return {'filters': self.filters.stats(), 'fsm': self.fsm.stats()}
+
+
+class SQLStateBackend(StateBackend):
+    """Состояние в таблицах user_filters и fsm_states - общее для всех процессов
+
+    Фильтры и шаги диалогов (добавление сборки, обратная связь, витрина)
+    переживают перезапуск. Запись идет в своей короткой транзакции, а не в
+    сессии апдейта: шаг сохраняется, даже если обработчик потом упал.
+
+    Чтения обслуживает локальный кэш со сквозной записью: апдейты одного
+    пользователя всегда попадают в один процесс (шардирование по user_id),
+    поэтому другой процесс эти ключи не меняет. Без кэша каждый апдейт
+    делал бы SELECT - FSMContextMiddleware читает состояние всегда.
+    """
+
+    def __init__(self, cache_size: int = 10000, cache_ttl: float = 300):
+        self.filters = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.fsm = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    async def get_filters(self, user_id: int) -> int:
+        packed = self.filters.get(user_id)
+        if packed is not None:
+            return packed
+
+        async with async_session() as session:
+            packed = (await session.execute(
+                select(UserFilter.packed).where(UserFilter.user_id == user_id)
+            )).scalar() or 0
+        # Отсутствие фильтров тоже кэшируем - это самый частый случай
+        self.filters.set(user_id, packed)
+        return packed
+
+    async def set_filters(self, user_id: int, packed: int):
+        async with async_session() as session:
+            if packed:
+                await self._upsert(session, UserFilter, UserFilter.user_id, {
+                    'user_id': user_id,
+                    'packed': packed,
+                    'updated_at': datetime.utcnow()
+                })
+            else:
+                await session.execute(delete(UserFilter).where(UserFilter.user_id == user_id))
+            await session.commit()
+        self.filters.set(user_id, packed)
+
+    async def get_fsm(self, key: str) -> tuple:
+        cached = self.fsm.get(key)
+        if cached is not None:
+            return cached
+
+        async with async_session() as session:
+            row = (await session.execute(
+                select(FsmState.state, FsmState.data).where(FsmState.key == key)
+            )).first()
+        entry = (row.state, json.loads(row.data) if row.data else {}) if row else (None, {})
+        self.fsm.set(key, entry)
+        return entry
+
+    async def set_fsm(self, key: str, state: str, data: dict):
+        async with async_session() as session:
+            if state is None and not data:
+                # FSMContext.clear() - строка больше не нужна
+                await session.execute(delete(FsmState).where(FsmState.key == key))
+            else:
+                await self._upsert(session, FsmState, FsmState.key, {
+                    'key': key,
+                    'state': state,
+                    'data': json.dumps(data, ensure_ascii=False) if data else None,
+                    'updated_at': datetime.utcnow()
+                })
+            await session.commit()
+        self.fsm.set(key, (state, data))
+
+    @staticmethod
+    async def _upsert(session, model, primary_key, values: dict):
+        dialect = session.get_bind().dialect.name
+        insert_stmt = (postgresql if dialect == 'postgresql' else sqlite).insert(model)
+        await session.execute(insert_stmt.values(**values).on_conflict_do_update(
+            index_elements=[primary_key],
+            set_={column: value for column, value in values.items() if column != primary_key.key}
+        ))
+
+    def stats(self) -> dict:
+        return {'filters': self.filters.stats(), 'fsm': self.fsm.stats()}
+
+
+class BackendFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх StateBackend"""
+
+    def __init__(self, backend: StateBackend, key_builder: KeyBuilder = None):
+        self.backend = backend
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        _, data = await self.backend.get_fsm(storage_key)
+        await self.backend.set_fsm(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str:
+        state, _ = await self.backend.get_fsm(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        storage_key = self.key_builder.build(key)
+        state, _ = await self.backend.get_fsm(storage_key)
+        await self.backend.set_fsm(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, data = await self.backend.get_fsm(self.key_builder.build(key))
+        return dict(data)
+
+    async def close(self) -> None:
+        pass
+
+
+def create_state_backend(kind: str) -> StateBackend:
+    """Хранилище по имени: memory или sql"""
+    if kind == 'memory':
+        return MemoryStateBackend(
+            maxsize=int(os.getenv('STATE_MEMORY_SIZE', 100000)),
+            ttl=float(os.getenv('STATE_MEMORY_TTL', 86400))
+        )
+    if kind == 'sql':
+        return SQLStateBackend(
+            cache_size=int(os.getenv('STATE_CACHE_SIZE', 10000)),
+            cache_ttl=float(os.getenv('STATE_CACHE_TTL', 300))
+        )
+    raise ValueError(f"Unknown state storage: {kind}")
+
+
+# sql - общее для всех процессов и переживает перезапуск, memory - только для одного процесса.
+# По умолчанию sql только под workers.py: одному процессу он добавил бы транзакцию на каждое нажатие
+state_backend = create_state_backend(
+    os.getenv('STATE_STORAGE', 'sql' if int(os.getenv('BOT_WORKERS', 1)) > 1 else 'memory')
+)
+fsm_storage = BackendFSMStorage(state_backend)
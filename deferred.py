@@ -0,0 +1,115 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import defaultdict
+
+
+class DeferredTasks:
+    """Фоновые побочные эффекты обработчиков: сначала ответ, потом остальное
+
+    Обработчик отвечает пользователю (callback.answer, сообщение) и отдает
+    сюда то, чего пользователь не видит: запись активности, счетчики,
+    прогрев кэшей. Задачи выполняются не больше concurrency одновременно,
+    ошибки логируются и считаются, а не теряются в "Task exception was
+    never retrieved". Если задач уже max_pending, новые отбрасываются -
+    побочные эффекты не должны копиться без предела под нагрузкой.
+    При остановке бота drain() дожидается оставшихся задач.
+    """
+
+    def __init__(self, concurrency: int = 10, max_pending: int = 1000):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+
+        self._semaphore = None
+        self._tasks = set()
+        self.running = 0
+
+        # Метрики по имени задачи
+        self.spawned = defaultdict(int)
+        self.completed = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.dropped = defaultdict(int)
+        self.duration_total = defaultdict(float)
+        self.duration_max = defaultdict(float)
+
+    def spawn(self, func, *args, name: str = None, **kwargs) -> bool:
+        """Запустить func(*args, **kwargs) в фоне, False - задача отброшена
+
+        Передается функция, а не корутина: отброшенная задача не оставляет
+        невыполненной корутины.
+        """
+        name = name or func.__name__
+        if len(self._tasks) >= self.max_pending:
+            self.dropped[name] += 1
+            return False
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Чистый контекст: задача не должна унаследовать сессию апдейта - та закроется раньше
+        task = asyncio.get_running_loop().create_task(
+            self._run(name, func, args, kwargs), context=contextvars.Context()
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.spawned[name] += 1
+        return True
+
+    async def _run(self, name: str, func, args: tuple, kwargs: dict):
+        async with self._semaphore:
+            self.running += 1
+            started = time.monotonic()
+            try:
+                await func(*args, **kwargs)
+            except Exception as e:
+                self.failed[name] += 1
+                logging.error(f"Deferred task {name} failed: {e}", exc_info=True)
+            else:
+                self.completed[name] += 1
+            finally:
+                self.running -= 1
+            # Отмененные при drain() задачи в длительность не попадают
+            duration = time.monotonic() - started
+            self.duration_total[name] += duration
+            self.duration_max[name] = max(self.duration_max[name], duration)
+
+    async def drain(self, timeout: float = 10):
+        """Дождаться фоновых задач (при остановке бота), по таймауту - отменить"""
+        deadline = time.monotonic() + timeout
+        # Задача может запустить следующую - ждем, пока множество не опустеет
+        while self._tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.wait(set(self._tasks), timeout=remaining)
+
+        if self._tasks:
+            logging.warning(f"Cancelling {len(self._tasks)} deferred task(s) after {timeout}s")
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        """Метрики по именам задач"""
+        stats = {}
+        for name in self.spawned.keys() | self.dropped.keys():
+            finished = self.completed[name] + self.failed[name]
+            stats[name] = {
+                'spawned': self.spawned[name],
+                'completed': self.completed[name],
+                'failed': self.failed[name],
+                'dropped': self.dropped[name],
+                'avg_ms': self.duration_total[name] / finished * 1000 if finished else 0.0,
+                'max_ms': self.duration_max[name] * 1000
+            }
+        return stats
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+
+deferred_tasks = DeferredTasks(
+    concurrency=int(os.getenv('DEFERRED_CONCURRENCY', 10)),
+    max_pending=int(os.getenv('DEFERRED_MAX_PENDING', 1000))
+)
@@ -0,0 +1,185 @@
+import os
+import random
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+
+from db.cache import TTLCache
+from db.crud import build_crud
+
+
+MASK64 = (1 << 64) - 1
+
+
+class FeistelPermutation:
+    """Псевдослучайная перестановка чисел 0..size-1 без хранения списка
+
+    Сеть Фейстеля на 2 * half битах - биекция на [0, 2^(2 * half)). Значения
+    за пределами size пропускаются повторным применением (cycle walking),
+    поэтому результат - перестановка именно 0..size-1. Весь ключ - seed.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, size: int, seed: int):
+        self.size = size
+        self.half = (max(size - 1, 1).bit_length() + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [self._mix(seed * self.ROUNDS + number) for number in range(self.ROUNDS)]
+
+    @staticmethod
+    def _mix(value: int) -> int:
+        """Перемешивание 64-битного числа (splitmix64)"""
+        value = (value + 0x9E3779B97F4A7C15) & MASK64
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+        return value ^ (value >> 31)
+
+    def __getitem__(self, index: int) -> int:
+        value = index
+        while True:
+            left, right = value >> self.half, value & self.mask
+            for key in self.keys:
+                left, right = right, left ^ (self._mix(right ^ key) & self.mask)
+            value = (left << self.half) | right
+            if value < self.size:
+                return value
+
+
+class DiscoverySegment:
+    """Перестановка позиций start..len(ids)-1 снимка пула ID
+
+    ids - сам закэшированный пул на момент открытия сегмента (ссылка, не
+    копия: пул при изменении каталога заменяется новым массивом, а не
+    меняется), поэтому позиция всегда указывает на тот же ID.
+    """
+
+    def __init__(self, ids, start: int, seed: int):
+        self.ids = ids
+        self.start = start
+        self.permutation = FeistelPermutation(len(ids) - start, seed)
+        self.position = 0
+
+    def left(self) -> int:
+        return len(self.ids) - self.start - self.position
+
+    def next_id(self) -> int:
+        build_id = self.ids[self.start + self.permutation[self.position]]
+        self.position += 1
+        return build_id
+
+
+@dataclass
+class DiscoveryCursor:
+    """Проход пользователя по корзине фильтров: seed и позиции, а не список ID
+
+    main - перестановка пула на момент начала прохода. Сборки, добавленные
+    позже (ID больше последнего в снимке), обходятся своей перестановкой
+    fresh вперемешку с основной.
+    """
+    seed: int
+    main: DiscoverySegment
+    fresh: DiscoverySegment = None
+
+    def newest(self) -> int:
+        """Наибольший ID, уже попавший в проход"""
+        return (self.fresh or self.main).ids[-1]
+
+
+class Discovery:
+    """Случайные сборки без повторов: "🎲 Другая случайная"
+
+    Для каждого пользователя и корзины фильтров хранится курсор по
+    псевдослучайной перестановке позиций в пуле ID корзины
+    (FeistelPermutation): seed и номер шага. Пул - отсортированный
+    закэшированный массив; курсор ссылается на тот снимок, с которого
+    начал, и каждый шаг дает ID корзины за O(1). Удаленные и снятые с
+    модерации сборки пропускаются (проверка бинарным поиском по текущему
+    пулу). Новые сборки не меняют уже начатую перестановку - они попадают
+    в отдельную, которая перемешивается с основной. Поэтому сборка не
+    повторится, пока пользователь не увидит всю корзину, а изменения
+    каталога никого не перетасовывают. После полного прохода начинается
+    новый с другим seed.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: float = 86400):
+        self.cursors = TTLCache(maxsize=maxsize, ttl=ttl)  # (user_id, корзина) -> DiscoveryCursor
+
+        self.picks = 0
+        self.skipped = 0  # ID, которых уже нет в корзине (удалены, сняты с модерации)
+        self.cycles = 0   # пройденные до конца корзины
+
+    async def next_build(self, user_id: int, build_type=None, style=None, difficulty=None):
+        """Следующая непоказанная сборка корзины фильтров (None - корзина пуста)"""
+        pool = await build_crud.get_id_pool(build_type, style, difficulty)
+        if not pool:
+            return None
+
+        key = (user_id, build_type, style, difficulty)
+        cursor = self.cursors.get(key)
+        if cursor is None:
+            cursor = self._new_cursor(pool)
+            self.cursors.set(key, cursor)
+
+        restarted = False
+        while True:
+            build_id = self._next_id(cursor, pool)
+            if build_id is None:
+                if restarted:
+                    # Целый проход без единой сборки - пул ID полностью устарел
+                    return None
+                # Корзина пройдена целиком - новый проход в другом порядке
+                restarted = True
+                self.cycles += 1
+                cursor = self._new_cursor(pool)
+                self.cursors.set(key, cursor)
+                continue
+
+            build = await build_crud.get_build_by_id(build_id)
+            if build is not None and build.is_approved:
+                self.picks += 1
+                return build
+            # Пул устарел (сборку удалили в другом процессе) - идем дальше
+            self.skipped += 1
+
+    @staticmethod
+    def _new_cursor(pool) -> DiscoveryCursor:
+        seed = random.getrandbits(32)
+        return DiscoveryCursor(seed=seed, main=DiscoverySegment(pool, 0, seed))
+
+    def _next_id(self, cursor: DiscoveryCursor, pool) -> int:
+        """Следующий ID из пула по курсору, None - все ID пройдены"""
+        while True:
+            fresh_left = cursor.fresh.left() if cursor.fresh else 0
+            newest = cursor.newest()
+            if not fresh_left and pool[-1] > newest:
+                # Появились сборки новее всех пройденных - открываем для них перестановку
+                cursor.fresh = DiscoverySegment(pool, bisect_right(pool, newest), cursor.seed ^ newest)
+                fresh_left = cursor.fresh.left()
+            main_left = cursor.main.left()
+            if not main_left and not fresh_left:
+                return None
+
+            # Выбор перестановки пропорционально остатку - новые сборки равномерно вперемешку
+            if random.randrange(main_left + fresh_left) < main_left:
+                build_id = cursor.main.next_id()
+            else:
+                build_id = cursor.fresh.next_id()
+
+            index = bisect_left(pool, build_id)
+            if index < len(pool) and pool[index] == build_id:
+                return build_id
+            self.skipped += 1
+
+    def stats(self) -> dict:
+        return {
+            'cursors': len(self.cursors),
+            'picks': self.picks,
+            'skipped': self.skipped,
+            'cycles': self.cycles
+        }
+
+
+discovery = Discovery(
+    maxsize=int(os.getenv('DISCOVERY_CURSORS_SIZE', 100000)),
+    ttl=float(os.getenv('DISCOVERY_CURSOR_TTL', 86400))
+)
@@ -1,42 +1,60 @@
-user_filters = {}
+from db.models import BuildType, BuildStyle, Difficulty
+from db.state import state_backend
+
+
+# Поле фильтра -> допустимые значения. Фильтры пользователя хранятся одним
+# числом: по 3 бита на поле, 0 - не выбрано, иначе номер значения + 1
+FILTER_FIELDS = (
+    ('build_type', [item.value for item in BuildType]),
+    ('style', [item.value for item in BuildStyle]),
+    ('difficulty', [item.value for item in Difficulty]),
+)
+FILTER_BITS = 3
+
+
+def pack_filters(filters: dict) -> int:
+    """Упаковать словарь фильтров в одно число"""
+    packed = 0
+    for position, (field, values) in enumerate(FILTER_FIELDS):
+        value = filters.get(field)
+        if value:
+            packed |= (values.index(value) + 1) << (position * FILTER_BITS)
+    return packed
+
+
+def unpack_filters(packed: int) -> dict:
+    """Распаковать число обратно в словарь фильтров"""
+    filters = {}
+    for position, (field, values) in enumerate(FILTER_FIELDS):
+        code = (packed >> (position * FILTER_BITS)) & ((1 << FILTER_BITS) - 1)
+        filters[field] = values[code - 1] if code else None
+    return filters
+
 
 class UserFilters:
-    """Класс для управления фильтрами пользователя"""
+    """Класс для управления фильтрами пользователя (хранилище - db/state.py)"""
     
     @staticmethod
-    def get_filters(user_id: int):
+    async def get_filters(user_id: int):
         """Получить фильтры пользователя"""
-        return user_filters.get(user_id, {
-            'build_type': None,
-            'style': None,
-            'difficulty': None
-        })
+        return unpack_filters(await state_backend.get_filters(user_id))
     
     @staticmethod
-    def set_filter(user_id: int, filter_type: str, value: str):
+    async def set_filter(user_id: int, filter_type: str, value: str):
         """Установить фильтр пользователя"""
-        if user_id not in user_filters:
-            user_filters[user_id] = {
-                'build_type': None,
-                'style': None,
-                'difficulty': None
-            }
-        user_filters[user_id][filter_type] = value
+        filters = await UserFilters.get_filters(user_id)
+        filters[filter_type] = value
+        await state_backend.set_filters(user_id, pack_filters(filters))
     
     @staticmethod
-    def clear_filters(user_id: int):
+    async def clear_filters(user_id: int):
         """Очистить фильтры пользователя"""
-        if user_id in user_filters:
-            user_filters[user_id] = {
-                'build_type': None,
-                'style': None,
-                'difficulty': None
-            }
+        await state_backend.set_filters(user_id, 0)
     
     @staticmethod
-    def get_active_filters_text(user_id: int):
+    async def get_active_filters_text(user_id: int):
         """Получить текст с активными фильтрами"""
-        filters = UserFilters.get_filters(user_id)
+        filters = await UserFilters.get_filters(user_id)
         active_filters = []
         
         if filters['build_type']:
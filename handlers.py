@@ -1,6 +1,7 @@
+import html
 import logging
 from aiogram import Router, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
@@ -10,18 +11,24 @@ from keyboards import (
     get_build_types_keyboard,
     get_style_keyboard,
     get_difficulty_keyboard,
-    get_search_results_keyboard,
     get_rating_keyboard,
     get_rating_stats_keyboard,
     get_cancel_keyboard,
-    get_showcase_keyboard
+    get_showcase_keyboard,
+    get_similar_builds_keyboard
 )
 
 from filters import UserFilters
 
-from db.crud import build_crud, analytics_crud
-from db.models import BuildType, BuildStyle, Difficulty, BUILD_TYPE_MAP, STYLE_MAP, DIFFICULTY_MAP
+from db.crud import build_crud, analytics_crud, search_terms
+from db.models import BUILD_TYPE_MAP, STYLE_MAP, DIFFICULTY_MAP
 from db.crud import showcase_crud
+from media import photo_sender
+from cards import TYPE_DISPLAY, STYLE_DISPLAY, DIFFICULTY_DISPLAY
+from renderer import renderer
+from deferred import deferred_tasks
+from search_results import search_results
+from discovery import discovery
 
 
 # Создаем роутер
@@ -42,8 +49,9 @@ router = Router()
 async def start_handler(message: types.Message):
     """Обработчик команды /start"""
    
-    # Логируем активность
-    await analytics_crud.log_user_activity(
+    # Логируем активность в фоне - приветствие не ждет очереди записи
+    deferred_tasks.spawn(
+        analytics_crud.log_user_activity,
         user_id=message.from_user.id,
         action='start',
         username=message.from_user.username,
@@ -80,7 +88,8 @@ async def random_build_handler(message: types.Message):
     await show_random_build(message)
     
     #logging user
-    await analytics_crud.log_user_activity(
+    deferred_tasks.spawn(
+        analytics_crud.log_user_activity,
         user_id=message.from_user.id,
         action='random_build'
     )
@@ -91,18 +100,57 @@ async def build_filters_handler(message: types.Message):
     await show_filters_menu(message)
 
     #logging user
-    await analytics_crud.log_user_activity(
+    deferred_tasks.spawn(
+        analytics_crud.log_user_activity,
         user_id=message.from_user.id,
         action='build_filters'
     )
 
+@router.message(Command("search"))
+async def search_handler(message: types.Message, command: CommandObject):
+    """Обработчик команды /search - поиск по названию и описанию сборок"""
+    query = command.args or ""
+    
+    #logging user
+    deferred_tasks.spawn(
+        analytics_crud.log_user_activity,
+        user_id=message.from_user.id,
+        action='search',
+        details=query[:200] or None
+    )
+    
+    if not search_terms(query):
+        await message.answer(
+            "🔎 <b>Поиск сборок</b>\n\n"
+            "Напиши после команды, что ищешь - по названию и описанию:\n"
+            "<code>/search драконы</code>",
+            parse_mode="HTML"
+        )
+        return
+    
+    build, _ = await search_results.start(message.from_user.id, query=query)
+    if not build:
+        await message.answer(
+            f"❌ <b>По запросу «{html.escape(query)}» ничего не найдено</b>\n\n"
+            f"Попробуй другие слова или подбор по фильтрам.",
+            parse_mode="HTML"
+        )
+        return
+    
+    # Первый результат - новым сообщением, дальше листание ◀️ / ▶️ правит его
+    await renderer.send_build(
+        message, build, "text_search",
+        keyboard=search_results.keyboard(message.from_user.id, build)
+    )
+
 # Обработчики для текстовых кнопок
 @router.message(lambda message: message.text == "🎲 Случайная сборка")
 async def random_build_button_handler(message: types.Message):
     await show_random_build(message)
 
     #logging user
-    await analytics_crud.log_user_activity(
+    deferred_tasks.spawn(
+        analytics_crud.log_user_activity,
         user_id=message.from_user.id,
         action='random_build'
     )
@@ -112,7 +160,8 @@ async def filters_button_handler(message: types.Message):
     await show_filters_menu(message)
 
     #logging user
-    await analytics_crud.log_user_activity(
+    deferred_tasks.spawn(
+        analytics_crud.log_user_activity,
         user_id=message.from_user.id,
         action='build_filters'
     )
@@ -135,35 +184,35 @@ async def top_builds_button_handler(message: types.Message):
 @router.callback_query(F.data == "filter_type")
 async def filter_type_callback(callback: types.CallbackQuery):
     """Обработчик выбора типа сборки"""
+    await callback.answer()
     await callback.message.edit_text(
         "🎯 <b>Выбери тип сборки:</b>\n\n"
         "Какой игровой опыт ты ищешь?",
         reply_markup=get_build_types_keyboard(),
         parse_mode="HTML"
     )
-    await callback.answer()
 
 @router.callback_query(F.data == "filter_style")
 async def filter_style_callback(callback: types.CallbackQuery):
     """Обработчик выбора стиля"""
+    await callback.answer()
     await callback.message.edit_text(
         "🏰 <b>Выбери стиль сборки:</b>\n\n"
         "В каком сеттинге хочешь играть?",
         reply_markup=get_style_keyboard(),
         parse_mode="HTML"
     )
-    await callback.answer()
 
 @router.callback_query(F.data == "filter_difficulty")
 async def filter_difficulty_callback(callback: types.CallbackQuery):
     """Обработчик выбора сложности"""
+    await callback.answer()
     await callback.message.edit_text(
         "⚡ <b>Выбери сложность:</b>\n\n"
         "Насколько сложную сборку ты ищешь?",
         reply_markup=get_difficulty_keyboard(),
         parse_mode="HTML"
     )
-    await callback.answer()
 
 @router.callback_query(F.data.startswith("type_"))
 async def build_type_selected_callback(callback: types.CallbackQuery):
@@ -172,16 +221,18 @@ async def build_type_selected_callback(callback: types.CallbackQuery):
     build_type_enum = BUILD_TYPE_MAP.get(build_type_key)
     
     if build_type_enum:
-        UserFilters.set_filter(callback.from_user.id, 'build_type', build_type_key)
+        await callback.answer("Тип сборки сохранен! ✅")
+        await UserFilters.set_filter(callback.from_user.id, 'build_type', build_type_key)
+        # Пул ID новой корзины фильтров загрузится, пока пользователь выбирает дальше
+        deferred_tasks.spawn(warm_filters_pool, callback.from_user.id)
         
         await callback.message.edit_text(
             f"✅ <b>Тип сборки выбран!</b>\n\n"
-            f"{UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
+            f"{await UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
             f"Продолжи выбор фильтров:",
             reply_markup=get_filters_keyboard(),
             parse_mode="HTML"
         )
-        await callback.answer("Тип сборки сохранен! ✅")
     else:
         await callback.answer("❌ Ошибка выбора типа", show_alert=True)
 
@@ -192,16 +243,17 @@ async def style_selected_callback(callback: types.CallbackQuery):
     style_enum = STYLE_MAP.get(style_key)
     
     if style_enum:
-        UserFilters.set_filter(callback.from_user.id, 'style', style_key)
+        await callback.answer("Стиль сохранен! ✅")
+        await UserFilters.set_filter(callback.from_user.id, 'style', style_key)
+        deferred_tasks.spawn(warm_filters_pool, callback.from_user.id)
         
         await callback.message.edit_text(
             f"✅ <b>Стиль выбран!</b>\n\n"
-            f"{UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
+            f"{await UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
             f"Продолжи выбор фильтров:",
             reply_markup=get_filters_keyboard(),
             parse_mode="HTML"
         )
-        await callback.answer("Стиль сохранен! ✅")
     else:
         await callback.answer("❌ Ошибка выбора стиля", show_alert=True)
 
@@ -212,111 +264,113 @@ async def difficulty_selected_callback(callback: types.CallbackQuery):
     difficulty_enum = DIFFICULTY_MAP.get(difficulty_key)
     
     if difficulty_enum:
-        UserFilters.set_filter(callback.from_user.id, 'difficulty', difficulty_key)
+        await callback.answer("Сложность сохранена! ✅")
+        await UserFilters.set_filter(callback.from_user.id, 'difficulty', difficulty_key)
+        deferred_tasks.spawn(warm_filters_pool, callback.from_user.id)
         
         await callback.message.edit_text(
             f"✅ <b>Сложность выбрана!</b>\n\n"
-            f"{UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
+            f"{await UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
             f"Продолжи выбор фильтров:",
             reply_markup=get_filters_keyboard(),
             parse_mode="HTML"
         )
-        await callback.answer("Сложность сохранена! ✅")
     else:
         await callback.answer("❌ Ошибка выбора сложности", show_alert=True)
 
 @router.callback_query(F.data == "back_to_filters")
 async def back_to_filters_callback(callback: types.CallbackQuery):
     """Обработчик возврата к фильтрам"""
+    await callback.answer()
     await callback.message.edit_text(
         f"🔍 <b>Подбор сборки по фильтрам</b>\n\n"
-        f"{UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
+        f"{await UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
         f"Выбери параметры для поиска:",
         reply_markup=get_filters_keyboard(),
         parse_mode="HTML"
     )
-    await callback.answer()
 
 @router.callback_query(F.data == "filter_search")
 async def filter_search_callback(callback: types.CallbackQuery):
     """Обработчик поиска по фильтрам"""
-    filters = UserFilters.get_filters(callback.from_user.id)
+    filters = await UserFilters.get_filters(callback.from_user.id)
     
     # Проверяем, выбраны ли фильтры
     if not any(filters.values()):
         await callback.answer("❌ Сначала выбери хотя бы один фильтр!", show_alert=True)
         return
+    await callback.answer()
     
-    # Преобразуем фильтры в enum'ы для БД
-    build_type_enum = BUILD_TYPE_MAP.get(filters['build_type']) if filters['build_type'] else None
-    style_enum = STYLE_MAP.get(filters['style']) if filters['style'] else None
-    difficulty_enum = DIFFICULTY_MAP.get(filters['difficulty']) if filters['difficulty'] else None
-    
-    # Ищем сборки в БД
-    builds = await build_crud.get_builds_by_filters(
-        build_type=build_type_enum,
-        style=style_enum,
-        difficulty=difficulty_enum,
-        limit=5
-    )
+    # Первая страница результатов; дальше пользователь листает ◀️ / ▶️
+    build, _ = await search_results.start(callback.from_user.id, filters_to_enums(filters))
     
-    if not builds:
+    if not build:
         await callback.message.edit_text(
             f"❌ <b>По вашему запросу ничего не найдено</b>\n\n"
-            f"{UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
+            f"{await UserFilters.get_active_filters_text(callback.from_user.id)}\n\n"
             f"Попробуйте изменить фильтры или посмотреть случайную сборку.",
             reply_markup=get_filters_keyboard(),
             parse_mode="HTML"
         )
-        await callback.answer()
         return
     
     # Показываем первую найденную сборку - редактируем текущее сообщение
-    build = builds[0]
-    await handle_callback_build(callback, build)
-    await callback.answer()
+    await handle_callback_build(callback, build, "search")
 
-async def handle_callback_build(callback: types.CallbackQuery, build):
-    """Обработка callback'а с показом сборки - всегда отправляет новое сообщение"""
-    text = format_build_text(build)
+@router.callback_query(F.data.startswith("results_"))
+async def results_page_callback(callback: types.CallbackQuery):
+    """Листание результатов поиска по фильтрам"""
+    _, search_id, index = callback.data.split("_")
+    build, cursor = await search_results.move(callback.from_user.id, search_id, int(index))
     
-    # Сначала пытаемся удалить старое сообщение
-    try:
-        await callback.message.delete()
-    except Exception as e:
-        logging.warning(f"Не удалось удалить старое сообщение: {e}")
-    
-    # Отправляем новое сообщение
-    if build.image_url:
-        try:
-            await callback.message.answer_photo(
-                photo=build.image_url,
-                caption=text,
-                reply_markup=get_search_results_keyboard(build.id),
-                parse_mode="HTML"
-            )
-            return
-        except Exception as e:
-            logging.warning(f"Не удалось отправить фото, используем текст: {e}")
+    if cursor is None:
+        await callback.answer("⌛ Результаты поиска устарели - запусти поиск заново", show_alert=True)
+        return
+    if build is None:
+        # Результатов оказалось меньше, чем показывал счетчик - обновляем кнопки
+        await callback.answer("Это последний результат")
+        build, _ = await search_results.move(callback.from_user.id, search_id, min(cursor.position, len(cursor.ids) - 1))
+        if build is not None:
+            await handle_callback_build(callback, build, "results_page")
+        return
     
-    # Текстовый вариант
-    await callback.message.answer(
-        text,
-        reply_markup=get_search_results_keyboard(build.id),
-        parse_mode="HTML",
-        disable_web_page_preview=True
-    )
+    await callback.answer()
+    await handle_callback_build(callback, build, "results_page")
+
+def filters_to_enums(filters: dict) -> dict:
+    """Фильтры пользователя -> аргументы запросов build_crud по фильтрам"""
+    return {
+        'build_type': BUILD_TYPE_MAP.get(filters['build_type']) if filters['build_type'] else None,
+        'style': STYLE_MAP.get(filters['style']) if filters['style'] else None,
+        'difficulty': DIFFICULTY_MAP.get(filters['difficulty']) if filters['difficulty'] else None
+    }
+
+async def warm_filters_pool(user_id: int):
+    """Загрузить в кэш пул ID сборок под текущие фильтры пользователя (в фоне)"""
+    filters = await UserFilters.get_filters(user_id)
+    await build_crud.warm_id_pool(**filters_to_enums(filters))
+
+async def handle_callback_build(callback: types.CallbackQuery, build, action: str = "build", **kwargs):
+    """Показать сборку вместо текущего сообщения (самым дешевым способом, см. renderer.py)
+    
+    Если пользователь листает результаты поиска и это текущий результат,
+    кнопки листания сохраняются (после скачивания, оценки и т.п.).
+    """
+    keyboard = search_results.keyboard(callback.from_user.id, build, kwargs.get('revealed', False))
+    await renderer.show_build(callback, build, action, keyboard=keyboard, **kwargs)
 
 @router.callback_query(F.data == "random_another")
 async def random_another_callback(callback: types.CallbackQuery):
     """Обработчик для другой случайной сборки"""
+    await callback.answer()
     try:
         logging.info(f"🔄 Пользователь {callback.from_user.id} запросил другую случайную сборку")
         
-        build = await build_crud.get_random_build()
+        # Без повторов, пока пользователь не увидит все сборки (см. discovery.py)
+        build = await discovery.next_build(callback.from_user.id)
         if build:
             logging.info(f"✅ Найдена сборка: {build.name} (ID: {build.id})")
-            await handle_callback_build(callback, build)  # Используем новую функцию
+            await handle_callback_build(callback, build, "random_another")
         else:
             logging.warning("❌ В базе нет сборок или они не одобрены")
             await callback.message.edit_text(
@@ -330,7 +384,6 @@ async def random_another_callback(callback: types.CallbackQuery):
             "Попробуйте еще раз позже.",
             parse_mode="HTML"
         )
-    await callback.answer()
 
 
 
@@ -338,9 +391,9 @@ async def random_another_callback(callback: types.CallbackQuery):
 @router.callback_query(F.data == "new_search")
 async def new_search_callback(callback: types.CallbackQuery):
     """Обработчик нового поиска"""
-    UserFilters.clear_filters(callback.from_user.id)
-    await show_filters_menu(callback.message)
     await callback.answer()
+    await UserFilters.clear_filters(callback.from_user.id)
+    await show_filters_menu(callback.message)
 
 @router.callback_query(F.data.startswith("download_"))
 async def download_build_callback(callback: types.CallbackQuery):
@@ -351,27 +404,39 @@ async def download_build_callback(callback: types.CallbackQuery):
         
         if build_id_str.isdigit():
             build_id = int(build_id_str)
-            build = await build_crud.get_build_by_id(build_id=build_id)
             
-            # Увеличиваем счетчик скачиваний
+            # Увеличиваем счетчик скачиваний (только в памяти - запись в БД отложена)
             updated_build = await build_crud.increment_downloads(build_id)
-            
-            if updated_build:
-                # Обновляем сообщение с новым счетчиком
-                await handle_callback_build(callback, updated_build)
-                await callback.answer(f"📥 Ссылка отображена")
-                await callback.message.answer(text=f"📥 <a href='{build.download_url}'>Скачать</a>")
-            else:
-                await callback.answer("❌ Сборка не найдена", show_alert=True)
         else:
             # Резервный вариант для старых сообщений без ID
             await callback.answer(f"📥 Ссылка отображена")
+            return
             
     except Exception as e:
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         logging.error(f"Error incrementing download count: {e}")
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         await callback.answer("❌ Ошибка при обновлении счетчика", show_alert=True)
+        return
+    
+    if not updated_build:
+        await callback.answer("❌ Сборка не найдена", show_alert=True)
+        return
+    
+    await callback.answer(f"📥 Ссылка на кнопке «Скачать»")
+    # ID сборки в деталях - по скачиваниям считаются похожие сборки (db/similar.py)
+    deferred_tasks.spawn(
+        analytics_crud.log_user_activity,
+        user_id=callback.from_user.id,
+        action='download',
+        username=callback.from_user.username,
+        first_name=callback.from_user.first_name,
+        last_name=callback.from_user.last_name,
+        details=str(build_id)
+    )
+    # Обновляем счетчик и превращаем кнопку "Скачать" в ссылку одним
+    # редактированием (раньше: удалить + отправить + сообщение со ссылкой)
+    await handle_callback_build(callback, updated_build, "download", revealed=True, baseline=3)
 
 @router.callback_query(F.data == "download_build")
 async def download_build_fallback_callback(callback: types.CallbackQuery):
@@ -382,130 +447,41 @@ async def download_build_fallback_callback(callback: types.CallbackQuery):
 
 async def send_new_build_message(message: types.Message, build):
     """Отправить новое сообщение с информацией о сборке"""
-    text = format_build_text(build)
-    
-    # Если есть изображение, отправляем как фото с описанием
-    if build.image_url:
-        try:
-            await message.answer_photo(
-                photo=build.image_url,
-                caption=text,
-                reply_markup=get_search_results_keyboard(build_id=build.id),
-                parse_mode="HTML"
-            )
-            return
-        except Exception as e:
-            logging.error(f"Error sending photo, falling back to text: {e}")
-    
-    # Fallback - обычное текстовое сообщение
-    await message.answer(
-        text,
-        reply_markup=get_search_results_keyboard(build.id),
-        parse_mode="HTML",
-        disable_web_page_preview=True
-    )
-
-async def edit_build_message(message: types.Message, build):
-    """Отредактировать сообщение с информацией о сборке"""
-    text = format_build_text(build)
-    
-    await message.edit_text(
-        text,
-        reply_markup=get_search_results_keyboard(build.id),
-        parse_mode="HTML",
-        disable_web_page_preview=True
-    )
+    await renderer.send_build(message, build, "random_message")
 
-    # ОБЩАЯ ФУНКЦИЯ ДЛЯ ФОРМАТИРОВАНИЯ ТЕКСТА
-def format_build_text(build):
-    """Форматировать текст сборки"""
-    type_display = {
-        BuildType.SURVIVAL: "🏕️ Выживание",
-        BuildType.ADVENTURE: "🗺️ Приключение/РПГ",
-        BuildType.HARDCORE: "💀 Хардкор", 
-        BuildType.PUZZLE: "🧩 Пазл/Головоломка",
-        BuildType.CREATIVE: "🎨 Творчество",
-        BuildType.MINIGAME: "🎯 Мини-игры"
-    }.get(build.build_type, build.build_type.value)
-    
-    style_display = {
-        BuildStyle.FANTASY: "🧙‍♂️ Фэнтези",
-        BuildStyle.MEDIEVAL: "🏰 Средневековье",
-        BuildStyle.POSTAPOCALYPTIC: "☢️ Постапокалипсис",
-        BuildStyle.SCI_FI: "🚀 Техно/Научная фантастика", 
-        BuildStyle.MODERN: "🏙️ Современный мир",
-        BuildStyle.FAIRYTALE: "🌈 Сказочный/Мультяшный"
-    }.get(build.style, build.style.value)
-    
-    difficulty_display = {
-        Difficulty.BEGINNER: "🟢 Для новичков",
-        Difficulty.INTERMEDIATE: "🟡 Средняя",
-        Difficulty.EXPERT: "🔴 Для экспертов"
-    }.get(build.difficulty, build.difficulty.value)
-    
-    # Добавляем отображение рейтинга
-    rating_display = f"⭐ {build.rating}/5" if build.rating > 0 else "☆ Еще нет оценок"
-    
-    return (
-        f"🎲 <b>{build.name}</b>\n\n"
-        f"{build.description}\n\n"
-        f"🔹 <b>Тип:</b> {type_display}\n"
-        f"🔹 <b>Стиль:</b> {style_display}\n" 
-        f"🔹 <b>Сложность:</b> {difficulty_display}\n"
-        f"🔹 <b>Скачиваний:</b> {build.downloads_count}\n"
-        f"🔹 <b>Рейтинг:</b> {rating_display} ({build.votes_count} оценок)\n"
-        f"🔹 <b>ID сборки:</b> {build.id}\n\n"
-    )
-
-
-async def show_build_details(message: types.Message, build, similar_builds=None):
-    """Показать детали сборки (отправляет новое сообщение)"""
+async def show_build_details(callback: types.CallbackQuery, build, similar_builds=None):
+    """Показать сборку кратко и список похожих сборок (вместо текущего сообщения)"""
     # Форматируем тип, стиль и сложность для красивого отображения
-    type_display = {
-        BuildType.SURVIVAL: "🏕️ Выживание",
-        BuildType.ADVENTURE: "🗺️ Приключение/РПГ",
-        BuildType.HARDCORE: "💀 Хардкор", 
-        BuildType.PUZZLE: "🧩 Пазл/Головоломка",
-        BuildType.CREATIVE: "🎨 Творчество",
-        BuildType.MINIGAME: "🎯 Мини-игры"
-    }.get(build.build_type, build.build_type.value)
-    
-    style_display = {
-        BuildStyle.FANTASY: "🧙‍♂️ Фэнтези",
-        BuildStyle.MEDIEVAL: "🏰 Средневековье",
-        BuildStyle.POSTAPOCALYPTIC: "☢️ Постапокалипсис",
-        BuildStyle.SCI_FI: "🚀 Техно/Научная фантастика", 
-        BuildStyle.MODERN: "🏙️ Современный мир",
-        BuildStyle.FAIRYTALE: "🌈 Сказочный/Мультяшный"
-    }.get(build.style, build.style.value)
-    
-    difficulty_display = {
-        Difficulty.BEGINNER: "🟢 Для новичков",
-        Difficulty.INTERMEDIATE: "🟡 Средняя",
-        Difficulty.EXPERT: "🔴 Для экспертов"
-    }.get(build.difficulty, build.difficulty.value)
+    type_display = TYPE_DISPLAY.get(build.build_type, build.build_type.value)
+    style_display = STYLE_DISPLAY.get(build.style, build.style.value)
+    difficulty_display = DIFFICULTY_DISPLAY.get(build.difficulty, build.difficulty.value)
     
     text = (
         f"🎲 <b>{build.name}</b>\n\n"
-        f"{build.description}\n\n"
         f"🔹 <b>Тип:</b> {type_display}\n"
         f"🔹 <b>Стиль:</b> {style_display}\n" 
         f"🔹 <b>Сложность:</b> {difficulty_display}\n"
         f"🔹 <b>Скачиваний:</b> {build.downloads_count}\n\n"
     )
     
-    # Всегда отправляем новое сообщение
-    await message.answer(
-        text,
-        reply_markup=get_search_results_keyboard(),
-        parse_mode="HTML",
-        disable_web_page_preview=True
+    if similar_builds:
+        text += "🧩 <b>Похожие сборки:</b>\n"
+        for similar in similar_builds:
+            similar_type = TYPE_DISPLAY.get(similar.build_type, similar.build_type.value)
+            similar_style = STYLE_DISPLAY.get(similar.style, similar.style.value)
+            text += f"• {similar.name} - {similar_type}, {similar_style}\n"
+    else:
+        text += "🧩 Похожих сборок пока нет - загляните позже."
+    
+    # На сообщении с фото список встает в подпись - без удаления и новой отправки
+    await renderer.show_text(
+        callback, text, get_similar_builds_keyboard(build.id, similar_builds or []), "similar"
     )
 
 async def show_random_build(message: types.Message):
     """Показать случайную сборку из БД (для reply-кнопок)"""
     try:
-        build = await build_crud.get_random_build()
+        build = await discovery.next_build(message.from_user.id)
         if build:
             # Для reply-кнопок отправляем новое сообщение
             await send_new_build_message(message, build)
@@ -527,7 +503,7 @@ async def show_filters_menu(message: types.Message):
     user_id = message.from_user.id
     await message.answer(
         f"🔍 <b>Подбор сборки по фильтрам</b>\n\n"
-        f"{UserFilters.get_active_filters_text(user_id)}\n\n"
+        f"{await UserFilters.get_active_filters_text(user_id)}\n\n"
         f"Выбери параметры для поиска идеальной сборки:",
         reply_markup=get_filters_keyboard(),
         parse_mode="HTML"
@@ -573,10 +549,10 @@ async def rate_build_callback(callback: types.CallbackQuery):
             user_vote = await build_crud.get_user_vote(build_id, callback.from_user.id)
             user_rating = user_vote.rating if user_vote else None
             
-            await callback.message.edit_reply_markup(
-                reply_markup=get_rating_keyboard(build_id, user_rating)
-            )
             await callback.answer("Выберите оценку от 1 до 5 звезд")
+            await renderer.show_keyboard(
+                callback, get_rating_keyboard(build_id, user_rating), "rate_menu"
+            )
             return
         
         # Проверяем валидность оценки
@@ -587,20 +563,22 @@ async def rate_build_callback(callback: types.CallbackQuery):
         # Добавляем оценку
         result = await build_crud.add_vote(build_id, callback.from_user.id, rating)
         
-        if result['success']:
-            # Обновляем сообщение с новым рейтингом
-            build = await build_crud.get_build_by_id(build_id)
-            await edit_build_message(callback.message, build)
-            await callback.answer(f"✅ Спасибо за оценку! Вы поставили {rating}⭐")
-        else:
+        if not result['success']:
             if result['error'] == 'already_voted':
                 await callback.answer("❌ Вы уже оценили эту сборку!", show_alert=True)
             else:
                 await callback.answer("❌ Ошибка при оценке сборки", show_alert=True)
+            return
                 
     except Exception as e:
         logging.error(f"Error rating build: {e}")
         await callback.answer("❌ Ошибка при оценке сборки", show_alert=True)
+        return
+    
+    # Голос записан - отвечаем, потом обновляем сообщение с новым рейтингом
+    await callback.answer(f"✅ Спасибо за оценку! Вы поставили {rating}⭐")
+    build = await build_crud.get_build_by_id(build_id)
+    await handle_callback_build(callback, build, "rate", baseline=1)
 
 @router.callback_query(F.data.startswith("rating_stats_"))
 async def rating_stats_callback(callback: types.CallbackQuery):
@@ -627,23 +605,35 @@ async def rating_stats_callback(callback: types.CallbackQuery):
                 bar = "█" * int(percentage / 10)  # Простая визуализация
                 stats_text += f"{'⭐' * star}{'☆' * (5-star)}: {count} {bar} ({percentage:.1f}%)\n"
         
-        #удаляем старое сообщение, если возможно
-        try:
-            await callback.message.delete()
-        except Exception as e:
-            logging.warning(f"Не удалось удалить старое сообщение: {e}")
-
-        await callback.message.answer(
-            stats_text,
-            reply_markup=get_rating_stats_keyboard(build_id),
-            parse_mode="HTML"
-        )
         await callback.answer()
+        # На сообщении с фото статистика встает в подпись - без удаления и новой отправки
+        await renderer.show_text(
+            callback, stats_text, get_rating_stats_keyboard(build_id), "rating_stats"
+        )
         
     except Exception as e:
         logging.error(f"Error showing rating stats: {e}")
         await callback.answer("❌ Ошибка при получении статистики", show_alert=True)
 
+@router.callback_query(F.data.startswith("similar_"))
+async def similar_builds_callback(callback: types.CallbackQuery):
+    """Обработчик кнопки "Похожие сборки" (соседи посчитаны заранее, см. db/similar.py)"""
+    try:
+        build_id = int(callback.data.replace("similar_", ""))
+        build = await build_crud.get_build_by_id(build_id)
+        
+        if not build:
+            await callback.answer("❌ Сборка не найдена", show_alert=True)
+            return
+        
+        similar_builds = await build_crud.get_similar_builds(build_id)
+        await callback.answer()
+        await show_build_details(callback, build, similar_builds)
+        
+    except Exception as e:
+        logging.error(f"Error showing similar builds: {e}")
+        await callback.answer("❌ Ошибка при поиске похожих сборок", show_alert=True)
+
 @router.callback_query(F.data.startswith("back_to_build_"))
 async def back_to_build_callback(callback: types.CallbackQuery):
     """Обработчик возврата к сборке из статистики"""
@@ -652,7 +642,8 @@ async def back_to_build_callback(callback: types.CallbackQuery):
         build = await build_crud.get_build_by_id(build_id)
         
         if build:
-            await handle_callback_build(callback, build)
+            await callback.answer()
+            await handle_callback_build(callback, build, "back_to_build")
         else:
             await callback.answer("❌ Сборка не найдена", show_alert=True)
             
@@ -685,11 +676,15 @@ async def showcase_handler(message: types.Message):
         text += f"\n{build.description}\n"
     text += f"\n❤️ <b>Лайков:</b> {build.likes_count}"
     
-    await message.answer_photo(
-        photo=build.image_url,
+    sent = await photo_sender.answer_photo(
+        message,
+        build,
+        showcase_crud,
         caption=text,
         reply_markup=get_showcase_keyboard(build.id)
     )
+    if not sent:
+        await message.answer(text, reply_markup=get_showcase_keyboard(build.id))
 
 # Callback для лайка
 @router.callback_query(F.data.startswith("like_build_"))
@@ -697,12 +692,15 @@ async def like_build_callback(callback: types.CallbackQuery):
     """Обработчик лайка постройки"""
     build_id = int(callback.data.replace("like_build_", ""))
     
-    success = await showcase_crud.like_build(build_id, callback.from_user.id)
-    
-    if success:
-        await callback.answer("❤️ Лайк поставлен!")
-    else:
+    # Проверка повторного лайка нужна для ответа, сама запись - в фоне
+    if not await showcase_crud.reserve_like(build_id, callback.from_user.id):
         await callback.answer("❌ Вы уже лайкали эту постройку")
+        return
+    
+    await callback.answer("❤️ Лайк поставлен!")
+    if not deferred_tasks.spawn(showcase_crud.like_build, build_id, callback.from_user.id):
+        # Фоновых задач слишком много - лайк не теряем, пишем сами
+        await showcase_crud.like_build(build_id, callback.from_user.id)
 
 # Callback для следующей постройки
 @router.callback_query(F.data == "next_showcase")
@@ -711,22 +709,27 @@ async def next_showcase_callback(callback: types.CallbackQuery):
     build = await showcase_crud.get_random_showcase()
     
     if build:
+        await callback.answer()
         text = f"🏗️ <b>Постройка от пользователя</b>\n"
         if build.description:
             text += f"\n{build.description}\n"
         text += f"\n❤️ <b>Лайков:</b> {build.likes_count}"
         
-        await callback.message.answer_photo(photo=build.image_url, caption=text, parse_mode="HTML", reply_markup=get_showcase_keyboard(build.id))
+        sent = await photo_sender.answer_photo(
+            callback.message, build, showcase_crud,
+            caption=text, parse_mode="HTML", reply_markup=get_showcase_keyboard(build.id)
+        )
+        if not sent:
+            await callback.message.answer(text, parse_mode="HTML", reply_markup=get_showcase_keyboard(build.id))
         
     else:
         await callback.answer("❌ Больше построек нет")
-    
-    await callback.answer()
 
 # Начало добавления постройки
 @router.callback_query(F.data == "add_showcase")
 async def add_showcase_start(callback: types.CallbackQuery, state: FSMContext):
     """Начать процесс добавления постройки"""
+    await callback.answer()
     await callback.message.answer(
         "🏗️ <b>Добавление постройки</b>\n\n"
         "Отправь ссылку на изображение твоей постройки:",
@@ -734,7 +737,6 @@ async def add_showcase_start(callback: types.CallbackQuery, state: FSMContext):
         parse_mode="HTML"
     )
     await state.set_state(ShowcaseStates.waiting_showcase_image)
-    await callback.answer()
 
 # Обработчик изображения
 @router.message(ShowcaseStates.waiting_showcase_image)
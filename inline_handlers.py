@@ -0,0 +1,96 @@
+import os
+
+from aiogram import Router, types
+
+from cards import get_build_card
+from db.cache import inline_cache
+from db.crud import build_crud, search_terms
+from keyboards import get_inline_result_keyboard
+from media import photo_sender
+
+
+# Создаем роутер для инлайн-режима (@бот запрос в любом чате)
+inline_router = Router()
+
+INLINE_PAGE_SIZE = int(os.getenv('INLINE_PAGE_SIZE', 20))
+# Сколько секунд Telegram отдает ответ на тот же запрос сам, не спрашивая бота
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 300))
+DESCRIPTION_PREVIEW = 100
+
+
+def inline_result(build) -> types.InlineQueryResult:
+    """Результат инлайн-запроса: фото с подписью, если file_id уже есть, иначе текст"""
+    card = get_build_card(build)
+    keyboard = get_inline_result_keyboard(build.download_url)
+    description = build.description
+    if len(description) > DESCRIPTION_PREVIEW:
+        description = description[:DESCRIPTION_PREVIEW] + "…"
+
+    file_id = photo_sender.cached_file_id(build)
+    if file_id and card.as_photo:
+        # Фото уже на серверах Telegram - в чат уйдет без загрузки по URL
+        return types.InlineQueryResultCachedPhoto(
+            id=f"build_{build.id}",
+            photo_file_id=file_id,
+            title=build.name,
+            description=description,
+            caption=card.text,
+            parse_mode="HTML",
+            reply_markup=keyboard
+        )
+
+    return types.InlineQueryResultArticle(
+        id=f"build_{build.id}",
+        title=build.name,
+        description=description,
+        input_message_content=types.InputTextMessageContent(
+            message_text=card.text,
+            parse_mode="HTML",
+            disable_web_page_preview=True
+        ),
+        reply_markup=keyboard,
+        thumbnail_url=build.image_url if photo_sender.can_send(build) else None
+    )
+
+
+async def get_inline_page(query: str, offset: int) -> tuple:
+    """(результаты, next_offset) для нормализованного запроса"""
+    if not query:
+        # Пустой запрос - топ по скачиваниям, без продолжения
+        builds = await build_crud.get_top_builds(limit=INLINE_PAGE_SIZE) if offset == 0 else []
+        return [inline_result(build) for build in builds], ""
+
+    # Смещение - по ID из индекса: удаленная сборка не обрывает и не сдвигает выдачу
+    build_ids = await build_crud.search_build_ids(query, offset=offset, limit=INLINE_PAGE_SIZE)
+    builds = await build_crud.get_builds_by_ids(build_ids)
+    next_offset = str(offset + len(build_ids)) if len(build_ids) == INLINE_PAGE_SIZE else ""
+    return [inline_result(build) for build in builds], next_offset
+
+
+@inline_router.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    """Поиск сборок из любого чата: @бот <запрос>
+
+    Запрос приходит на каждое изменение текста, поэтому ответы кэшируются
+    дважды: Telegram хранит их cache_time секунд, а у бота - inline_cache
+    по нормализованному запросу ("Замок  Драконы" и "замок драконы" -
+    один ключ) и смещению. Следующие страницы Telegram запрашивает сам по
+    next_offset, когда пользователь долистывает список.
+    """
+    query = " ".join(search_terms(inline_query.query))
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    key = (query, offset)
+    page = inline_cache.get(key)
+    if page is None:
+        page = await get_inline_page(query, offset)
+        inline_cache.set(key, page)
+    results, next_offset = page
+
+    # Результаты одинаковы для всех пользователей - Telegram может делить кэш между ними
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=next_offset
+    )
@@ -106,16 +106,32 @@ def get_difficulty_keyboard():
     ]
     return types.InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-def get_search_results_keyboard(build_id: int = None):
-    """Клавиатура для результатов поиска"""
+def get_search_results_keyboard(build_id: int = None, download_url: str = None, page: tuple = None):
+    """Клавиатура для результатов поиска
+    
+    download_url - ссылка уже выдана (скачивание засчитано), кнопка "Скачать"
+    открывает ее напрямую.
+    page - (ID поиска, номер результата, всего результатов): кнопки листания
+    результатов подбора по фильтрам (см. search_results.py).
+    """
     keyboard = []
     
+    if download_url:
+        download_button = types.InlineKeyboardButton(text="📥 Скачать", url=download_url)
+    else:
+        download_button = types.InlineKeyboardButton(text="📥 Скачать", callback_data=f"download_{build_id}")
+    
     # Кнопки основного действия
     if build_id:
         keyboard.extend([
-            [types.InlineKeyboardButton(text="📥 Скачать", callback_data=f"download_{build_id}")],
+            [download_button],
             [types.InlineKeyboardButton(text="⭐ Оценить сборку", callback_data=f"rate_{build_id}_0")],
             [types.InlineKeyboardButton(text="📊 Статистика рейтинга", callback_data=f"rating_stats_{build_id}")],
+            [types.InlineKeyboardButton(text="🧩 Похожие сборки", callback_data=f"similar_{build_id}")],
+        ])
+        if page:
+            keyboard.append(get_results_navigation_row(*page))
+        keyboard.extend([
             [types.InlineKeyboardButton(text="🎲 Другая случайная", callback_data="random_another")],
             [types.InlineKeyboardButton(text="🔍 Новый поиск", callback_data="new_search")],
         ])
@@ -128,6 +144,29 @@ def get_search_results_keyboard(build_id: int = None):
         
     return types.InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+def get_results_navigation_row(search_id: str, index: int, total: int):
+    """Ряд кнопок ◀️ N/M ▶️ для листания результатов поиска"""
+    row = []
+    if index > 0:
+        row.append(types.InlineKeyboardButton(text="◀️", callback_data=f"results_{search_id}_{index - 1}"))
+    # Счетчик никуда не ведет - нажатие на него просто показывает тот же результат
+    row.append(types.InlineKeyboardButton(text=f"{index + 1} / {total}", callback_data=f"results_{search_id}_{index}"))
+    if index + 1 < total:
+        row.append(types.InlineKeyboardButton(text="▶️", callback_data=f"results_{search_id}_{index + 1}"))
+    return row
+
+def get_inline_result_keyboard(download_url: str):
+    """Клавиатура карточки, отправленной через инлайн-режим
+
+    У сообщений из инлайн-режима нет message в callback, поэтому только
+    кнопки-ссылки: скачать и продолжить поиск в том же чате.
+    """
+    keyboard = [
+        [types.InlineKeyboardButton(text="📥 Скачать", url=download_url)],
+        [types.InlineKeyboardButton(text="🔎 Найти другие сборки", switch_inline_query_current_chat="")],
+    ]
+    return types.InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 def get_admin_keyboard():
     """Клавиатура админ-панели"""
     keyboard = [
@@ -238,6 +277,15 @@ def get_rating_stats_keyboard(build_id: int):
     ]
     return types.InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+def get_similar_builds_keyboard(build_id: int, similar_builds: list):
+    """Клавиатура похожих сборок: кнопка на каждую и возврат к исходной"""
+    keyboard = [
+        [types.InlineKeyboardButton(text=f"🔹 {build.name}", callback_data=f"back_to_build_{build.id}")]
+        for build in similar_builds
+    ]
+    keyboard.append([types.InlineKeyboardButton(text="⬅️ Назад к сборке", callback_data=f"back_to_build_{build_id}")])
+    return types.InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 def get_showcase_keyboard(build_id: int):
     """Клавиатура для показа построек"""
     keyboard = [
@@ -0,0 +1,142 @@
+import logging
+import time
+from collections import defaultdict
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+from db.cache import broken_image_cache
+
+
+# Ответы Telegram, означающие, что по URL нет пригодной картинки. Прочие ошибки
+# (сеть, 429, разметка подписи) к картинке не относятся - URL не помечаем
+BROKEN_IMAGE_ERRORS = (
+    "failed to get http url content",
+    "wrong file identifier/http url specified",
+    "wrong type of the web page content",
+)
+
+
+def is_broken_image_error(error: Exception) -> bool:
+    """Ошибка из-за содержимого по URL картинки"""
+    return isinstance(error, TelegramBadRequest) and any(
+        text in str(error).lower() for text in BROKEN_IMAGE_ERRORS
+    )
+
+
+class PhotoSender:
+    """Отправка фото сборок и построек с повторным использованием file_id
+
+    Первая успешная отправка по URL заставляет Telegram скачать картинку;
+    file_id из ответа сохраняется в объекте (вместе с URL, из которого он
+    получен), и дальше фото отправляется по file_id без повторной загрузки.
+    Сменился image_url - сохраненный file_id перестает использоваться.
+    URL, которые Telegram не смог загрузить, на время попадают в
+    broken_image_cache, чтобы не тратить на них запрос при каждом показе;
+    при остальных ошибках показывается текст, но URL не помечается.
+    """
+
+    def __init__(self):
+        self.sends = defaultdict(int)       # 'file_id' / 'url' -> успешных отправок
+        self.latency = defaultdict(float)   # 'file_id' / 'url' -> суммарное время, с
+        self.failures = defaultdict(int)
+        self.skipped = 0
+
+    @staticmethod
+    def cached_file_id(item) -> str:
+        """file_id, если он получен для текущего image_url"""
+        if item.image_file_id and item.image_file_url == item.image_url:
+            return item.image_file_id
+        return None
+
+    def can_send(self, item) -> bool:
+        """Есть ли шанс отправить фото (file_id или не помеченный битым URL)"""
+        if self.cached_file_id(item):
+            return True
+        return bool(item.image_url) and item.image_url not in broken_image_cache
+
+    async def answer_photo(self, message: types.Message, item, crud, **kwargs) -> types.Message:
+        """Ответить фото объекта (item.image_url), вернуть сообщение или None
+
+        crud - объект с методом set_image_file_id (build_crud, showcase_crud).
+        None означает, что фото отправить не удалось и нужен текстовый вариант.
+        """
+        async def send(photo):
+            return await message.answer_photo(photo=photo, **kwargs)
+
+        return await self._deliver(item, crud, send)
+
+    async def edit_photo(self, message: types.Message, item, crud, caption: str,
+                         parse_mode: str = None, reply_markup=None) -> types.Message:
+        """Заменить фото и подпись в уже отправленном сообщении (edit_message_media)"""
+        async def send(photo):
+            return await message.edit_media(
+                media=types.InputMediaPhoto(media=photo, caption=caption, parse_mode=parse_mode),
+                reply_markup=reply_markup
+            )
+
+        return await self._deliver(item, crud, send)
+
+    async def _deliver(self, item, crud, send) -> types.Message:
+        file_id = self.cached_file_id(item)
+        if file_id:
+            sent, _ = await self._send(send, 'file_id', file_id)
+            if sent is not None:
+                return sent
+            # file_id мог стать недействительным (например, сменили токен бота) - пробуем по URL
+
+        if not item.image_url:
+            return None
+        if item.image_url in broken_image_cache:
+            self.skipped += 1
+            return None
+
+        sent, error = await self._send(send, 'url', item.image_url)
+        if sent is None:
+            if is_broken_image_error(error):
+                broken_image_cache.set(item.image_url, True)
+            return None
+
+        if isinstance(sent, types.Message) and sent.photo:
+            # Самый большой размер - последний
+            new_file_id = sent.photo[-1].file_id
+            try:
+                await crud.set_image_file_id(item.id, new_file_id, item.image_url)
+            except Exception as e:
+                logging.error(f"Error saving file_id for {item.id}: {e}")
+        return sent
+
+    async def _send(self, send, source: str, photo: str) -> tuple:
+        """(сообщение, None) или (None, ошибка)"""
+        started = time.perf_counter()
+        try:
+            sent = await send(photo)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                # Сообщение уже показывает это фото - картинка тут ни при чем
+                raise
+            self.failures[source] += 1
+            logging.warning(f"Не удалось отправить фото ({source}): {e}")
+            return None, e
+        except Exception as e:
+            self.failures[source] += 1
+            logging.warning(f"Не удалось отправить фото ({source}): {e}")
+            return None, e
+
+        self.sends[source] += 1
+        self.latency[source] += time.perf_counter() - started
+        return sent, None
+
+    def stats(self) -> dict:
+        """Количество и среднее время отправок по file_id и по URL"""
+        return {
+            source: {
+                'sends': self.sends[source],
+                'failures': self.failures[source],
+                'avg_ms': self.latency[source] / self.sends[source] * 1000 if self.sends[source] else 0.0
+            }
+            for source in ('file_id', 'url')
+        } | {'skipped_broken': self.skipped}
+
+
+photo_sender = PhotoSender()
@@ -0,0 +1,205 @@
+import logging
+import os
+import time
+from collections import defaultdict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from db.cache import TTLCache
+from db.session import async_session, current_session, query_counter
+from outbound import priority
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия БД на апдейт
+
+    Сессия доступна обработчикам как аргумент session, а CRUD-методам -
+    через db.session.session_scope(). В конце апдейта изменения
+    коммитятся одним коммитом (или откатываются при ошибке), так что
+    апдейт занимает одно соединение из пула. В профиле SQLite записи
+    фиксируются сразу, см. db.session.commit(). Заодно считаем SQL-запросы
+    на апдейт, чтобы регрессии было видно в логах и статистике.
+    """
+
+    def __init__(self, warn_queries: int = 10):
+        self.warn_queries = warn_queries
+        self.updates = defaultdict(int)   # тип апдейта -> количество
+        self.queries = defaultdict(int)   # тип апдейта -> всего запросов
+        self.max_queries = defaultdict(int)
+
+    async def __call__(self, handler, event: Update, data: dict):
+        async with async_session() as session:
+            session_token = current_session.set(session)
+            counter = [0]
+            counter_token = query_counter.set(counter)
+            try:
+                data['session'] = session
+                result = await handler(event, data)
+                await session.commit()
+                return result
+            except Exception:
+                await session.rollback()
+                raise
+            finally:
+                current_session.reset(session_token)
+                query_counter.reset(counter_token)
+                self._record(event.event_type, counter[0])
+
+    def _record(self, update_type: str, queries: int):
+        self.updates[update_type] += 1
+        self.queries[update_type] += queries
+        self.max_queries[update_type] = max(self.max_queries[update_type], queries)
+
+        if queries > self.warn_queries:
+            logging.warning(f"Update {update_type} made {queries} SQL queries")
+
+    def stats(self) -> dict:
+        """Среднее и максимальное число SQL-запросов по типам апдейтов"""
+        return {
+            update_type: {
+                'updates': count,
+                'avg_queries': self.queries[update_type] / count,
+                'max_queries': self.max_queries[update_type]
+            }
+            for update_type, count in self.updates.items()
+        }
+
+
+db_session_middleware = DbSessionMiddleware(
+    warn_queries=int(os.getenv('DB_QUERIES_WARN', 10))
+)
+
+
+# Класс действия -> (пополнение токенов в секунду, емкость корзины)
+THROTTLE_RULES = {
+    # ORDER BY random и отрисовка карточки
+    'random': (float(os.getenv('THROTTLE_RANDOM_RATE', 1)), int(os.getenv('THROTTLE_RANDOM_BURST', 4))),
+    # Звезды и лайки: поиск голоса и запись
+    'vote': (float(os.getenv('THROTTLE_VOTE_RATE', 0.5)), int(os.getenv('THROTTLE_VOTE_BURST', 4))),
+    # Инлайн-запросы приходят на каждое изменение текста в поле ввода
+    'inline': (float(os.getenv('THROTTLE_INLINE_RATE', 3)), int(os.getenv('THROTTLE_INLINE_BURST', 20))),
+    # Все остальное - только от явного флуда
+    'default': (float(os.getenv('THROTTLE_DEFAULT_RATE', 3)), int(os.getenv('THROTTLE_DEFAULT_BURST', 10))),
+}
+
+RANDOM_TEXTS = {"🎲 Случайная сборка", "/random_build"}
+RANDOM_CALLBACKS = {"random_another", "filter_search", "next_showcase"}
+VOTE_CALLBACK_PREFIXES = ("like_build_",)
+
+
+def action_class(event: Update) -> str:
+    """Класс действия апдейта для лимитов"""
+    if event.callback_query:
+        data = event.callback_query.data or ""
+        if data in RANDOM_CALLBACKS:
+            return 'random'
+        # rate_<id>_<1..5> - звезда, rate_<id>_0 - только открыть меню оценки
+        if data.startswith(VOTE_CALLBACK_PREFIXES) or (data.startswith("rate_") and not data.endswith("_0")):
+            return 'vote'
+    elif event.message and event.message.text in RANDOM_TEXTS:
+        return 'random'
+    elif event.inline_query:
+        return 'inline'
+    return 'default'
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Защита от флуда: корзина токенов на пользователя и класс действия
+
+    Стоит перед DbSessionMiddleware, поэтому лишние апдейты не открывают
+    сессию и не доходят до БД и Bot API:
+      throttled - в корзине нет токена; на нажатие кнопки отвечаем
+                  всплывающим "не так быстро", сообщения отбрасываем молча;
+      coalesced - эта же кнопка этого же сообщения еще обрабатывается -
+                  повторное нажатие склеивается с ней (сообщения не
+                  склеиваем: в них может быть текст для обратной связи).
+    Корзины хранятся в ограниченном TTLCache: простаивающая корзина
+    все равно полная, так что ее вытеснение ничего не меняет.
+    """
+
+    def __init__(self, rules: dict, maxsize: int = 100000, slow_down_text: str = "⏳ Не так быстро!"):
+        self.rules = rules
+        self.slow_down_text = slow_down_text
+        # Через capacity / rate секунд простоя корзина снова полная
+        idle = max(capacity / rate for rate, capacity in rules.values())
+        self.buckets = TTLCache(maxsize=maxsize, ttl=idle)  # (user_id, класс) -> (токены, время)
+        self.in_flight = set()
+
+        self.passed = defaultdict(int)  # класс -> пропущено
+        self.shed = defaultdict(int)    # (класс, причина) -> отброшено
+
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        action = action_class(event)
+        if not event.callback_query:
+            if not self._take_token(user.id, action):
+                return await self._shed(event, action, 'throttled')
+            self.passed[action] += 1
+            return await handler(event, data)
+
+        key = (user.id, event.callback_query.message.message_id if event.callback_query.message else None,
+               event.callback_query.data)
+        if key in self.in_flight:
+            return await self._shed(event, action, 'coalesced')
+        if not self._take_token(user.id, action):
+            return await self._shed(event, action, 'throttled')
+
+        self.passed[action] += 1
+        self.in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(key)
+
+    def _take_token(self, user_id: int, action: str) -> bool:
+        rate, capacity = self.rules[action]
+        now = time.monotonic()
+        tokens, updated = self.buckets.get((user_id, action), (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self.buckets.set((user_id, action), (tokens, now))
+            return False
+        self.buckets.set((user_id, action), (tokens - 1, now))
+        return True
+
+    async def _shed(self, event: Update, action: str, reason: str):
+        self.shed[(action, reason)] += 1
+        if event.callback_query:
+            # Без ответа у пользователя крутятся "часики" на кнопке
+            try:
+                await event.callback_query.answer(self.slow_down_text)
+            except Exception as e:
+                logging.debug(f"Не удалось ответить на лишнее нажатие: {e}")
+        return None
+
+    def stats(self) -> dict:
+        """Пропущенные и отброшенные апдейты по классам действий"""
+        return {
+            action: {
+                'passed': self.passed[action],
+                'throttled': self.shed[(action, 'throttled')],
+                'coalesced': self.shed[(action, 'coalesced')]
+            }
+            for action in self.rules
+        }
+
+
+class OutboundPriorityMiddleware(BaseMiddleware):
+    """Запросы к Bot API из обработчиков роутера идут с заданным приоритетом (см. outbound.py)"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    async def __call__(self, handler, event, data: dict):
+        with priority(self.name):
+            return await handler(event, data)
+
+
+throttling_middleware = ThrottlingMiddleware(
+    THROTTLE_RULES,
+    maxsize=int(os.getenv('THROTTLE_USERS', 100000))
+)
@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from db.cache import TTLCache
+
+
+# Классы исходящих запросов: меньше - важнее
+PRIORITIES = {'interactive': 0, 'admin': 1, 'bulk': 2}
+
+# Класс запросов текущей задачи (рассылка выставляет bulk, админка - admin)
+outbound_priority: ContextVar[str] = ContextVar('outbound_priority', default='interactive')
+
+
+@contextmanager
+def priority(name: str):
+    """Отправлять запросы внутри блока с указанным приоритетом"""
+    token = outbound_priority.set(name)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+
+class ChatRateLimiter:
+    """Лимит сообщений в один чат: корзина с резервированием
+
+    Токен резервируется сразу (баланс может уйти в минус), а запрос ждет,
+    пока резерв не покроется пополнением - без задач и очередей на чат.
+    """
+
+    def __init__(self, rate: float, capacity: float, maxsize: int = 100000, ttl: float = 3600):
+        self.rate = rate
+        self.capacity = capacity
+        # ttl с запасом больше возможной паузы RetryAfter: истекшая запись - полная корзина
+        self.buckets = TTLCache(maxsize=maxsize, ttl=ttl)  # chat_id -> (токены, время)
+
+    def reserve(self, chat_id) -> float:
+        """Занять токен, вернуть сколько секунд подождать перед отправкой"""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(chat_id, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate) - 1
+        self.buckets.set(chat_id, (tokens, now))
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+    def pause(self, chat_id, seconds: float):
+        """Telegram попросил подождать с этим чатом (RetryAfter)"""
+        self.buckets.set(chat_id, (-seconds * self.rate, time.monotonic()))
+
+
+class PriorityRateLimiter:
+    """Общий лимит запросов: свободный токен получает самый важный ожидающий
+
+    Пока токены есть и очереди нет, запрос проходит сразу. Иначе он ждет в
+    куче (приоритет, номер), и фоновая задача раздает токены по мере
+    пополнения: интерактивные ответы обгоняют админку, админка - рассылку.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []  # (приоритет, номер, future)
+        self._counter = itertools.count()
+        self._task = None
+
+    async def acquire(self, priority: int):
+        self._refill()
+        if not self._waiters and self._tokens >= 1 and time.monotonic() >= self._paused_until:
+            self._tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._grant())
+        await future
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (глобальный RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def _grant(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                self._updated = time.monotonic()
+                continue
+
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():  # запрос могли отменить, пока он ждал
+                self._tokens -= 1
+                future.set_result(None)
+
+
+class ScheduledSession(AiohttpSession):
+    """Сессия бота с общим планировщиком исходящих запросов
+
+    Все запросы к Bot API (обработчики, рассылка, пересылка обращений
+    администратору) проходят через одни лимиты:
+      - общий лимит сообщений в секунду с приоритетами (outbound_priority);
+      - лимит на чат: в личку около 1 сообщения в секунду с небольшим
+        запасом, в группы - 20 в минуту;
+      - RetryAfter: запрос ждет сколько сказал Telegram и повторяется
+        (до max_retries раз), а чат ставится на паузу, чтобы следом не
+        полетели новые 429. Общий лимит встает на паузу, только если 429
+        за retry_window секунд пришли из global_retry_chats разных чатов -
+        тогда это общий флуд-контроль бота, а не лимит одного чата.
+    Лимиты касаются только методов с chat_id (отправка и правка
+    сообщений); answerCallbackQuery, getUpdates и т.п. идут без очереди.
+    """
+
+    def __init__(self, global_rate: float = 28, private_rate: float = 1, private_burst: float = 5,
+                 group_rate: float = 20 / 60, group_burst: float = 3, max_retries: int = 3,
+                 global_retry_chats: int = 3, retry_window: float = 5, limit: int = 100, keepalive_timeout: float = 60, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        # Все запросы идут на api.telegram.org - держим соединения открытыми между апдейтами
+        self._connector_init.update(
+            limit_per_host=limit,
+            keepalive_timeout=keepalive_timeout,
+            enable_cleanup_closed=True
+        )
+        # Без запаса на всплеск: Telegram считает сообщения за скользящую секунду
+        self.global_limiter = PriorityRateLimiter(global_rate, capacity=1)
+        self.private_limiter = ChatRateLimiter(private_rate, private_burst)
+        self.group_limiter = ChatRateLimiter(group_rate, group_burst)
+        self.max_retries = max_retries
+        self.global_retry_chats = global_retry_chats
+        self.retry_window = retry_window
+        self._retry_chats = {}  # chat_id -> время последнего RetryAfter
+
+        self.requests = defaultdict(int)     # класс -> запросов через очередь
+        self.wait_total = defaultdict(float)  # класс -> суммарное ожидание, с
+        self.wait_max = defaultdict(float)
+        self.retry_after = defaultdict(int)
+        self.global_pauses = 0
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int = None):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await super().make_request(bot, method, timeout)
+
+        name = outbound_priority.get()
+        chat_limiter = self._chat_limiter(chat_id)
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            delay = chat_limiter.reserve(chat_id)
+            if delay:
+                await asyncio.sleep(delay)
+            await self.global_limiter.acquire(PRIORITIES.get(name, 0))
+            self._record(name, time.monotonic() - started)
+
+            try:
+                return await super().make_request(bot, method, timeout)
+            except TelegramRetryAfter as e:
+                self.retry_after[name] += 1
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"RetryAfter {e.retry_after}s for chat {chat_id} ({name}), requeueing")
+                chat_limiter.pause(chat_id, e.retry_after)
+                if self._global_retry(chat_id):
+                    # 429 сразу во многих чатах - флуд-контроль общий для бота, притормаживаем всех
+                    self.global_pauses += 1
+                    self.global_limiter.pause(e.retry_after)
+
+    def _global_retry(self, chat_id) -> bool:
+        """Учесть RetryAfter чата, True - за retry_window их получили global_retry_chats чатов"""
+        now = time.monotonic()
+        self._retry_chats = {
+            chat: at for chat, at in self._retry_chats.items() if now - at < self.retry_window
+        }
+        self._retry_chats[chat_id] = now
+        return len(self._retry_chats) >= self.global_retry_chats
+
+    def _chat_limiter(self, chat_id) -> ChatRateLimiter:
+        # Группы и каналы - отрицательные ID и @username
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.private_limiter
+        return self.group_limiter
+
+    def _record(self, name: str, waited: float):
+        self.requests[name] += 1
+        self.wait_total[name] += waited
+        self.wait_max[name] = max(self.wait_max[name], waited)
+
+    def stats(self) -> dict:
+        """Ожидание в очереди по классам запросов"""
+        return {
+            name: {
+                'requests': self.requests[name],
+                'avg_wait_ms': self.wait_total[name] / self.requests[name] * 1000 if self.requests[name] else 0.0,
+                'max_wait_ms': self.wait_max[name] * 1000,
+                'retry_after': self.retry_after[name]
+            }
+            for name in PRIORITIES
+        } | {'waiting': self.global_limiter.waiting(), 'global_pauses': self.global_pauses}
+
+
+def create_session(processes: int = 1, broadcasts: bool = True) -> ScheduledSession:
+    """Сессия бота с лимитами из окружения
+
+    processes - сколько процессов бота работает одновременно (workers.py):
+    общий лимит Telegram делится между ними. Рассылки идут только из
+    процесса с шардом администратора (broadcasts), поэтому ему отдается
+    доля OUTBOUND_BULK_SHARE общего лимита, а остаток поровну делят ответы
+    пользователям во всех процессах. Лимиты на чат не делятся - чат
+    пользователя обслуживает один процесс.
+    """
+    # Чуть ниже ~30 сообщ./с, после которых Telegram отвечает 429
+    global_rate = float(os.getenv('OUTBOUND_GLOBAL_RATE', 28))
+    if processes > 1:
+        bulk_rate = global_rate * float(os.getenv('OUTBOUND_BULK_SHARE', 0.8))
+        global_rate = (global_rate - bulk_rate) / processes + (bulk_rate if broadcasts else 0)
+    return ScheduledSession(
+        global_rate=global_rate,
+        private_rate=float(os.getenv('OUTBOUND_PRIVATE_RATE', 1)),
+        private_burst=float(os.getenv('OUTBOUND_PRIVATE_BURST', 5)),
+        group_rate=float(os.getenv('OUTBOUND_GROUP_RATE', 20 / 60)),
+        group_burst=float(os.getenv('OUTBOUND_GROUP_BURST', 3)),
+        max_retries=int(os.getenv('OUTBOUND_MAX_RETRIES', 3)),
+        global_retry_chats=int(os.getenv('OUTBOUND_GLOBAL_RETRY_CHATS', 3)),
+        limit=int(os.getenv('OUTBOUND_CONNECTIONS', 100)),
+        keepalive_timeout=float(os.getenv('OUTBOUND_KEEPALIVE', 60))
+    )
@@ -0,0 +1,213 @@
+import logging
+import os
+from collections import defaultdict
+from dataclasses import dataclass, replace
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+from cards import get_build_card, visible_length, CAPTION_LIMIT
+from db.cache import TTLCache
+from db.crud import build_crud
+from media import photo_sender
+
+
+@dataclass(frozen=True)
+class MessageView:
+    """Что сейчас показывает сообщение бота"""
+    kind: str                                  # 'photo' или 'text'
+    text: str = None                           # None - неизвестно (сообщение из прошлого запуска)
+    keyboard: types.InlineKeyboardMarkup = None
+    photo: str = None                          # image_url показанной картинки
+
+
+class MessageRenderer:
+    """Переходы между экранами с минимальным числом вызовов Bot API
+
+    Для каждого сообщения бота помним, что оно показывает, и выбираем
+    самый дешевый способ показать новый экран:
+      ничего не изменилось          - 0 вызовов;
+      изменилась только клавиатура  - edit_message_reply_markup;
+      изменился текст/подпись       - edit_message_text / edit_message_caption;
+      другое фото                   - edit_message_media;
+      фото <-> текст                - удалить и отправить заново (2 вызова).
+    Раньше каждый переход был "удалить и отправить" - экономию считаем
+    относительно этого по типам действий.
+    """
+
+    def __init__(self, registry_size: int = 10000, registry_ttl: float = 86400):
+        self.views = TTLCache(maxsize=registry_size, ttl=registry_ttl)  # (chat_id, message_id) -> MessageView
+        self.updates = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.saved = defaultdict(int)
+
+    def current_view(self, message: types.Message) -> MessageView:
+        view = self.views.get((message.chat.id, message.message_id))
+        if view is not None:
+            return view
+        # Сообщение не из нашего реестра - знаем только тип и клавиатуру
+        return MessageView(
+            kind='photo' if message.photo else 'text',
+            keyboard=message.reply_markup
+        )
+
+    def remember(self, message: types.Message, view: MessageView):
+        self.views.set((message.chat.id, message.message_id), view)
+
+    @staticmethod
+    def build_view(build, revealed: bool = False, keyboard: types.InlineKeyboardMarkup = None) -> MessageView:
+        """Экран карточки сборки (revealed - ссылка на скачивание уже выдана)
+
+        keyboard - своя клавиатура вместо клавиатуры карточки (например, с
+        кнопками листания результатов поиска).
+        """
+        card = get_build_card(build)
+        if keyboard is None:
+            keyboard = card.download_keyboard if revealed else card.keyboard
+        if card.as_photo and photo_sender.can_send(build):
+            return MessageView('photo', card.text, keyboard, build.image_url)
+        return MessageView('text', card.text, keyboard)
+
+    async def show_build(self, callback: types.CallbackQuery, build, action: str,
+                         revealed: bool = False, baseline: int = 2,
+                         keyboard: types.InlineKeyboardMarkup = None):
+        """Показать карточку сборки вместо текущего сообщения"""
+        target = self.build_view(build, revealed, keyboard)
+        await self.transition(callback.message, target, action, item=build, baseline=baseline)
+
+    async def show_text(self, callback: types.CallbackQuery, text: str,
+                        keyboard: types.InlineKeyboardMarkup, action: str, baseline: int = 2):
+        """Показать текстовый экран; на сообщении с фото - подписью к тому же фото"""
+        current = self.current_view(callback.message)
+        if current.kind == 'photo' and visible_length(text) <= CAPTION_LIMIT:
+            target = MessageView('photo', text, keyboard, current.photo)
+        else:
+            target = MessageView('text', text, keyboard)
+        await self.transition(callback.message, target, action, baseline=baseline)
+
+    async def show_keyboard(self, callback: types.CallbackQuery,
+                            keyboard: types.InlineKeyboardMarkup, action: str, baseline: int = 1):
+        """Заменить только клавиатуру"""
+        target = replace(self.current_view(callback.message), keyboard=keyboard)
+        await self.transition(callback.message, target, action, baseline=baseline)
+
+    async def send_build(self, message: types.Message, build, action: str,
+                         keyboard: types.InlineKeyboardMarkup = None):
+        """Отправить карточку сборки новым сообщением"""
+        target = self.build_view(build, keyboard=keyboard)
+        calls = await self._send(message, target, build)
+        self._record(action, calls, baseline=calls)
+
+    async def transition(self, message: types.Message, target: MessageView, action: str,
+                         item=None, baseline: int = 2):
+        current = self.current_view(message)
+        calls = 0
+        try:
+            calls = await self._edit(message, current, target, item)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                calls = 1
+                self.remember(message, target)
+            else:
+                logging.warning(f"Не удалось отредактировать сообщение, отправляем заново: {e}")
+                calls = 1 + await self._resend(message, target, item)
+        self._record(action, calls, baseline)
+
+    async def _edit(self, message: types.Message, current: MessageView, target: MessageView, item) -> int:
+        """Отредактировать сообщение на месте, вернуть число вызовов API"""
+        if current.kind != target.kind:
+            # Текстовое сообщение нельзя превратить в фото и наоборот
+            return await self._resend(message, target, item)
+
+        if target.kind == 'photo' and target.photo != current.photo:
+            edited = await photo_sender.edit_photo(
+                message, item, build_crud,
+                caption=target.text,
+                parse_mode="HTML",
+                reply_markup=target.keyboard
+            )
+            if edited is None:
+                # Новое фото загрузить не удалось - показываем текстом
+                return 1 + await self._resend(message, replace(target, kind='text', photo=None), item)
+            self.remember(message, target)
+            return 1
+
+        if target.text != current.text:
+            if target.kind == 'photo':
+                await message.edit_caption(
+                    caption=target.text,
+                    parse_mode="HTML",
+                    reply_markup=target.keyboard
+                )
+            else:
+                await message.edit_text(
+                    target.text,
+                    parse_mode="HTML",
+                    reply_markup=target.keyboard,
+                    disable_web_page_preview=True
+                )
+            self.remember(message, target)
+            return 1
+
+        if target.keyboard != current.keyboard:
+            await message.edit_reply_markup(reply_markup=target.keyboard)
+            self.remember(message, target)
+            return 1
+
+        return 0
+
+    async def _resend(self, message: types.Message, target: MessageView, item) -> int:
+        """Удалить сообщение и отправить экран заново"""
+        calls = 1
+        try:
+            await message.delete()
+        except Exception as e:
+            logging.warning(f"Не удалось удалить старое сообщение: {e}")
+        self.views.invalidate((message.chat.id, message.message_id))
+        return calls + await self._send(message, target, item)
+
+    async def _send(self, message: types.Message, target: MessageView, item) -> int:
+        calls = 0
+        if target.kind == 'photo' and item is not None:
+            calls += 1
+            sent = await photo_sender.answer_photo(
+                message, item, build_crud,
+                caption=target.text,
+                reply_markup=target.keyboard,
+                parse_mode="HTML"
+            )
+            if sent:
+                self.remember(sent, target)
+                return calls
+            target = replace(target, kind='text', photo=None)
+
+        sent = await message.answer(
+            target.text,
+            reply_markup=target.keyboard,
+            parse_mode="HTML",
+            disable_web_page_preview=True
+        )
+        self.remember(sent, target)
+        return calls + 1
+
+    def _record(self, action: str, calls: int, baseline: int):
+        self.updates[action] += 1
+        self.calls[action] += calls
+        self.saved[action] += baseline - calls
+
+    def stats(self) -> dict:
+        """Вызовы API и сэкономленные вызовы по типам действий"""
+        return {
+            action: {
+                'updates': count,
+                'calls': self.calls[action],
+                'saved': self.saved[action]
+            }
+            for action, count in self.updates.items()
+        }
+
+
+renderer = MessageRenderer(
+    registry_size=int(os.getenv('MESSAGE_VIEWS_SIZE', 10000)),
+    registry_ttl=float(os.getenv('MESSAGE_VIEWS_TTL', 86400))
+)
@@ -0,0 +1,204 @@
+import asyncio
+import os
+import random
+from dataclasses import dataclass, field
+
+from cards import get_build_card
+from db.cache import TTLCache
+from db.crud import build_crud
+from deferred import deferred_tasks
+from keyboards import get_search_results_keyboard
+
+
+@dataclass
+class ResultCursor:
+    """Листание результатов одного поиска: по фильтрам или по тексту"""
+    search_id: str
+    total: int                               # сколько всего результатов (для N / M)
+    filters: dict = None                     # аргументы build_crud.get_builds_page
+    query: str = None                        # текст для build_crud.search_build_ids
+    ids: list = field(default_factory=list)  # ID уже загруженных результатов по порядку
+    position: int = 0                        # номер показанного результата
+    exhausted: bool = False                  # загружена последняя страница
+    last_id: int = None                      # ID последнего загруженного (для keyset-пагинации)
+    loaded: int = 0                          # сколько ID выдал текстовый поиск (смещение следующей страницы)
+    loading: asyncio.Event = None            # идет загрузка следующей страницы
+
+
+class SearchResults:
+    """Результаты поиска с листанием ◀️ / ▶️
+
+    Результаты загружаются страницами по page_size. Подбор по фильтрам
+    упорядочен по ID (новые сборки первыми) и листается keyset-пагинацией,
+    текстовый поиск (/search) - по релевантности. Для каждого
+    пользователя хранится короткоживущий курсор: ID уже загруженных
+    результатов и текущая позиция. Показ результата кладет в фон прогрев
+    следующей карточки, а когда до конца загруженного остается
+    prefetch_distance результатов - и загрузку следующей страницы. Поэтому
+    листание обычно обходится поиском в кэше, без запроса с фильтрами.
+    """
+
+    def __init__(self, page_size: int = 10, prefetch_distance: int = 3,
+                 maxsize: int = 10000, ttl: float = 600):
+        self.page_size = page_size
+        self.prefetch_distance = prefetch_distance
+        self.cursors = TTLCache(maxsize=maxsize, ttl=ttl)  # user_id -> ResultCursor
+
+        self.searches = 0
+        self.moves = 0
+        self.waited = 0         # листание ждало загрузку страницы
+        self.page_loads = 0
+        self.prefetched = 0     # страницы, загруженные в фоне
+        self.dropped = 0        # результаты, исчезнувшие до показа
+
+    async def start(self, user_id: int, filters: dict = None, query: str = None):
+        """Начать листание результатов, вернуть (первая сборка, курсор) или (None, None)
+
+        Передается либо filters (подбор по фильтрам), либо query (текстовый поиск).
+        """
+        if query is not None:
+            total = await build_crud.count_search_results(query)
+        else:
+            total = await build_crud.count_builds_by_filters(**filters)
+        cursor = ResultCursor(
+            search_id=f"{random.getrandbits(24):x}", total=total, filters=filters, query=query
+        )
+        await self._load_page(cursor)
+        if not cursor.ids:
+            return None, None
+
+        build = await self._show(cursor, 0)
+        if build is None:
+            return None, None
+
+        self.searches += 1
+        self.cursors.set(user_id, cursor)
+        return build, cursor
+
+    async def move(self, user_id: int, search_id: str, index: int):
+        """Перейти к результату index, вернуть (сборка, курсор)
+
+        (None, None) - курсор истек или кнопка от другого поиска,
+        (None, курсор) - такого результата нет.
+        """
+        cursor = self.cursors.get(user_id)
+        if cursor is None or cursor.search_id != search_id:
+            return None, None
+        if index < 0:
+            return None, cursor
+
+        self.moves += 1
+        return await self._show(cursor, index), cursor
+
+    def page(self, user_id: int, build_id: int):
+        """(ID поиска, номер, всего) для клавиатуры, если пользователь листает эту сборку"""
+        cursor = self.cursors.get(user_id)
+        if cursor is None or cursor.position >= len(cursor.ids) or cursor.ids[cursor.position] != build_id:
+            return None
+        return cursor.search_id, cursor.position, cursor.total
+
+    def keyboard(self, user_id: int, build, revealed: bool = False):
+        """Клавиатура карточки с кнопками листания (None - сборка показана не из результатов)"""
+        page = self.page(user_id, build.id)
+        if page is None:
+            return None
+        return get_search_results_keyboard(
+            build.id, download_url=build.download_url if revealed else None, page=page
+        )
+
+    async def _show(self, cursor: ResultCursor, index: int):
+        """Сборка результата index (None - результатов меньше), позиция курсора - на ней"""
+        while True:
+            while index >= len(cursor.ids) and not cursor.exhausted:
+                # Предзагрузка не успела (или ее отбросили) - ждем страницу
+                self.waited += 1
+                await self._load_page(cursor)
+            if index >= len(cursor.ids):
+                return None
+
+            build = await build_crud.get_build_by_id(cursor.ids[index])
+            if build is not None and build.is_approved:
+                break
+            # Сборку удалили или сняли с модерации после загрузки страницы - выкидываем ее
+            del cursor.ids[index]
+            cursor.total = max(cursor.total - 1, len(cursor.ids))
+            if index < cursor.position:
+                cursor.position -= 1
+            self.dropped += 1
+
+        cursor.position = index
+        if index + 1 < len(cursor.ids):
+            deferred_tasks.spawn(self._warm, cursor.ids[index + 1], name='results_warm')
+        if not cursor.exhausted and len(cursor.ids) - index <= self.prefetch_distance:
+            deferred_tasks.spawn(self._prefetch, cursor, name='results_prefetch')
+        return build
+
+    async def _warm(self, build_id: int):
+        """Следующая сборка - в кэше сборок, ее карточка - в кэше карточек"""
+        build = await build_crud.get_build_by_id(build_id)
+        if build is not None:
+            get_build_card(build)
+
+    async def _prefetch(self, cursor: ResultCursor):
+        if await self._load_page(cursor):
+            self.prefetched += 1
+
+    async def _load_page(self, cursor: ResultCursor) -> bool:
+        """Догрузить следующую страницу, False - ее уже грузит другой вызов"""
+        if cursor.loading is not None:
+            await cursor.loading.wait()
+            return False
+        if cursor.exhausted:
+            return False
+
+        cursor.loading = asyncio.Event()
+        try:
+            if cursor.query is not None:
+                # Ранжированный список: страницы по смещению в выдаче индекса. Смещение
+                # считается по выданным ID - выкинутые из ids (_show) его не сдвигают
+                page_ids = await build_crud.search_build_ids(
+                    cursor.query, offset=cursor.loaded, limit=self.page_size, total=cursor.total
+                )
+                cursor.loaded += len(page_ids)
+                # Сборки страницы - в кэш одним запросом; исчезнувшие выкинет _show
+                await build_crud.get_builds_by_ids(page_ids)
+            else:
+                builds = await build_crud.get_builds_page(
+                    **cursor.filters,
+                    before_id=cursor.last_id,
+                    limit=self.page_size
+                )
+                page_ids = [build.id for build in builds]
+                if builds:
+                    cursor.last_id = builds[-1].id
+            self.page_loads += 1
+            cursor.ids.extend(page_ids)
+            if len(page_ids) < self.page_size:
+                cursor.exhausted = True
+                # Пул ID для счетчика мог устареть - верим фактическому числу
+                cursor.total = len(cursor.ids)
+            else:
+                cursor.total = max(cursor.total, len(cursor.ids))
+        finally:
+            cursor.loading.set()
+            cursor.loading = None
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'cursors': len(self.cursors),
+            'searches': self.searches,
+            'moves': self.moves,
+            'waited': self.waited,
+            'page_loads': self.page_loads,
+            'prefetched': self.prefetched,
+            'dropped': self.dropped
+        }
+
+
+search_results = SearchResults(
+    page_size=int(os.getenv('RESULTS_PAGE_SIZE', 10)),
+    prefetch_distance=int(os.getenv('RESULTS_PREFETCH_DISTANCE', 3)),
+    maxsize=int(os.getenv('RESULTS_CURSORS_SIZE', 10000)),
+    ttl=float(os.getenv('RESULTS_CURSOR_TTL', 600))
+)
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+
+WEBHOOK_PATH = "/webhook"
+WORKER_PATH = "/updates"
+
+
+def get_webhook_secret(token: str) -> str:
+    """Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+
+    Берется из WEBHOOK_SECRET, иначе выводится из токена бота - одинаковый
+    во всех процессах и после перезапуска, но не раскрывает сам токен.
+    """
+    return os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Вебхук с обработкой апдейтов в фоне и ограничением числа апдейтов в работе
+
+    Telegram получает 200 сразу, как только апдейт принят в работу. Если в
+    работе уже max_in_flight апдейтов, ответ задерживается до освобождения
+    слота: Telegram не шлет больше max_connections запросов одновременно и
+    сам притормаживает, а задачи и память не растут без предела.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_in_flight: int = 100,
+                 drain_timeout: float = 30.0, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.drain_timeout = drain_timeout
+        self._slots = None
+
+        self.received = 0
+        self.failed = 0
+        self.max_seen = 0
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._accept(bot, update)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _accept(self, bot: Bot, update: dict, after: asyncio.Task = None) -> asyncio.Task:
+        """Запустить обработку апдейта в фоне
+
+        Апдейт без предшественника сразу занимает слот (ожидание слота -
+        обратное давление на отправителя). Апдейт, который ждет предыдущий
+        апдейт пользователя (after), занимает слот только когда дождется:
+        иначе очередь одного пользователя заняла бы все слоты ожиданием.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+
+        if after is None:
+            await self._slots.acquire()
+        self.received += 1
+
+        task = asyncio.create_task(self._process(bot, update, after))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        self.max_seen = max(self.max_seen, len(self._background_feed_update_tasks))
+        return task
+
+    async def _process(self, bot: Bot, update: dict, after: asyncio.Task = None):
+        """after - задача, которая должна завершиться раньше (предыдущий апдейт пользователя)"""
+        acquired = after is None
+        try:
+            if after is not None:
+                await asyncio.wait([after])
+                await self._slots.acquire()
+                acquired = True
+            await self._background_feed_update(bot=bot, update=update)
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Error processing update {update.get('update_id')}: {e}")
+        finally:
+            if acquired:
+                self._slots.release()
+
+    async def close(self):
+        """Дождаться апдейтов в работе и закрыть сессию бота (при остановке приложения)"""
+        # Их записи должны попасть в буферы до того, как фоновые писатели остановятся
+        if self._background_feed_update_tasks:
+            await asyncio.wait(set(self._background_feed_update_tasks), timeout=self.drain_timeout)
+        await super().close()
+
+    def stats(self) -> dict:
+        """Апдейты в работе и принятые с начала работы"""
+        return {
+            'in_flight': len(self._background_feed_update_tasks),
+            'max_in_flight': self.max_in_flight,
+            'max_seen': self.max_seen,
+            'received': self.received,
+            'failed': self.failed
+        }
+
+
+class ShardWorkerHandler(BoundedRequestHandler):
+    """Обработчик процесса-воркера (см. workers.py)
+
+    Фронтовой процесс присылает пачки апдейтов этого шарда JSON-списком в
+    порядке получения. Апдейты одного пользователя обрабатываются строго
+    по очереди - следующий ждет окончания предыдущего; апдейты разных
+    пользователей, как и раньше, параллельно. В очереди одного
+    пользователя не больше max_queued_per_user апдейтов - лишние
+    отбрасываются (флуд), не доходя до слотов и до ThrottlingMiddleware.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_queued_per_user: int = 10, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, **kwargs)
+        self.max_queued_per_user = max_queued_per_user
+        self._last = {}    # user_id -> задача последнего апдейта пользователя
+        self._queued = {}  # user_id -> апдейтов пользователя в работе и в очереди
+        self.shed = 0
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        updates = await request.json(loads=bot.session.json_loads)
+        accepted = 0
+        for update in updates:
+            user_id = update_user_id(update)
+            if user_id and self._queued.get(user_id, 0) >= self.max_queued_per_user:
+                self.shed += 1
+                continue
+            task = await self._accept(bot, update, after=self._last.get(user_id))
+            accepted += 1
+            if user_id:
+                self._last[user_id] = task
+                self._queued[user_id] = self._queued.get(user_id, 0) + 1
+                task.add_done_callback(lambda done, user_id=user_id: self._forget(user_id, done))
+        return web.json_response({'accepted': accepted}, dumps=bot.session.json_dumps)
+
+    def _forget(self, user_id: int, task: asyncio.Task):
+        if self._last.get(user_id) is task:
+            del self._last[user_id]
+        self._queued[user_id] -= 1
+        if not self._queued[user_id]:
+            del self._queued[user_id]
+
+    def stats(self) -> dict:
+        return {**super().stats(), 'shed': self.shed}
+
+
+def update_user_id(update: dict) -> int:
+    """ID пользователя - автора апдейта (для каналов и опросов - ID чата или 0)"""
+    for key, event in update.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+        chat = event.get('chat') or event.get('message', {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    """Номер шарда пользователя: одинаковый во всех процессах и после перезапуска"""
+    # Фибоначчиево хэширование: старшие биты произведения перемешивают все биты ID
+    return (((user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % shards
+
+
+async def register_webhook(bot: Bot, base_url: str, secret_token: str):
+    """Указать Telegram адрес вебхука"""
+    webhook_url = f"{base_url}{WEBHOOK_PATH}"
+    await bot.set_webhook(
+        webhook_url,
+        secret_token=secret_token,
+        max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+    )
+    logging.info(f"Webhook set to: {webhook_url}")
+
+
+def create_app(dispatcher: Dispatcher, bot: Bot, secret_token: str, max_in_flight: int = 100) -> web.Application:
+    """aiohttp-приложение вебхука: запуск и остановка диспетчера в жизненном цикле приложения"""
+    app = web.Application()
+    handler = BoundedRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        secret_token=secret_token,
+        max_in_flight=max_in_flight
+    )
+    # Порядок важен: при остановке сначала дожидаемся апдейтов (register),
+    # потом выполняем shutdown диспетчера (setup_application)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+    app['webhook_handler'] = handler
+    return app
+
+
+def create_worker_app(dispatcher: Dispatcher, bot: Bot, max_in_flight: int = 100) -> web.Application:
+    """aiohttp-приложение воркера: принимает пачки апдейтов от фронтового процесса"""
+    app = web.Application()
+    handler = ShardWorkerHandler(
+        dispatcher=dispatcher, bot=bot, max_in_flight=max_in_flight,
+        max_queued_per_user=int(os.getenv('WEBHOOK_MAX_QUEUED_PER_USER', 10))
+    )
+    handler.register(app, path=WORKER_PATH)
+    setup_application(app, dispatcher, bot=bot)
+    app['webhook_handler'] = handler
+    return app
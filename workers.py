@@ -0,0 +1,341 @@
+"""Запуск бота в нескольких процессах за одним вебхуком
+
+Один процесс Python упирается в одно ядро. Здесь фронтовой процесс
+принимает вебхук Telegram, проверяет секрет и раскладывает апдейты по
+процессам-воркерам по хэшу ID пользователя (webhook.shard_for): апдейты
+одного пользователя всегда попадают в один воркер и обрабатываются по
+порядку. Воркер - обычный диспетчер из bot.py со своим event loop,
+фильтры и состояния FSM лежат в БД (db/state.py) и доступны любому процессу.
+
+Кэши сборок у каждого воркера свои. Сброс после записи (db.cache.
+cache_events) воркер рассылает остальным по их unix-сокетам (CachePeers),
+поэтому правка, оценка или удаление видны во всех процессах сразу, а не
+после истечения TTL.
+
+Запуск (продакшен, нужен RAILWAY_STATIC_URL):
+    python workers.py [число воркеров]
+По умолчанию воркеров столько, сколько ядер (или WEB_WORKERS).
+"""
+import asyncio
+import importlib
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from collections import deque
+from multiprocessing import get_context
+
+from aiohttp import web, ClientSession, UnixConnector
+
+from webhook import WEBHOOK_PATH, WORKER_PATH, create_worker_app, update_user_id, shard_for
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+CACHE_PATH = "/cache"
+
+
+class ShardForwarder:
+    """Пересылка апдейтов одному воркеру по unix-сокету
+
+    Одновременно в пути не больше одной пачки: пока воркер принимает
+    предыдущую, новые апдейты копятся в очереди и уходят следующей пачкой.
+    Так порядок апдейтов сохраняется, а под нагрузкой на один запрос к
+    воркеру приходится много апдейтов.
+    """
+
+    def __init__(self, socket_path: str, max_batch: int = 100):
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self._pending = deque()  # (тело апдейта, future)
+        self._wakeup = None
+        self._task = None
+        self._session = None
+
+        self.forwarded = 0
+        self.batches = 0
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._session = ClientSession(connector=UnixConnector(path=self.socket_path))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._session:
+            await self._session.close()
+
+    async def forward(self, body: bytes):
+        """Передать апдейт воркеру; возвращается, когда воркер принял его в работу"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((body, future))
+        self._wakeup.set()
+        await future
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                try:
+                    # Тела апдейтов уже JSON - склеиваем в список без повторной сериализации
+                    data = b"[" + b",".join(body for body, _ in batch) + b"]"
+                    async with self._session.post(
+                        f"http://worker{WORKER_PATH}", data=data,
+                        headers={"Content-Type": "application/json"}
+                    ) as response:
+                        response.raise_for_status()
+                except Exception as e:
+                    logging.error(f"Worker {self.socket_path} rejected {len(batch)} update(s): {e}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                self.forwarded += len(batch)
+                self.batches += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+
+class CachePeers:
+    """Рассылка сбросов кэшей остальным воркерам по их unix-сокетам
+
+    publish вызывается синхронно после коммита и не ждет соседей: события
+    копятся и уходят пачкой каждому воркеру из фоновой задачи. Если сосед
+    не принял пачку, его кэши догонит TTL.
+    """
+
+    def __init__(self, socket_paths: list):
+        self.socket_paths = socket_paths
+        self._pending = []  # [имя, аргументы]
+        self._wakeup = None
+        self._task = None
+        self._sessions = []
+
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._sessions = [ClientSession(connector=UnixConnector(path=path)) for path in self.socket_paths]
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for session in self._sessions:
+            await session.close()
+
+    def publish(self, name: str, args):
+        if self._wakeup is None:
+            return
+        self._pending.append([name, list(args)])
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            events, self._pending = self._pending, []
+            results = await asyncio.gather(
+                *(self._send(session, events) for session in self._sessions), return_exceptions=True
+            )
+            for path, result in zip(self.socket_paths, results):
+                if isinstance(result, Exception):
+                    self.failed += 1
+                    logging.warning(f"Worker {path} missed {len(events)} cache invalidation(s): {result}")
+                else:
+                    self.sent += 1
+
+    @staticmethod
+    async def _send(session: ClientSession, events: list):
+        async with session.post(f"http://worker{CACHE_PATH}", json=events) as response:
+            response.raise_for_status()
+
+
+def add_cache_peers(app: web.Application, peer_paths: list):
+    """Принимать сбросы кэшей от остальных воркеров и рассылать им свои"""
+    from db.cache import cache_events
+
+    peers = CachePeers(peer_paths)
+
+    async def handle(request: web.Request) -> web.Response:
+        for name, args in await request.json():
+            cache_events.apply(name, args)
+        return web.json_response({})
+
+    async def start(app: web.Application):
+        peers.start()
+        cache_events.publisher = peers.publish
+
+    async def stop(app: web.Application):
+        cache_events.publisher = None
+        await peers.stop()
+
+    app.router.add_post(CACHE_PATH, handle)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app['cache_peers'] = peers
+
+
+def create_front_app(socket_paths: list, secret_token: str, on_startup=None) -> web.Application:
+    """Фронтовое приложение: вебхук Telegram -> воркер шарда пользователя"""
+    app = web.Application()
+    forwarders = [ShardForwarder(path) for path in socket_paths]
+
+    async def handle(request: web.Request) -> web.Response:
+        if request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(body="Unauthorized", status=401)
+        body = await request.read()
+        shard = shard_for(update_user_id(json.loads(body)), len(forwarders))
+        try:
+            await forwarders[shard].forward(body)
+        except Exception:
+            # Telegram повторит апдейт позже
+            return web.Response(status=503)
+        return web.json_response({})
+
+    async def start(app: web.Application):
+        for forwarder in forwarders:
+            forwarder.start()
+        if on_startup is not None:
+            await on_startup()
+
+    async def stop(app: web.Application):
+        for forwarder in forwarders:
+            await forwarder.stop()
+
+    app.router.add_post(WEBHOOK_PATH, handle)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app['forwarders'] = forwarders
+    return app
+
+
+def run_worker(index: int, workers: int, socket_path: str, peer_paths: list, app_module: str,
+               max_in_flight: int):
+    """Точка входа процесса-воркера: диспетчер из app_module на unix-сокете
+
+    peer_paths - сокеты остальных воркеров, им рассылаются сбросы кэшей.
+    """
+    # bot.py читает номер воркера при импорте
+    os.environ['BOT_WORKER_INDEX'] = str(index)
+    os.environ['BOT_WORKERS'] = str(workers)
+    # Ctrl+C получает вся группа процессов - останавливает воркеры фронт (SIGTERM),
+    # когда перестанет принимать апдейты
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    module = importlib.import_module(app_module)
+    app = create_worker_app(module.dp, module.bot, max_in_flight=max_in_flight)
+    add_cache_peers(app, peer_paths)
+    asyncio.run(_serve_worker(app, socket_path))
+
+
+async def _serve_worker(app: web.Application, socket_path: str):
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.UnixSite(runner, socket_path).start()
+
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    await stopped.wait()
+    # Дожидается апдейтов в работе и выполняет shutdown диспетчера
+    await runner.cleanup()
+
+
+def start_workers(workers: int, app_module: str, max_in_flight: int = 100, timeout: float = 60.0):
+    """Запустить воркеры, вернуть (процессы, пути сокетов, временный каталог)"""
+    socket_dir = tempfile.mkdtemp(prefix="bot-workers-")
+    socket_paths = [os.path.join(socket_dir, f"worker-{index}.sock") for index in range(workers)]
+    context = get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(
+                index, workers, path, [peer for peer in socket_paths if peer != path],
+                app_module, max_in_flight
+            ),
+            name=f"bot-worker-{index}"
+        )
+        for index, path in enumerate(socket_paths)
+    ]
+    for process in processes:
+        process.start()
+
+    deadline = time.monotonic() + timeout
+    while not all(os.path.exists(path) for path in socket_paths):
+        if time.monotonic() > deadline or not all(process.is_alive() for process in processes):
+            stop_workers(processes, socket_dir)
+            raise RuntimeError("Workers failed to start")
+        time.sleep(0.05)
+    return processes, socket_paths, socket_dir
+
+
+def stop_workers(processes: list, socket_dir: str, timeout: float = 60.0):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+    shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def main():
+    """Фронт на PORT и воркеры с диспетчером bot.py"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(processName)s - %(name)s - %(message)s",
+    )
+    from aiogram import Bot
+    from config import TOKEN
+    from commands import set_bot_commands
+    from db.session import init_db
+    from webhook import get_webhook_secret, register_webhook
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv('WEB_WORKERS', os.cpu_count() or 1))
+    secret = get_webhook_secret(TOKEN)
+
+    # Схему создаем один раз до старта воркеров, чтобы они не мигрировали базу наперегонки
+    asyncio.run(init_db())
+    processes, socket_paths, socket_dir = start_workers(
+        workers, "bot", max_in_flight=int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', 100))
+    )
+    logging.info(f"Started {workers} worker(s)")
+
+    async def on_startup():
+        bot = Bot(token=TOKEN)
+        try:
+            await set_bot_commands(bot)
+            await register_webhook(bot, os.environ['RAILWAY_STATIC_URL'], secret)
+        finally:
+            await bot.session.close()
+
+    try:
+        web.run_app(
+            create_front_app(socket_paths, secret, on_startup=on_startup),
+            port=int(os.environ.get("PORT", 8000)),
+            host='0.0.0.0'
+        )
+    finally:
+        stop_workers(processes, socket_dir)
+
+
+if __name__ == "__main__":
+    main()